@@ -1,14 +1,52 @@
+import multiprocessing
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import customtkinter
+import numpy as np
 import os
 from server.libs.receipt_check import receipt_check
+from server.libs.calendar_snapshot import get_calendar_snapshot_store
+from server.libs.calendar_client import CalendarFetchError
+from server.libs.instrumentation import ProgressReport, CheckCancelled
+from server.libs.constant import CALENDAR_CACHE_ENABLED, RECEIPT_CHECK_REPORT_PATH, RESULT_PAGE_SIZE, SECTION_LABELS
 
 FONT_TYPE = "meiryo"
 PRIMARY = "blue"
 BACK_COLOR = "dark"
 FONT_COLOR = "white"
 FORM_SIZE = "1440x1080"
+# 照合の進捗のキューを読み取る間隔（ミリ秒）
+PROGRESS_POLL_MS = 100
+# 進捗バーに使うステージの順序と表示名（メモ・キャッシュを使った場合は途中のステージを飛ばす）
+PROGRESS_STAGES = {
+    'ibow_hash': "Ibowのファイルを確認しています",
+    'date_range': "Ibowの訪問日を読み込んでいます",
+    'ibow': "Ibowを読み込んでいます",
+    'rules': "ルール表を読み込んでいます",
+    'calendar_formatted': "カレンダーを取得しています",
+    'ibow_formatted': "Ibowを整形しています",
+    'merge': "カレンダーとIbowをマージしています",
+    'check': "照合しています",
+    'mark': "照合結果を作成しています",
+    'concat': "照合結果を作成しています",
+    'results': "照合結果を作成しています",
+}
+
+
+def describe_calendar_snapshot(df) -> str:
+    """
+    照合に使ったカレンダーのスナップショットが古い場合に、取得日時と経過時間を示す警告を返す（古くなければ空文字列）
+    :param df: 照合結果のデータフレーム（attrs['calendar_snapshot']にスナップショットの情報がある）
+    """
+    snapshot = df.attrs.get('calendar_snapshot') if df is not None else None
+    if not snapshot or not snapshot.get('stale'):
+        return ""
+    fetched_at = snapshot['fetched_at'].replace('T', ' ')
+    age_minutes = int(snapshot['age_seconds'] // 60)
+    age = f"{age_minutes // 60}時間{age_minutes % 60}分前" if age_minutes >= 60 else f"{age_minutes}分前"
+    return f"⚠ 最新のカレンダーを取得できなかったため、{fetched_at}（{age}）に取得したカレンダーで照合しました"
 
 
 class ReadCsvFrame(customtkinter.CTkFrame):
@@ -62,6 +100,9 @@ class DataDisplayFrame(customtkinter.CTkFrame):
 
         self.fonts = ("Arial", 15)
         self.result_df = None
+        # 表示中のページと、照合結果の境界行の位置（照合結果のattrs['boundary_rows']から取り出す）
+        self.page = 0
+        self.boundary_rows = np.array([], dtype=np.intp)
 
         self.setup_form()
 
@@ -71,6 +112,9 @@ class DataDisplayFrame(customtkinter.CTkFrame):
 
         self.label = customtkinter.CTkLabel(self, text="照合結果", font=("Arial", 11))
         self.label.grid(row=0, column=0, padx=20, sticky="w")
+        # 古いカレンダーのスナップショットで照合した場合の警告
+        self.snapshot_label = customtkinter.CTkLabel(self, text="", font=("Arial", 11), text_color="orange")
+        self.snapshot_label.grid(row=0, column=1, columnspan=2, padx=20, sticky="e")
         self.tree = ttk.Treeview(self, show="headings")
         self.tree.grid(row=1, column=0, columnspan=3, padx=10, pady=0, sticky="nsew")
 
@@ -82,31 +126,48 @@ class DataDisplayFrame(customtkinter.CTkFrame):
         self.scroll_x.grid(row=2, column=0, columnspan=3, sticky="ew")
         self.tree.configure(xscrollcommand=self.scroll_x.set)
 
+        # ページの切り替え（Treeviewには表示中のページの行だけを挿入する）
+        self.page_frame = customtkinter.CTkFrame(self, fg_color="transparent")
+        self.page_frame.grid(row=3, column=0, columnspan=3, padx=10, pady=(10, 0))
+        self.button_previous = customtkinter.CTkButton(self.page_frame, text="前へ", width=80, font=self.fonts,
+                                                       command=lambda: self.show_page(self.page - 1))
+        self.button_previous.grid(row=0, column=0, padx=5)
+        self.page_label = customtkinter.CTkLabel(self.page_frame, text="", font=("Arial", 11))
+        self.page_label.grid(row=0, column=1, padx=10)
+        self.button_next = customtkinter.CTkButton(self.page_frame, text="次へ", width=80, font=self.fonts,
+                                                   command=lambda: self.show_page(self.page + 1))
+        self.button_next.grid(row=0, column=2, padx=5)
+        self.section_menu = customtkinter.CTkOptionMenu(self.page_frame, values=SECTION_LABELS, font=self.fonts,
+                                                        command=self.show_section)
+        self.section_menu.grid(row=0, column=3, padx=(20, 5))
+        self.set_page_controls(None)
+
         self.button_download = customtkinter.CTkButton(master=self, command=self.download_csv,
                                                        text="CSV形式でダウンロード",
                                                        font=self.fonts)
-        self.button_download.grid(row=3, column=0, columnspan=3, padx=10, pady=10)
+        self.button_download.grid(row=4, column=0, columnspan=3, padx=10, pady=10)
         style = ttk.Style()
         style.configure("Treeview.Heading", font=("Arial", 12, "bold", "underline"))
         style.configure("Treeview", font=("Arial", 10), rowheight=25)
 
     def display_text(self, text):
-        for column in self.tree.get_children():
-            self.tree.delete(column)
+        self.tree.delete(*self.tree.get_children())
+        self.set_page_controls(None)
+        self.snapshot_label.configure(text="")
 
         self.tree["columns"] = ["message"]
         self.tree.heading("message", text=text)
         self.tree.column("message", width=100)
 
     def display_dataframe(self, df):
-        for column in self.tree.get_children():
-            self.tree.delete(column)
+        self.tree.delete(*self.tree.get_children())
 
         if df is None:
             self.display_text("表示するデータがありません")
             return
         if df.shape[0] == 0:
             self.display_text("不整合データはありません")
+            self.snapshot_label.configure(text=describe_calendar_snapshot(df))
             return
 
         self.tree["columns"] = list(df.columns)
@@ -121,11 +182,58 @@ class DataDisplayFrame(customtkinter.CTkFrame):
         # タグの設定
         self.tree.tag_configure('boundary', background='lightgray')
 
-        for index, row in df.iterrows():
-            tag = 'boundary' if row['訪問日'] in ['不整合データ', '整合データ', 'カレンダーのみ', 'Ibowのみ'] else ''
-            self.tree.insert("", tk.END, values=list(row), tags=(tag,))
-
         self.result_df = df
+        self.snapshot_label.configure(text=describe_calendar_snapshot(df))
+        # 境界行はinsert_boundariesで挟んだ際に記録した位置で判定する（訪問日の値では判定しない）
+        self.boundary_rows = np.asarray(df.attrs.get('boundary_rows', ()), dtype=np.intp)
+        self.show_page(0)
+
+    def show_page(self, page: int):
+        """
+        照合結果のページを表示する（Treeviewの行を表示中のページの行だけに入れ替える）
+        :param page: ページ番号（0始まり、範囲外の場合は最初または最後のページ）
+        """
+        if self.result_df is None:
+            return
+        page_count = max(-(-len(self.result_df) // RESULT_PAGE_SIZE), 1)
+        self.page = min(max(page, 0), page_count - 1)
+        start = self.page * RESULT_PAGE_SIZE
+        stop = min(start + RESULT_PAGE_SIZE, len(self.result_df))
+        rows = self.result_df.iloc[start:stop].to_numpy(dtype=object).tolist()
+        # 境界行は記録した位置から判定する
+        boundaries = set(self.boundary_rows[np.searchsorted(self.boundary_rows, start):
+                                            np.searchsorted(self.boundary_rows, stop)] - start)
+
+        self.tree.delete(*self.tree.get_children())
+        for position, values in enumerate(rows):
+            self.tree.insert("", tk.END, values=values, tags=('boundary',) if position in boundaries else ())
+        self.tree.yview_moveto(0)
+        self.set_page_controls(page_count)
+
+    def show_section(self, label: str):
+        """
+        区分の境界行を含むページを表示する
+        """
+        if self.result_df is None or len(self.boundary_rows) != len(SECTION_LABELS):
+            return
+        self.show_page(int(self.boundary_rows[SECTION_LABELS.index(label)]) // RESULT_PAGE_SIZE)
+
+    def set_page_controls(self, page_count):
+        """
+        ページの切り替えの表示を更新する（page_countがNoneの場合は照合結果を表示していないため無効にする）
+        """
+        if page_count is None:
+            self.page_label.configure(text="")
+            for widget in (self.button_previous, self.button_next, self.section_menu):
+                widget.configure(state="disabled")
+            return
+        start = self.page * RESULT_PAGE_SIZE
+        self.page_label.configure(text=f"{self.page + 1} / {page_count} ページ"
+                                       f"（{start + 1}〜{min(start + RESULT_PAGE_SIZE, len(self.result_df))}行目 / "
+                                       f"全{len(self.result_df)}行）")
+        self.button_previous.configure(state="normal" if self.page > 0 else "disabled")
+        self.button_next.configure(state="normal" if self.page < page_count - 1 else "disabled")
+        self.section_menu.configure(state="normal" if len(self.boundary_rows) == len(SECTION_LABELS) else "disabled")
 
 
     def download_csv(self):
@@ -136,7 +244,27 @@ class DataDisplayFrame(customtkinter.CTkFrame):
         save_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSVファイル", "*.csv")])
         if save_path:
             self.result_df.to_csv(save_path, index=False)
-            messagebox.showinfo("情報", f"CSVファイルが保存されました: {save_path}")
+            # 古いカレンダーで照合した結果であれば、保存したCSVについても警告する
+            warning = describe_calendar_snapshot(self.result_df)
+            if warning:
+                messagebox.showwarning("警告", f"CSVファイルが保存されました: {save_path}\n{warning}")
+            else:
+                messagebox.showinfo("情報", f"CSVファイルが保存されました: {save_path}")
+
+
+def run_receipt_check(receipt_file, report: ProgressReport, progress_queue: queue.Queue) -> None:
+    """
+    ワーカースレッドで照合し、結果または例外をキューに送る（メッセージボックスは画面のスレッドで表示する）
+    キューには ('result', 照合結果) または ('error', 例外) を送る
+    """
+    try:
+        result_df = receipt_check(receipt_file, report=report, show_errors=False)
+    except Exception as error:
+        progress_queue.put(('error', error))
+        return
+    if RECEIPT_CHECK_REPORT_PATH:
+        report.dump_json(RECEIPT_CHECK_REPORT_PATH)
+    progress_queue.put(('result', result_df))
 
 
 class App(customtkinter.CTk):
@@ -145,6 +273,9 @@ class App(customtkinter.CTk):
         self.fonts = (FONT_TYPE, 15)
         self.geometry(FORM_SIZE)
         self.title("CSV input")
+        # 実行中の照合の進捗のキューと中止のイベント（実行中でなければNone）
+        self.progress_queue = None
+        self.cancel_event = None
         self.setup_form()
 
     def setup_form(self):
@@ -157,9 +288,23 @@ class App(customtkinter.CTk):
         self.receipt_frame.grid(row=0, column=0, padx=20, pady=10, sticky="ew")
 
 
-        self.button_execute = customtkinter.CTkButton(self, text="照合", command=self.button_execute_callback,
-                                                      font=self.fonts)
-        self.button_execute.grid(row=2, column=0, padx=20, pady=(10, 20))
+        self.progress_frame = customtkinter.CTkFrame(self, fg_color="transparent")
+        self.progress_frame.grid(row=1, column=0, padx=20, sticky="ew")
+        self.progress_frame.grid_columnconfigure(0, weight=1)
+        self.progress_bar = customtkinter.CTkProgressBar(self.progress_frame)
+        self.progress_bar.grid(row=0, column=0, padx=10, pady=(10, 0), sticky="ew")
+        self.progress_bar.set(0)
+        self.progress_label = customtkinter.CTkLabel(self.progress_frame, text="", font=(FONT_TYPE, 11))
+        self.progress_label.grid(row=1, column=0, padx=10, sticky="w")
+
+        self.button_frame = customtkinter.CTkFrame(self, fg_color="transparent")
+        self.button_frame.grid(row=2, column=0, padx=20, pady=(10, 20))
+        self.button_execute = customtkinter.CTkButton(self.button_frame, text="照合",
+                                                      command=self.button_execute_callback, font=self.fonts)
+        self.button_execute.grid(row=0, column=0, padx=10)
+        self.button_cancel = customtkinter.CTkButton(self.button_frame, text="中止", command=self.button_cancel_callback,
+                                                     font=self.fonts, state="disabled")
+        self.button_cancel.grid(row=0, column=1, padx=10)
 
         self.data_display_frame = DataDisplayFrame(self)
         self.data_display_frame.grid(row=3, column=0, padx=20, pady=10, sticky="nsew")
@@ -170,17 +315,98 @@ class App(customtkinter.CTk):
         if not receipt_file:
             messagebox.showwarning("エラー", "ファイルが選択されていません")
             return
-        try:
-            result_df = receipt_check(receipt_file)
+
+        # 照合はワーカースレッドで実行し、画面は進捗のキューを定期的に読み取って更新する
+        self.progress_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        report = ProgressReport(self.progress_queue, self.cancel_event)
+        threading.Thread(target=run_receipt_check, args=(receipt_file, report, self.progress_queue),
+                         name='receipt-check', daemon=True).start()
+        self.set_running(True)
+        self.progress_bar.set(0)
+        self.progress_label.configure(text="照合を開始しました")
+        self.after(PROGRESS_POLL_MS, self.poll_progress, self.progress_queue, 0)
+
+        self.receipt_frame.file_path = None
+        self.receipt_frame.textbox.delete(0, tk.END)
+        self.receipt_frame.textbox.insert(0, "ファイルが選択されていません")
+
+    def button_cancel_callback(self):
+        """
+        実行中の照合を中止する（ワーカースレッドは次のステージの開始時に止まる）
+        """
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+        # 中止した照合の進捗・結果は読み取らない
+        self.progress_queue = None
+        self.cancel_event = None
+        self.set_running(False)
+        self.progress_bar.set(0)
+        self.progress_label.configure(text="照合を中止しました")
+        self.data_display_frame.display_text("照合を中止しました")
+
+    def set_running(self, running: bool):
+        self.button_execute.configure(state="disabled" if running else "normal")
+        self.button_cancel.configure(state="normal" if running else "disabled")
+
+    def poll_progress(self, progress_queue: queue.Queue, completed: int):
+        """
+        照合の進捗のキューを読み取り、進捗バーを更新する（照合が終わるまでPROGRESS_POLL_MSごとに呼び出す）
+        :param progress_queue: 読み取るキュー（中止した照合のキューであれば読み取りをやめる）
+        :param completed: 終了したステージのうち、PROGRESS_STAGESで最も後のものの位置+1
+        """
+        if progress_queue is not self.progress_queue:
+            return
+        stages = list(PROGRESS_STAGES)
+        while True:
+            try:
+                kind, value = progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'start' and value in PROGRESS_STAGES:
+                self.progress_label.configure(text=PROGRESS_STAGES[value])
+            elif kind == 'done' and value in PROGRESS_STAGES:
+                completed = max(completed, stages.index(value) + 1)
+                self.progress_bar.set(completed / len(stages))
+            elif kind == 'result':
+                self.finish_check(value, None)
+                return
+            elif kind == 'error':
+                self.finish_check(None, value)
+                return
+        self.after(PROGRESS_POLL_MS, self.poll_progress, progress_queue, completed)
+
+    def finish_check(self, result_df, error):
+        """
+        照合の終了後に、照合結果を表示する（失敗した場合はメッセージボックスを表示する）
+        """
+        self.progress_queue = None
+        self.cancel_event = None
+        self.set_running(False)
+        if error is None:
+            self.progress_bar.set(1)
+            self.progress_label.configure(text="照合が完了しました")
             self.data_display_frame.display_dataframe(result_df)
-        finally:
-            result_df = None
-            self.receipt_frame.file_path = None
-            self.receipt_frame.textbox.delete(0, tk.END)
-            self.receipt_frame.textbox.insert(0, "ファイルが選択されていません")
+            return
+
+        self.progress_bar.set(0)
+        self.progress_label.configure(text="照合に失敗しました")
+        if isinstance(error, CheckCancelled):
+            self.data_display_frame.display_text("照合を中止しました")
+        elif isinstance(error, CalendarFetchError):
+            messagebox.showerror("エラー", "データの取得に失敗しました: 開発者にお問い合わせください。")
+        elif isinstance(error, ValueError):
+            messagebox.showerror("エラー", str(error))
+        else:
+            messagebox.showerror("エラー", f"照合中にエラーが発生しました: {error}")
 
 
 
 if __name__ == "__main__":
+    # PyInstallerでexe化した場合に、並列照合のワーカーのプロセスがアプリを起動し直さないようにする
+    multiprocessing.freeze_support()
+    if CALENDAR_CACHE_ENABLED:
+        # 整形済みのカレンダーのスナップショットをバックグラウンドで定期的に更新し、照合時はIbowの処理だけにする
+        get_calendar_snapshot_store().start_refresher()
     app = App()
     app.mainloop()
@@ -0,0 +1,2 @@
+from .generate_data import generate_dataframes, write_dataset
+from .run_benchmark import run, benchmark_stages, benchmark_archive, serve_calendar_file
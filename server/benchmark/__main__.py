@@ -0,0 +1,3 @@
+from .run_benchmark import main
+
+main()
@@ -0,0 +1,162 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from server.libs.constant import USE_IBOW_COLUMNS, ADD_ON_COLUMNS
+
+CALENDAR_COLUMNS = ["訪問日", "利用者名", "開始時間", "終了時間", "提供時間", "サービス内容", "主訪問者"]
+
+# ベンチマーク用のサービス内容と、それぞれの提供時間（分）の範囲
+SERVICES = [
+    ("訪看I２", 20, 29),
+    ("訪看I３", 30, 59),
+    ("訪看I４", 60, 89),
+    ("予防訪看I３", 30, 59),
+    ("訪看I５", 21, 40),
+    ("訪看I５・２超", 41, 60),
+    ("基本療養費I・３日", 30, 90),
+    ("難病等複数回訪問加算(２回)", 30, 90),
+]
+# 全角・半角の表記ゆれ（正規化後に同じ値になる置き換え）
+WIDTH_VARIANTS = [("I", "Ⅰ"), ("I", "1"), ("２", "2"), ("３", "3"), ("・", "･")]
+ADD_ONS = ["緊急時訪問看護加算", "特別管理加算", "長時間訪問看護加算", "複数名訪問看護加算", "夜間・早朝訪問看護加算"]
+TIME_LABELS = np.array([f"{minutes // 60}:{minutes % 60:02d}" for minutes in range(24 * 60)], dtype=object)
+
+
+def apply_width_variants(values: np.ndarray, rate: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    指定した割合の値に全角・半角の表記ゆれを入れる（ユニークな値ごとに置き換える）
+    :param values: 文字列の配列
+    :param rate: 表記ゆれを入れる割合
+    :param rng: 乱数生成器
+    :return: 表記ゆれを入れた配列
+    """
+    values = values.copy()
+    rows = np.flatnonzero(rng.random(len(values)) < rate)
+    variants = rng.integers(len(WIDTH_VARIANTS), size=len(rows))
+    for variant, (old, new) in enumerate(WIDTH_VARIANTS):
+        target = rows[variants == variant]
+        codes, uniques = pd.factorize(values[target])
+        replaced = np.array([value.replace(old, new) for value in uniques], dtype=object)
+        values[target] = replaced[codes]
+    return values
+
+
+def generate_dataframes(n_visits: int, seed: int = 0, mismatch_rate: float = 0.1, out_of_range_rate: float = 0.02,
+                        calendar_only_rate: float = 0.03, ibow_only_rate: float = 0.03, repeat_rate: float = 0.1,
+                        width_variant_rate: float = 0.2, missing_rate: float = 0.01, month: str = "2024-05"
+                        ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    1か月分の訪問データから、ベンチマーク用のカレンダーとIbowのデータフレームを生成する
+    :param n_visits: Ibowの訪問件数（カレンダーのみの訪問は別に追加される）
+    :param seed: 乱数のシード
+    :param mismatch_rate: カレンダー側の開始時間・提供時間・サービス内容を変える割合
+    :param out_of_range_rate: 提供時間をサービスの有効範囲外にする割合
+    :param calendar_only_rate: カレンダーにだけある訪問の割合
+    :param ibow_only_rate: Ibowにだけある訪問の割合
+    :param repeat_rate: 同じ日・同じ利用者・同じ訪問者で2回目の訪問がある割合
+    :param width_variant_rate: 利用者名・主訪問者・サービス内容に全角・半角の表記ゆれを入れる割合
+    :param missing_rate: 提供時間・サービス内容・加算を欠損値にする割合
+    :param month: 訪問月（YYYY-MM）
+    :return: calendar_df, ibow_df（いずれもCSVに書き出す前の文字列表現）
+    """
+    rng = np.random.default_rng(seed)
+    period = pd.Period(month, freq="M")
+    days = pd.date_range(period.start_time, period.end_time.normalize()).strftime("%Y/%m/%d").to_numpy(dtype=object)
+    n_clients = max(n_visits // 20, 10)
+    n_nurses = max(n_visits // 200, 4)
+    clients = np.array([f"利用者{i:06d}　太郎" for i in range(n_clients)], dtype=object)
+    nurses = np.array([f"訪問者{i:04d} 花子" for i in range(n_nurses)], dtype=object)
+
+    # 1回目の訪問（8:00〜16:55、5分刻み）
+    n_first = int(round(n_visits / (1 + repeat_rate)))
+    service_ids = rng.integers(len(SERVICES), size=n_visits)
+    min_minutes = np.array([service[1] for service in SERVICES])[service_ids]
+    max_minutes = np.array([service[2] for service in SERVICES])[service_ids]
+    minutes = rng.integers(min_minutes, max_minutes + 1)
+    out_of_range = rng.random(n_visits) < out_of_range_rate
+    minutes[out_of_range] = max_minutes[out_of_range] + rng.integers(1, 30, size=out_of_range.sum())
+    day_ids = rng.integers(len(days), size=n_visits)
+    client_ids = rng.integers(n_clients, size=n_visits)
+    nurse_ids = rng.integers(n_nurses, size=n_visits)
+    starts = rng.integers(8 * 12, 17 * 12, size=n_visits) * 5
+
+    # 同じ日の2回目の訪問は、1回目の訪問と同じキーで2〜4時間後に開始する
+    repeats = np.arange(n_first, n_visits)
+    origins = rng.integers(n_first, size=len(repeats))
+    day_ids[repeats] = day_ids[origins]
+    client_ids[repeats] = client_ids[origins]
+    nurse_ids[repeats] = nurse_ids[origins]
+    starts[repeats] = np.minimum(starts[origins] + rng.integers(24, 49, size=len(repeats)) * 5, 21 * 60)
+
+    ibow_df = pd.DataFrame({
+        "訪問日": days[day_ids],
+        "利用者名": clients[client_ids],
+        "開始時間": starts,
+        "終了時間": starts + minutes,
+        "提供時間": minutes.astype(float),
+        "サービス内容": np.array([service[0] for service in SERVICES], dtype=object)[service_ids],
+        "主訪問者": nurses[nurse_ids],
+    })
+
+    # カレンダー: Ibowのみの訪問を除き、一部の値を変え、カレンダーのみの訪問を追加する
+    calendar_df = ibow_df[rng.random(n_visits) >= ibow_only_rate].copy()
+    changes = np.flatnonzero(rng.random(len(calendar_df)) < mismatch_rate)
+    kinds = rng.integers(3, size=len(changes))
+    start_col, end_col = calendar_df.columns.get_loc("開始時間"), calendar_df.columns.get_loc("終了時間")
+    service_time_col = calendar_df.columns.get_loc("提供時間")
+    service_col = calendar_df.columns.get_loc("サービス内容")
+    shift = rng.choice([-15, -10, 10, 15], size=len(changes))
+    calendar_df.iloc[changes[kinds == 0], start_col] += shift[kinds == 0]
+    calendar_df.iloc[changes[kinds == 0], end_col] += shift[kinds == 0]
+    calendar_df.iloc[changes[kinds == 1], service_time_col] += 5
+    calendar_df.iloc[changes[kinds == 1], end_col] += 5
+    calendar_df.iloc[changes[kinds == 2], service_col] = "医"
+
+    n_calendar_only = int(round(n_visits * calendar_only_rate))
+    calendar_only_df = ibow_df.sample(n=n_calendar_only, random_state=seed, replace=n_calendar_only > n_visits)
+    calendar_only_df = calendar_only_df.assign(
+        利用者名=np.array([f"新規{i:06d}　次郎" for i in rng.integers(n_clients, size=n_calendar_only)], dtype=object))
+    calendar_df = pd.concat([calendar_df, calendar_only_df], ignore_index=True)
+
+    for df in (calendar_df, ibow_df):
+        for column in ["利用者名", "主訪問者", "サービス内容"]:
+            df[column] = apply_width_variants(df[column].to_numpy(dtype=object), width_variant_rate, rng)
+        df["開始時間"] = TIME_LABELS[df["開始時間"].to_numpy() % (24 * 60)]
+        df["終了時間"] = TIME_LABELS[df["終了時間"].to_numpy() % (24 * 60)]
+        for column in ["提供時間", "サービス内容"]:
+            df.loc[rng.random(len(df)) < missing_rate, column] = np.nan
+
+    # 加算①は大半が「通常」、加算②以降はまれに入る
+    add_on_values = np.array(ADD_ONS, dtype=object)
+    for slot, column in enumerate(ADD_ON_COLUMNS):
+        rate = [0.9, 0.2, 0.05, 0.01, 0.01][slot]
+        values = np.full(len(ibow_df), np.nan, dtype=object)
+        filled = rng.random(len(ibow_df)) < rate
+        values[filled] = add_on_values[rng.integers(len(ADD_ONS), size=filled.sum())]
+        if slot == 0:
+            values[rng.random(len(ibow_df)) < 0.8] = "通常"
+            values[rng.random(len(ibow_df)) < missing_rate] = np.nan
+        ibow_df[column] = values
+
+    return calendar_df[CALENDAR_COLUMNS], ibow_df.sample(frac=1, random_state=seed).reset_index(drop=True)[USE_IBOW_COLUMNS]
+
+
+def write_dataset(directory: Path, n_visits: int, seed: int = 0, **options) -> tuple[Path, Path]:
+    """
+    ベンチマーク用のカレンダーとIbowのCSVを生成して書き出す（既にあれば再利用する）
+    :param directory: 書き出し先のディレクトリ
+    :param n_visits: Ibowの訪問件数
+    :param seed: 乱数のシード
+    :param options: generate_dataframesに渡すその他の引数
+    :return: calendar_path, ibow_path
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    suffix = "_".join([str(n_visits), str(seed)] + [f"{key}{value}" for key, value in sorted(options.items())])
+    calendar_path = directory / f"calendar_{suffix}.csv"
+    ibow_path = directory / f"ibow_{suffix}.csv"
+    if not (calendar_path.exists() and ibow_path.exists()):
+        calendar_df, ibow_df = generate_dataframes(n_visits, seed=seed, **options)
+        calendar_df.to_csv(calendar_path, index=False, encoding="utf-8")
+        ibow_df.to_csv(ibow_path, index=False, encoding="utf-8")
+    return calendar_path, ibow_path
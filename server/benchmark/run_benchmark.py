@@ -0,0 +1,222 @@
+import argparse
+import gc
+import http.server
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from server.libs.get_dataframe import get_dataframes
+from server.libs.constant import RESULT_COLUMNS
+from server.libs.format_dataframe import format_dataframes, render_dataframe
+from server.libs.validate_dataframe import (merge_dataframes, check_columns, categorize_rows, get_valid_ranges,
+                                            mark_mismatches, mark_matches, insert_boundaries)
+from .generate_data import write_dataset
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+DEFAULT_DATA_DIR = Path(__file__).resolve().parent / "data"
+# 旧実装（server/archive）は行ごとのapplyのため、これより大きい件数では計測しない
+DEFAULT_ARCHIVE_MAX_VISITS = 20_000
+
+
+@contextmanager
+def serve_calendar_file(calendar_path: Path):
+    """
+    カレンダーのCSVファイルをローカルのHTTPサーバーで返す（GASのAPIの代わり）
+    :param calendar_path: カレンダーのCSVファイルのパス
+    :return: CSVを返すURL
+    """
+    body = Path(calendar_path).read_bytes()
+
+    class CalendarHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CalendarHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def measure(stage: str, trace_memory: bool, func, *args, **kwargs):
+    """
+    処理を1回実行し、経過時間またはピークメモリ（tracemallocで追跡した確保量）を計測する
+    tracemallocはPythonオブジェクトの多い処理を大きく遅くするため、経過時間は追跡していない実行で計測する
+    :param stage: ステージ名
+    :param trace_memory: ピークメモリを計測するか（Falseの場合は経過時間を計測する）
+    :param func: 計測する関数
+    :return: (関数の戻り値, 計測結果の辞書)
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    if trace_memory:
+        return result, {"stage": stage, "seconds": np.nan, "peak_mib": peak / 2 ** 20}
+    return result, {"stage": stage, "seconds": seconds, "peak_mib": np.nan}
+
+
+def benchmark_stages(ibow_path: Path, calendar_url: str, trace_memory: bool = False, match_by_time: bool = False
+                     ) -> list[dict]:
+    """
+    receipt_checkの各ステージを順に実行し、ステージごとに計測する
+    :param ibow_path: IbowのCSVファイルのパス
+    :param calendar_url: カレンダーのCSVを返すURL
+    :param trace_memory: ピークメモリを計測するか（Falseの場合は経過時間を計測する）
+    :param match_by_time: 開始時間で訪問を対応付けるか
+    :return: ステージごとの計測結果のリスト
+    """
+    records = []
+    (calendar_df, ibow_df), record = measure("get_dataframes", trace_memory, get_dataframes, ibow_path, calendar_url,
+                                             use_cache=False)
+    records.append(record)
+    (calendar_df, ibow_df), record = measure("format_dataframes", trace_memory, format_dataframes,
+                                             calendar_df, ibow_df)
+    records.append(record)
+    merged_df, record = measure("merge_dataframes", trace_memory, merge_dataframes, calendar_df, ibow_df,
+                                match_by_time=match_by_time)
+    records.append(record)
+    _, record = measure("check_columns", trace_memory, check_columns, merged_df)
+    records.append(record)
+
+    def categorize_and_sort(df: pd.DataFrame) -> pd.DataFrame:
+        categorize_rows(df)
+        return df.take(np.argsort(df['区分'].to_numpy(), kind='stable')).reset_index(drop=True)
+
+    results_df, record = measure("categorize_rows", trace_memory, categorize_and_sort, merged_df)
+    records.append(record)
+
+    # render_resultsと同じ処理を、表示形式への変換と注記の追加に分けて計測する
+    display_df = results_df[RESULT_COLUMNS].copy()
+    _, record = measure("render_dataframe", trace_memory, render_dataframe, display_df)
+    records.append(record)
+    results, sections = results_df['検証結果'].to_numpy(), results_df['区分'].to_numpy()
+
+    def mark_mismatches_with_ranges(df: pd.DataFrame) -> dict:
+        valid_ranges = get_valid_ranges(results_df)
+        mark_mismatches(df, results, sections, valid_ranges)
+        return valid_ranges
+
+    valid_ranges, record = measure("mark_mismatches", trace_memory, mark_mismatches_with_ranges, display_df)
+    records.append(record)
+    _, record = measure("mark_matches", trace_memory, mark_matches, display_df, results, sections, valid_ranges)
+    records.append(record)
+    _, record = measure("concat", trace_memory, insert_boundaries, display_df, results_df['区分'].to_numpy())
+    records.append(record)
+    return records
+
+
+def benchmark_archive(ibow_path: Path, calendar_url: str, trace_memory: bool = False) -> list[dict]:
+    """
+    旧実装（server/archive/function.py）のreceipt_checkを計測する（比較の基準）
+    旧実装はサービス内容の欠損値を扱えないため、欠損値のないデータ（missing_rate=0）を渡す
+    :param ibow_path: IbowのCSVファイルのパス
+    :param calendar_url: カレンダーのCSVを返すURL
+    :param trace_memory: ピークメモリを計測するか（Falseの場合は経過時間を計測する）
+    :return: 計測結果のリスト
+    """
+    from server.archive import function as archive_function
+
+    original_url = archive_function.calendar_gas_api_url
+    archive_function.calendar_gas_api_url = calendar_url
+    records = []
+    try:
+        (calendar_df, ibow_df), record = measure("archive.get_dataframes", trace_memory,
+                                                 archive_function.get_dataframes, ibow_path)
+        records.append(record)
+        _, record = measure("archive.merge_and_validate", trace_memory,
+                            archive_function.merge_and_validate, calendar_df, ibow_df)
+        records.append(record)
+    except Exception as e:
+        # 旧実装はサービス内容の欠損値で失敗するため欠損値のないデータで計測するが、それ以外で失敗した場合はエラーとして記録する
+        records.append({"stage": "archive", "seconds": np.nan, "peak_mib": np.nan, "error": repr(e)})
+    finally:
+        archive_function.calendar_gas_api_url = original_url
+    return records
+
+
+def run(sizes: list, data_dir: Path = DEFAULT_DATA_DIR, repeat: int = 1,
+        archive_max_visits: int = DEFAULT_ARCHIVE_MAX_VISITS, match_by_time: bool = False, **options) -> pd.DataFrame:
+    """
+    件数ごとにデータを生成し、各ステージの計測結果をまとめる（繰り返した場合は最小の経過時間を採用する）
+    :param sizes: Ibowの訪問件数のリスト
+    :param data_dir: 生成したCSVの保存先
+    :param repeat: 繰り返し回数
+    :param archive_max_visits: 旧実装を計測する最大の件数（0で計測しない）
+    :param match_by_time: 開始時間で訪問を対応付けるか
+    :param options: generate_dataframesに渡すその他の引数
+    :return: 計測結果のデータフレーム
+    """
+    rows = []
+    for n_visits in sizes:
+        calendar_path, ibow_path = write_dataset(data_dir, n_visits, **options)
+        with serve_calendar_file(calendar_path) as calendar_url:
+            # 経過時間はrepeat回の最小値、ピークメモリは別に1回追跡して計測する
+            for trace_memory in [False] * repeat + [True]:
+                records = benchmark_stages(ibow_path, calendar_url, trace_memory, match_by_time=match_by_time)
+                rows += [dict(record, visits=n_visits) for record in records]
+        if n_visits <= archive_max_visits:
+            # 旧実装はサービス内容の欠損値で失敗するため、欠損値のないデータを別に生成して計測する
+            archive_calendar_path, archive_ibow_path = write_dataset(data_dir, n_visits,
+                                                                     **dict(options, missing_rate=0))
+            with serve_calendar_file(archive_calendar_path) as calendar_url:
+                for trace_memory in [False] * repeat + [True]:
+                    records = benchmark_archive(archive_ibow_path, calendar_url, trace_memory)
+                    rows += [dict(record, visits=n_visits) for record in records]
+
+    report = pd.DataFrame(rows).reindex(columns=["visits", "stage", "seconds", "peak_mib", "error"])
+    return report.groupby(["visits", "stage"], sort=False).agg(
+        seconds=("seconds", "min"), peak_mib=("peak_mib", "max"), error=("error", "first")).reset_index()
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="receipt_checkのステージごとのベンチマーク")
+    parser.add_argument("sizes", nargs="*", type=int, default=DEFAULT_SIZES, help="Ibowの訪問件数")
+    parser.add_argument("--repeat", type=int, default=1, help="繰り返し回数")
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR, help="生成したCSVの保存先")
+    parser.add_argument("--archive-max-visits", type=int, default=DEFAULT_ARCHIVE_MAX_VISITS,
+                        help="旧実装を計測する最大の件数（0で計測しない）")
+    parser.add_argument("--match-by-time", action="store_true", help="開始時間で訪問を対応付ける")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mismatch-rate", type=float)
+    parser.add_argument("--out-of-range-rate", type=float)
+    parser.add_argument("--calendar-only-rate", type=float)
+    parser.add_argument("--ibow-only-rate", type=float)
+    parser.add_argument("--repeat-rate", type=float)
+    parser.add_argument("--width-variant-rate", type=float)
+    parser.add_argument("--missing-rate", type=float)
+    parser.add_argument("--csv", type=Path, help="計測結果を書き出すCSVのパス")
+    args = parser.parse_args(argv)
+
+    options = {key: value for key, value in vars(args).items()
+               if key.endswith("_rate") and value is not None}
+    report = run(args.sizes, data_dir=args.data_dir, repeat=args.repeat, archive_max_visits=args.archive_max_visits,
+                 match_by_time=args.match_by_time, seed=args.seed, **options)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(report.to_string(index=False, float_format="{:.3f}".format))
+    if args.csv:
+        report.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,9 @@ a = Analysis(
     ['app_execute.py'],
     pathex=[],
     binaries=[],
-    datas=[('/Users/fuku079/.pyenv/versions/miniforge3-23.3.1-1/envs/auto_receipt/lib/python3.10/site-packages/customtkinter', 'customtkinter/')],
+    datas=[('/Users/fuku079/.pyenv/versions/miniforge3-23.3.1-1/envs/auto_receipt/lib/python3.10/site-packages/customtkinter', 'customtkinter/'),
+           ('libs/service_rules.json', 'server/libs/')],
+    hiddenimports=['pyarrow', 'pyarrow.feather', 'pyarrow.csv'],
     hookspath=['./hooks'],
     hooksconfig={},
     runtime_hooks=[],
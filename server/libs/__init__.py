@@ -2,5 +2,6 @@ from .get_dataframe import get_dataframes
 from .validate_dataframe import merge_and_validate
 from .format_dataframe import format_dataframes
 from .receipt_check import receipt_check
+from .instrumentation import PipelineReport
 
 __version__ = "0.1.0"
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+import pandas as pd
+from .calendar_client import CalendarClient, CalendarFetchError, get_calendar_client
+from .constant import (CALENDAR_CACHE_DIR, CALENDAR_CACHE_TTL_SECONDS, CALENDAR_CACHE_STALE_SECONDS,
+                       CALENDAR_CACHE_REVALIDATE_WAIT_SECONDS)
+
+
+class CalendarCache:
+    """
+    カレンダーのCSVをエンドポイントのURLとクエリパラメータごとにディスクへ保存するキャッシュ
+    - TTL以内であれば保存したスナップショットを返す
+    - TTLを過ぎていれば取得し直す（ETag/Last-Modifiedがある場合は条件付きリクエストで再検証する）
+    - TTLを過ぎてからstale_seconds以内であれば、エンドポイントが遅い・落ちている場合は古いスナップショットを返し、
+      更新はバックグラウンドで続ける
+    返すデータフレームのattrs['calendar_snapshot']に、スナップショットの取得日時・経過秒数・古いかどうかを記録する
+    """
+
+    def __init__(self, directory: Path = CALENDAR_CACHE_DIR, ttl_seconds: float = CALENDAR_CACHE_TTL_SECONDS,
+                 stale_seconds: float = CALENDAR_CACHE_STALE_SECONDS,
+                 revalidate_wait_seconds: float = CALENDAR_CACHE_REVALIDATE_WAIT_SECONDS, client: CalendarClient = None):
+        self.directory = Path(directory)
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.revalidate_wait_seconds = revalidate_wait_seconds
+        self.client = client or get_calendar_client()
+        self._lock = threading.Lock()
+        self._refreshing = {}
+
+    def get_key(self, url: str, params: dict = None) -> str:
+        """
+        URLとクエリパラメータからキャッシュのキーを作成する
+        """
+        source = json.dumps([url, sorted((params or {}).items())], ensure_ascii=False, default=str)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def get_paths(self, key: str) -> tuple[Path, Path]:
+        return self.directory / f"{key}.csv", self.directory / f"{key}.json"
+
+    def read_metadata(self, key: str) -> dict:
+        data_path, metadata_path = self.get_paths(key)
+        try:
+            with open(metadata_path, encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return metadata if data_path.exists() else None
+
+    def fetch_csv(self, url: str, params: dict = None, **read_csv_options) -> pd.DataFrame:
+        """
+        キャッシュを使ってカレンダーのCSVを取得する
+        :param url: エンドポイントのURL
+        :param params: クエリパラメータ
+        :param read_csv_options: pd.read_csvに渡す引数
+        :return: データフレーム（attrs['calendar_snapshot']にスナップショットの情報を記録する）
+        """
+        key = self.get_key(url, params)
+        metadata = self.read_metadata(key)
+        age = time.time() - metadata['fetched_at'] if metadata else None
+
+        if metadata is None or age > self.ttl_seconds + self.stale_seconds:
+            metadata = self.refresh(key, url, params, metadata)
+        elif age > self.ttl_seconds:
+            # 更新をrevalidate_wait_secondsだけ待ち、間に合わなければ古いスナップショットを返す（更新は続ける）
+            self.refresh_in_background(key, url, params, metadata).join(self.revalidate_wait_seconds)
+            metadata = self.read_metadata(key) or metadata
+
+        return self.read_snapshot(key, metadata, **read_csv_options)
+
+    def read_snapshot(self, key: str, metadata: dict, **read_csv_options) -> pd.DataFrame:
+        data_path, _ = self.get_paths(key)
+        calendar_df = pd.read_csv(data_path, **read_csv_options)
+        age = max(time.time() - metadata['fetched_at'], 0)
+        calendar_df.attrs['calendar_snapshot'] = {
+            'url': metadata['url'],
+            'fetched_at': datetime.fromtimestamp(metadata['fetched_at']).isoformat(timespec='seconds'),
+            'age_seconds': age,
+            'stale': age > self.ttl_seconds,
+        }
+        return calendar_df
+
+    def refresh(self, key: str, url: str, params: dict, metadata: dict = None) -> dict:
+        """
+        エンドポイントからスナップショットを取得し直す（前回のETag/Last-Modifiedがあれば条件付きリクエストにする）
+        :return: 更新後のメタデータ
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data_path, metadata_path = self.get_paths(key)
+        # 書き込み途中のファイルを読まないように、一時ファイルに書き出してから置き換える
+        temporary_path = data_path.with_name(f"{data_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            validators = self.client.download(url, temporary_path, params=params,
+                                              etag=metadata and metadata.get('etag'),
+                                              last_modified=metadata and metadata.get('last_modified'))
+            if validators is None:
+                # 304: 保存したスナップショットは最新のまま
+                validators = {'etag': metadata.get('etag'), 'last_modified': metadata.get('last_modified')}
+            else:
+                os.replace(temporary_path, data_path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+
+        metadata = dict(validators, url=url, params=params, fetched_at=time.time())
+        temporary_metadata_path = temporary_path.with_suffix('.json.tmp')
+        with open(temporary_metadata_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, default=str)
+        os.replace(temporary_metadata_path, metadata_path)
+        return metadata
+
+    def refresh_in_background(self, key: str, url: str, params: dict, metadata: dict) -> threading.Thread:
+        """
+        バックグラウンドのスレッドでスナップショットを更新する（同じキーの更新は同時に1つまで）
+        """
+        with self._lock:
+            thread = self._refreshing.get(key)
+            if thread is not None and thread.is_alive():
+                return thread
+
+            def refresh():
+                try:
+                    self.refresh(key, url, params, metadata)
+                except (CalendarFetchError, OSError):
+                    # 次回の取得時に再び更新する
+                    pass
+
+            thread = threading.Thread(target=refresh, name=f"calendar-cache-{key[:8]}", daemon=True)
+            self._refreshing[key] = thread
+            thread.start()
+            return thread
+
+
+@lru_cache(maxsize=None)
+def get_calendar_cache() -> CalendarCache:
+    """
+    プロセス内で共有するカレンダーのキャッシュを返す（バックグラウンドの更新を重複させないため）
+    """
+    return CalendarCache()
@@ -0,0 +1,160 @@
+import shutil
+import time
+import pandas as pd
+import requests
+import urllib3
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+from requests.adapters import HTTPAdapter
+from .constant import (CALENDAR_CONNECT_TIMEOUT, CALENDAR_READ_TIMEOUT, CALENDAR_MAX_RETRIES,
+                       CALENDAR_BACKOFF_FACTOR, CALENDAR_BACKOFF_MAX, CALENDAR_POOL_SIZE)
+
+# 再試行するHTTPステータス（GASの一時的なエラー・レート制限）
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+class CalendarFetchError(ValueError):
+    """
+    カレンダーのデータの取得に失敗した場合のエラー（これまで通りValueErrorとしても扱える）
+    """
+
+    def __init__(self, message: str, url: str = None, status_code: int = None):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
+
+
+class CalendarTimeoutError(CalendarFetchError):
+    """
+    接続または読み込みがタイムアウトした場合のエラー
+    """
+
+
+class CalendarConnectionError(CalendarFetchError):
+    """
+    エンドポイントに接続できなかった場合のエラー
+    """
+
+
+class CalendarHTTPError(CalendarFetchError):
+    """
+    エンドポイントが200以外のステータスを返した場合のエラー
+    """
+
+
+class CalendarParseError(CalendarFetchError):
+    """
+    レスポンスをCSVとして読み込めなかった場合のエラー
+    """
+
+
+class CalendarClient:
+    """
+    カレンダーのGASのエンドポイントからCSVを取得するクライアント
+    接続をプールしたセッションを使い回し、タイムアウトと指数バックオフによる再試行を行い、
+    レスポンスを一度にメモリへ読み込まずにストリームのままCSVとして読み込む
+    """
+
+    def __init__(self, connect_timeout: float = CALENDAR_CONNECT_TIMEOUT, read_timeout: float = CALENDAR_READ_TIMEOUT,
+                 max_retries: int = CALENDAR_MAX_RETRIES, backoff_factor: float = CALENDAR_BACKOFF_FACTOR,
+                 backoff_max: float = CALENDAR_BACKOFF_MAX, pool_size: int = CALENDAR_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'text/csv', 'Accept-Encoding': 'gzip, deflate'})
+
+    def get_backoff(self, attempt: int) -> float:
+        """
+        attempt回目の再試行までの待ち時間（秒）を返す（backoff_maxで打ち切る）
+        """
+        return min(self.backoff_max, self.backoff_factor * (2 ** attempt))
+
+    def fetch_csv(self, url: str, params: dict = None, **read_csv_options) -> pd.DataFrame:
+        """
+        エンドポイントからCSVを取得してデータフレームを作成する
+        タイムアウト・接続エラー・再試行するステータスの場合は、max_retries回まで待ってから再試行する
+        :param url: エンドポイントのURL
+        :param params: クエリパラメータ
+        :param read_csv_options: pd.read_csvに渡す引数
+        :return: データフレーム
+        """
+        return self._retry(self._fetch_csv_once, url, params, read_csv_options)
+
+    def download(self, url: str, destination: Path, params: dict = None, etag: str = None,
+                 last_modified: str = None) -> Optional[dict]:
+        """
+        エンドポイントのレスポンスをファイルに書き出す（条件付きリクエストに対応する）
+        :param url: エンドポイントのURL
+        :param destination: 書き出し先のパス
+        :param params: クエリパラメータ
+        :param etag: 前回のレスポンスのETag（If-None-Matchとして送る）
+        :param last_modified: 前回のレスポンスのLast-Modified（If-Modified-Sinceとして送る）
+        :return: レスポンスのETagとLast-Modified（304で変更がない場合はNone）
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return self._retry(self._download_once, url, params, headers, Path(destination))
+
+    def _retry(self, func, url: str, *args):
+        attempt = 0
+        while True:
+            try:
+                return func(url, *args)
+            except (CalendarTimeoutError, CalendarConnectionError, CalendarHTTPError) as e:
+                retryable = not isinstance(e, CalendarHTTPError) or e.status_code in RETRY_STATUS_CODES
+                if not retryable or attempt >= self.max_retries:
+                    raise
+            time.sleep(self.get_backoff(attempt))
+            attempt += 1
+
+    @contextmanager
+    def _get(self, url: str, params: dict, headers: dict = None, expected_status=(200,)):
+        try:
+            with self.session.get(url, params=params, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code not in expected_status:
+                    raise CalendarHTTPError(f"データの取得に失敗しました: HTTP {response.status_code}",
+                                            url=url, status_code=response.status_code)
+                # gzipで圧縮されたレスポンスは読み込みながら展開する
+                response.raw.decode_content = True
+                yield response
+        # ストリームから読み込んでいる途中のエラーはurllib3の例外のまま送出される
+        except (requests.exceptions.Timeout, urllib3.exceptions.ReadTimeoutError) as e:
+            raise CalendarTimeoutError(f"データの取得がタイムアウトしました: {e}", url=url) from e
+        except (requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError) as e:
+            raise CalendarConnectionError(f"データの取得先に接続できませんでした: {e}", url=url) from e
+
+    def _fetch_csv_once(self, url: str, params: dict, read_csv_options: dict) -> pd.DataFrame:
+        with self._get(url, params) as response:
+            try:
+                return pd.read_csv(response.raw, **read_csv_options)
+            except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+                raise CalendarParseError(f"データをCSVとして読み込めませんでした: {e}", url=url) from e
+
+    def _download_once(self, url: str, params: dict, headers: dict, destination: Path) -> Optional[dict]:
+        with self._get(url, params, headers, expected_status=(200, 304)) as response:
+            if response.status_code == 304:
+                return None
+            with open(destination, 'wb') as f:
+                shutil.copyfileobj(response.raw, f)
+            return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+    def close(self) -> None:
+        self.session.close()
+
+
+@lru_cache(maxsize=None)
+def get_calendar_client() -> CalendarClient:
+    """
+    プロセス内で共有するカレンダーのクライアントを返す（接続を使い回すため）
+    """
+    return CalendarClient()
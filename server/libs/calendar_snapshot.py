@@ -0,0 +1,340 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+from .calendar_client import CalendarFetchError
+from .constant import (CALENDAR_CACHE_TTL_SECONDS, CALENDAR_SNAPSHOT_DIR,
+                       CALENDAR_SNAPSHOT_FORMAT, CALENDAR_SNAPSHOT_REFRESH_SECONDS, CALENDAR_SNAPSHOT_MAX_AGE_SECONDS,
+                       CALENDAR_SNAPSHOT_RETENTION_SECONDS, CALENDAR_SNAPSHOT_VERSION)
+from .format_dataframe import format_calendar_dataframe
+from .get_dataframe import load_calendar_dataframe, build_calendar_params
+from .result_cache import hash_dataframe
+from .service_rules import load_service_rules
+
+
+def write_columns(df: pd.DataFrame, path: Path) -> None:
+    """
+    データフレームをカラムごとのコード（1つの2次元のnpyファイル）とユニークな値（pickle）に分けてディレクトリに書き出す
+    """
+    path.mkdir(parents=True)
+    codes = np.empty((len(df.columns), len(df)), dtype=np.int32)
+    uniques = []
+    for position, column in enumerate(df.columns):
+        codes[position], column_uniques = pd.factorize(df[column], use_na_sentinel=False)
+        uniques.append(column_uniques)
+    np.save(path / 'codes.npy', codes)
+    with open(path / 'uniques.pkl', 'wb') as f:
+        pickle.dump({'columns': list(df.columns), 'uniques': uniques, 'index': df.index}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_columns(path: Path) -> pd.DataFrame:
+    """
+    write_columnsで書き出したディレクトリを読み込む
+    （カラムごとにユニークな値をコードで展開するため、データフレーム全体をメモリに読み込む）
+    """
+    codes = np.load(path / 'codes.npy')
+    with open(path / 'uniques.pkl', 'rb') as f:
+        encoded = pickle.load(f)
+    return pd.DataFrame({column: uniques.take(codes[position]) for position, (column, uniques)
+                         in enumerate(zip(encoded['columns'], encoded['uniques']))}, index=encoded['index'])
+
+
+def write_feather(df: pd.DataFrame, path: Path) -> None:
+    """
+    データフレームを非圧縮のFeather（Arrow IPC）で書き出す（メモリマップで読めるように圧縮しない）
+    """
+    from pyarrow import feather
+    feather.write_feather(df, path, compression='uncompressed')
+
+
+def read_feather(path: Path) -> pd.DataFrame:
+    """
+    Featherをメモリマップで開いて読み込む（数値・日付のカラムはファイルから直接変換し、
+    文字列のカラムはPythonの文字列に変換するためメモリに載る）
+    """
+    from pyarrow import feather
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+
+SNAPSHOT_FORMATS = {
+    'feather': (write_feather, read_feather),
+    'npy': (write_columns, read_columns),
+}
+
+
+def remove_path(path: Path) -> None:
+    """
+    ファイルまたはディレクトリを削除する（開いているなどで削除できない場合はそのまま残す）
+    """
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+
+class CalendarSnapshotStore:
+    """
+    整形済みのカレンダーを、エンドポイントのURL・取得範囲・ルール表ごとにディスクへ保存するストア
+    - 照合時は保存した整形済みのカレンダーを開き（Featherの場合はメモリマップで開く）、カレンダーのCSVの読み込みと整形を省く
+    - refresh_interval秒より古ければ、保存したものを返してバックグラウンドで更新する
+    - max_age_seconds秒より古ければ、照合の前に取得・整形し直す
+    - start_refresherを呼ぶと、refresh_interval秒ごとに使ったことのあるスナップショットをバックグラウンドで更新する
+    スナップショットは内容ごとに別のファイルに書き出してからメタデータを置き換えるため、開いているファイルを上書きしない
+    返すデータフレームのattrs['fingerprint']に内容のハッシュを、attrs['calendar_snapshot']に取得日時・経過秒数を記録する
+    """
+
+    def __init__(self, directory: Path = CALENDAR_SNAPSHOT_DIR, snapshot_format: str = CALENDAR_SNAPSHOT_FORMAT,
+                 refresh_interval: float = CALENDAR_SNAPSHOT_REFRESH_SECONDS,
+                 max_age_seconds: float = CALENDAR_SNAPSHOT_MAX_AGE_SECONDS,
+                 retention_seconds: float = CALENDAR_SNAPSHOT_RETENTION_SECONDS):
+        self.directory = Path(directory)
+        self.snapshot_format = snapshot_format
+        self.refresh_interval = refresh_interval
+        self.max_age_seconds = max_age_seconds
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._refreshing = {}
+        # 開いたスナップショット（同じプロセスで続けて照合する場合に開き直さない）
+        self._opened = {}
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def get_key(self, url: str, date_range: Optional[tuple], rules) -> str:
+        """
+        URL・取得範囲・ルール表からスナップショットのキーを作成する
+        """
+        source = json.dumps([CALENDAR_SNAPSHOT_VERSION, self.snapshot_format, url,
+                             sorted(build_calendar_params(date_range).items()), rules.fingerprint], ensure_ascii=False)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def get_metadata_path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get_data_path(self, metadata: dict) -> Path:
+        return self.directory / metadata['file']
+
+    def read_metadata(self, key: str) -> Optional[dict]:
+        try:
+            with open(self.get_metadata_path(key), encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return metadata if 'file' in metadata and self.get_data_path(metadata).exists() else None
+
+    def write_metadata(self, key: str, metadata: dict) -> None:
+        metadata_path = self.get_metadata_path(key)
+        # 書き込み途中のファイルを読まないように、一時ファイルに書き出してから置き換える
+        temporary_path = metadata_path.with_name(f"{metadata_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False)
+            os.replace(temporary_path, metadata_path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+
+    def load(self, url: str, date_range: Optional[tuple], rules=None) -> pd.DataFrame:
+        """
+        整形済みのカレンダーを返す（ない場合・古すぎる場合・読み込めない場合は取得・整形して保存する）
+        :param url: エンドポイントのURL
+        :param date_range: (範囲の開始日, 範囲の終了日)
+        :param rules: ルール表（デフォルトは現在のルール表）
+        :return: 整形済みのカレンダーのデータフレーム（他の照合と共有するため、変更してはならない）
+        """
+        rules = rules or load_service_rules()
+        key = self.get_key(url, date_range, rules)
+        metadata = self.read_metadata(key)
+        age = time.time() - metadata['fetched_at'] if metadata else None
+
+        if metadata is None or age > self.max_age_seconds:
+            metadata = self.refresh(key, url, date_range, rules, metadata)
+        elif age > self.refresh_interval:
+            self.refresh_in_background(key, url, date_range, rules, metadata)
+
+        try:
+            calendar_df = self.open(key, metadata)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, ValueError):
+            # 壊れたスナップショットは削除して作り直す
+            self.remove(key, metadata)
+            metadata = self.refresh(key, url, date_range, rules)
+            calendar_df = self.open(key, metadata)
+
+        # 最後に使った日時としてファイルの更新日時を更新する（retention_seconds以上使っていないものは定期的な更新で削除する）
+        try:
+            os.utime(self.get_data_path(metadata))
+        except OSError:
+            pass
+        return calendar_df
+
+    def open(self, key: str, metadata: dict) -> pd.DataFrame:
+        """
+        スナップショットを開き、attrsにフィンガープリントと取得日時を記録したデータフレームを返す
+        """
+        with self._lock:
+            opened = self._opened.get(key)
+        if opened is None or opened[0] != metadata['fingerprint']:
+            _, read = SNAPSHOT_FORMATS[self.snapshot_format]
+            opened = (metadata['fingerprint'], read(self.get_data_path(metadata)))
+            with self._lock:
+                self._opened[key] = opened
+
+        # 開いたデータフレームは他の照合と共有するため、attrsはコピーに付ける
+        calendar_df = opened[1].copy(deep=False)
+        age = max(time.time() - metadata['fetched_at'], 0)
+        # 取得元のキャッシュが古いスナップショットを返した場合は、経過秒数にかかわらず古いとする
+        stale = metadata.get('stale', False) or age > CALENDAR_CACHE_TTL_SECONDS
+        calendar_df.attrs = {
+            'fingerprint': metadata['fingerprint'],
+            'calendar_snapshot': {
+                'url': metadata['url'],
+                'fetched_at': datetime.fromtimestamp(metadata['fetched_at']).isoformat(timespec='seconds'),
+                'age_seconds': age,
+                'stale': stale,
+            },
+        }
+        return calendar_df
+
+    def refresh(self, key: str, url: str, date_range: Optional[tuple], rules, metadata: dict = None) -> dict:
+        """
+        カレンダーを取得し直し、内容が変わっていれば整形して新しいファイルに保存する
+        取得日時は、カレンダーのキャッシュが返したスナップショットの取得日時とする（エンドポイントが落ちていて
+        古いスナップショットが返された場合に、今取得したものとして扱わないため）
+        :return: 更新後のメタデータ
+        """
+        calendar_df, _ = load_calendar_dataframe(url, True, date_range)
+        source_fingerprint = hash_dataframe(calendar_df)
+        source_snapshot = calendar_df.attrs.get('calendar_snapshot')
+        if source_snapshot:
+            fetched_at, stale = time.time() - source_snapshot['age_seconds'], source_snapshot['stale']
+        else:
+            fetched_at, stale = time.time(), False
+
+        if metadata is None or metadata.get('source_fingerprint') != source_fingerprint:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            calendar_df = format_calendar_dataframe(calendar_df.copy())
+            fingerprint = hash_dataframe(calendar_df)
+            data_path = self.directory / f"{key}.{fingerprint[:16]}.{self.snapshot_format}"
+            if not data_path.exists():
+                temporary_path = data_path.with_name(f"{data_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                write, _ = SNAPSHOT_FORMATS[self.snapshot_format]
+                try:
+                    write(calendar_df, temporary_path)
+                    os.replace(temporary_path, data_path)
+                finally:
+                    remove_path(temporary_path)
+            previous_path = self.get_data_path(metadata) if metadata else None
+            metadata = {'file': data_path.name, 'fingerprint': fingerprint, 'source_fingerprint': source_fingerprint}
+        else:
+            previous_path = None
+
+        metadata = dict(metadata, url=url, fetched_at=fetched_at, stale=stale,
+                        date_range=[date.isoformat() for date in date_range] if date_range else None)
+        self.write_metadata(key, metadata)
+        # 前の内容のファイルは、メタデータを置き換えてから削除する（開いている照合があれば残る）
+        if previous_path is not None and previous_path != self.get_data_path(metadata):
+            remove_path(previous_path)
+        return metadata
+
+    def refresh_in_background(self, key: str, url: str, date_range: Optional[tuple], rules,
+                              metadata: dict) -> threading.Thread:
+        """
+        バックグラウンドのスレッドでスナップショットを更新する（同じキーの更新は同時に1つまで）
+        """
+        with self._lock:
+            thread = self._refreshing.get(key)
+            if thread is not None and thread.is_alive():
+                return thread
+
+            def refresh():
+                try:
+                    self.refresh(key, url, date_range, rules, metadata)
+                except (CalendarFetchError, OSError, ValueError):
+                    # 次回の照合時・定期的な更新時に再び更新する
+                    pass
+
+            thread = threading.Thread(target=refresh, name=f"calendar-snapshot-{key[:8]}", daemon=True)
+            self._refreshing[key] = thread
+            thread.start()
+            return thread
+
+    def refresh_all(self) -> None:
+        """
+        保存したスナップショットのうち、retention_seconds以内に使ったものを現在のルール表で更新し、それ以外は削除する
+        """
+        rules = load_service_rules()
+        for metadata_path in self.directory.glob('*.json'):
+            key = metadata_path.stem
+            metadata = self.read_metadata(key)
+            try:
+                unused_seconds = time.time() - self.get_data_path(metadata).stat().st_mtime if metadata else None
+            except OSError:
+                unused_seconds = None
+            if unused_seconds is None or unused_seconds > self.retention_seconds:
+                self.remove(key, metadata)
+                continue
+            try:
+                date_range = tuple(pd.Timestamp(date) for date in metadata['date_range']) \
+                    if metadata['date_range'] else None
+                new_key = self.get_key(metadata['url'], date_range, rules)
+                if new_key == key:
+                    self.refresh(key, metadata['url'], date_range, rules, metadata)
+                else:
+                    # ルール表が変わった場合は、新しいルール表で整形したスナップショットに置き換える
+                    self.refresh(new_key, metadata['url'], date_range, rules)
+                    self.remove(key, metadata)
+            except (CalendarFetchError, OSError, ValueError, KeyError):
+                # 次回の定期的な更新で再び更新する
+                continue
+
+    def remove(self, key: str, metadata: dict = None) -> None:
+        """
+        スナップショットを削除する
+        """
+        self.get_metadata_path(key).unlink(missing_ok=True)
+        if metadata:
+            remove_path(self.get_data_path(metadata))
+        with self._lock:
+            self._opened.pop(key, None)
+
+    def start_refresher(self) -> threading.Thread:
+        """
+        refresh_interval秒ごとにrefresh_allを実行するバックグラウンドのスレッドを開始する（開始済みであればそのまま返す）
+        """
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return self._refresher
+            self._stop.clear()
+
+            def run():
+                while not self._stop.wait(self.refresh_interval):
+                    self.refresh_all()
+
+            self._refresher = threading.Thread(target=run, name='calendar-snapshot-refresher', daemon=True)
+            self._refresher.start()
+            return self._refresher
+
+    def stop_refresher(self) -> None:
+        """
+        定期的な更新を止める（実行中の更新は最後まで続ける）
+        """
+        self._stop.set()
+
+
+@lru_cache(maxsize=None)
+def get_calendar_snapshot_store() -> CalendarSnapshotStore:
+    """
+    プロセス内で共有するカレンダーのスナップショットのストアを返す（バックグラウンドの更新を重複させないため）
+    """
+    return CalendarSnapshotStore()
@@ -1,45 +1,139 @@
 from dotenv import load_dotenv
 from os.path import dirname, join
+import importlib.util
 import os
 
 load_dotenv(verbose=True)
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
+# 設定した場合、receipt_checkのステージごとの計測結果をこのパスにJSONで書き出す
+RECEIPT_CHECK_REPORT_PATH = os.getenv('RECEIPT_CHECK_REPORT_PATH')
+# 計測結果にtracemallocのピークメモリを含めるか（処理が遅くなるため、既定では含めない）
+RECEIPT_CHECK_TRACE_MEMORY = os.getenv('RECEIPT_CHECK_TRACE_MEMORY') == '1'
+# 照合（整形・マージ・検証）を並列に実行するプロセス数（1の場合は並列にしない）
+RECEIPT_CHECK_WORKERS = int(os.getenv('RECEIPT_CHECK_WORKERS', 1))
+# 並列に実行する最小の行数（これより小さいデータはプロセスへの受け渡しの方が遅いため並列にしない）
+RECEIPT_CHECK_PARALLEL_MIN_ROWS = 50_000
 CALENDER_GAS_API_URL="https://script.google.com/macros/s/AKfycbygVKDMEhnbeu4UKDB7TgAFaRQpegkJ8lh1vYFfkH0vR0dpFb2ewc_Qyh4Wz2ap3tlHGg/exec"
+# カレンダーのAPIの接続・読み込みのタイムアウト（秒）
+CALENDAR_CONNECT_TIMEOUT = 5
+CALENDAR_READ_TIMEOUT = 60
+# カレンダーのAPIの再試行回数と、指数バックオフの係数・上限（秒）
+CALENDAR_MAX_RETRIES = 3
+CALENDAR_BACKOFF_FACTOR = 0.5
+CALENDAR_BACKOFF_MAX = 8
+# カレンダーのAPIのセッションで保持する接続数
+CALENDAR_POOL_SIZE = 4
+# カレンダーのAPIに取得する範囲を渡すクエリパラメータ名（開始日・終了日はYYYY-MM-DD、主訪問者はカンマ区切り）
+CALENDAR_PARAM_START = 'start'
+CALENDAR_PARAM_END = 'end'
+CALENDAR_PARAM_STAFF = 'staff'
+CALENDAR_PARAM_CALENDAR_ID = 'calendarId'
+# 取得するカレンダーIDのリスト（カンマ区切り、空の場合はAPIの既定のカレンダーを1つ取得する）
+CALENDAR_IDS = [calendar_id.strip() for calendar_id in os.getenv('RECEIPT_CHECK_CALENDAR_IDS', '').split(',')
+                if calendar_id.strip()]
+# 複数のカレンダーを同時に取得する数の上限（CALENDAR_POOL_SIZE以下にする）
+CALENDAR_FETCH_WORKERS = 4
+# カレンダーのスナップショットのキャッシュ（RECEIPT_CHECK_CALENDAR_CACHE=0で無効にする）
+CALENDAR_CACHE_ENABLED = os.getenv('RECEIPT_CHECK_CALENDAR_CACHE', '1') != '0'
+CALENDAR_CACHE_DIR = os.getenv('RECEIPT_CHECK_CALENDAR_CACHE_DIR',
+                               join(os.path.expanduser('~'), '.receipt_check', 'calendar_cache'))
+# スナップショットをそのまま使う秒数
+CALENDAR_CACHE_TTL_SECONDS = float(os.getenv('RECEIPT_CHECK_CALENDAR_CACHE_TTL', 300))
+# TTLを過ぎてから、エンドポイントが遅い・落ちている場合に古いスナップショットを返してよい秒数
+CALENDAR_CACHE_STALE_SECONDS = 24 * 60 * 60
+# TTLを過ぎたスナップショットを更新する際に、古いスナップショットを返すまで待つ秒数
+CALENDAR_CACHE_REVALIDATE_WAIT_SECONDS = 3
+# 整形済みのカレンダーのスナップショット（カレンダーのキャッシュを使う場合に使う）
+CALENDAR_SNAPSHOT_DIR = os.getenv('RECEIPT_CHECK_CALENDAR_SNAPSHOT_DIR',
+                                  join(os.path.expanduser('~'), '.receipt_check', 'calendar_snapshot'))
+# スナップショットの保存形式（pyarrowがあればメモリマップで開けるFeather、なければカラムごとのコードのnpyファイルとユニークな値）
+CALENDAR_SNAPSHOT_FORMAT = 'feather' if importlib.util.find_spec('pyarrow') else 'npy'
+# バックグラウンドでスナップショットを更新する間隔（秒）
+CALENDAR_SNAPSHOT_REFRESH_SECONDS = float(os.getenv('RECEIPT_CHECK_CALENDAR_SNAPSHOT_REFRESH',
+                                                    CALENDAR_CACHE_TTL_SECONDS))
+# 照合時にスナップショットをそのまま使う秒数（これより古い場合は照合の前に作り直す）
+CALENDAR_SNAPSHOT_MAX_AGE_SECONDS = 60 * 60
+# 最後に使ってからこの秒数が経ったスナップショットは、更新せずに削除する
+CALENDAR_SNAPSHOT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+# スナップショットの内容・形式を変えた場合に上げる
+CALENDAR_SNAPSHOT_VERSION = 1
+# 照合結果のキャッシュ（RECEIPT_CHECK_RESULT_CACHE=0で無効にする）
+RESULT_CACHE_ENABLED = os.getenv('RECEIPT_CHECK_RESULT_CACHE', '1') != '0'
+RESULT_CACHE_DIR = os.getenv('RECEIPT_CHECK_RESULT_CACHE_DIR',
+                             join(os.path.expanduser('~'), '.receipt_check', 'result_cache'))
+# 保存する照合結果の合計の上限（超えた場合は最後に使ってから最も時間が経ったものから削除する）
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# 照合結果の内容・形式を変えた場合に上げる（以前のバージョンで保存した照合結果を使わないため）
+RESULT_CACHE_VERSION = 2
+# receipt_checkのパイプラインで、メモリ上にメモするステージの出力の件数（1回の照合で最大4件）
+PIPELINE_MEMO_SIZE = 12
+# インクリメンタル照合（前回からフィンガープリントが変わったグループだけを照合する、RECEIPT_CHECK_INCREMENTAL=1で有効にする）
+RECEIPT_CHECK_INCREMENTAL = os.getenv('RECEIPT_CHECK_INCREMENTAL') == '1'
+INCREMENTAL_STORE_DIR = os.getenv('RECEIPT_CHECK_INCREMENTAL_DIR',
+                                  join(os.path.expanduser('~'), '.receipt_check', 'incremental'))
+# 保存する照合結果の内容・形式を変えた場合に上げる
+INCREMENTAL_STORE_VERSION = 1
 
 USE_IBOW_COLUMNS = ["訪問日", "利用者名", "開始時間", "終了時間", "提供時間", "サービス内容", "主訪問者", "加算①", "加算②", "加算③", "加算④", "加算⑤"]
+ADD_ON_COLUMNS = ["加算①", "加算②", "加算③", "加算④", "加算⑤"]
+# IbowのCSVの読み込み時の型（繰り返しの多い文字列はカテゴリ型、提供時間は読み込み後にInt16に縮める）
+IBOW_DTYPES = {"訪問日": "category", "利用者名": "category", "開始時間": "category", "終了時間": "category",
+               "提供時間": "float64", "サービス内容": "category", "主訪問者": "category",
+               **{column: "category" for column in ADD_ON_COLUMNS}}
+# IbowのCSVの文字コードを判定するために先頭から読み込むバイト数
+IBOW_ENCODING_SAMPLE_BYTES = 1 << 16
+# UTF-8として読めない場合に試す文字コード（電子カルテの出力に多いShift_JIS）
+IBOW_FALLBACK_ENCODING = 'cp932'
+# IbowのCSVをどの文字コードでも読めなかった場合のメッセージ
+IBOW_ENCODING_ERROR_MESSAGE = ("Ibowのファイルの文字コードが誤っています。"
+                               "UTF-8またはShift_JIS（cp932）形式のファイルを選択してください。")
+# 月ごとに照合する場合に、IbowのCSVを1度に読み込む行数
+IBOW_CHUNK_SIZE = 100_000
+# IbowのCSVを読み込むエンジン（pyarrowがインストールされていれば複数スレッドで読み込む）
+IBOW_CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
 COLUMNS_TO_DATETIME = ['開始時間', '終了時間']
 COLUMNS_TO_REPLACES = ['主訪問者', '利用者名', 'サービス内容']
-SERVICE_CODE_VALID_TIME_RANGES = {
-    '訪看I２': (20, 29),
-    '予防看I２': (20, 29),
-    '予訪看I２': (20, 29),
-    '予防訪看I２': (20, 29),
-    '訪看I３': (30, 59),
-    '予防看I３': (30, 59),
-    '予訪看I３': (30, 59),
-    '予防訪看I３': (30, 59),
-    '訪看I４': (60, 89),
-    '予防看I４': (60, 89),
-    '予訪看I４': (60, 89),
-    '予防訪看I４': (60, 89),
-    '訪看I５': (21, 40),
-    '予防看I５': (21, 40),
-    '予訪看I５':(21, 40),
-    '予防訪看I５': (21, 40),
-    '訪看I５・２超': (41, 60),
-    '訪看I５２超': (41, 60),
-    '予防看I５・２超': (41, 60),
-    '予訪看I５・２超': (41, 60),
-    '予防訪看I５２超': (41, 60),
-    '基本療養費': (30, 90),
-    '医': (30, 90),
-    '難病等複数回訪問加算(２回)': (30, 90)
-}
+# 正規化済みの文字列をキャッシュする件数
+NORMALIZE_CACHE_SIZE = 4096
+# サービスコードのルール表（有効範囲・同一とみなす組み合わせ・終了時間の補正）
+SERVICE_RULES_PATH = join(dirname(__file__), 'service_rules.json')
 
 MERGE_KEY_COLUMNS = ['訪問日', '利用者名', '主訪問者']
-
-MATCH_COLUMNS = ['開始時間', '提供時間', 'サービス内容']
+# マージ前に共通の辞書でエンコードするキーカラム
+ENCODE_KEY_COLUMNS = ['利用者名', '主訪問者']
+# 開始時間で訪問を対応付ける場合に、同じ訪問とみなす開始時間の差の上限（分）
+VISIT_MATCH_TOLERANCE_MINUTES = 60
 
 CHECK_COLUMNS = ['開始時間', '終了時間', '提供時間', 'サービス内容', "加算"]
 
+# 照合結果の区分（値は出力順）と境界行のラベル
+SECTION_MISMATCHED = 0
+SECTION_CALENDAR_ONLY = 1
+SECTION_IBOW_ONLY = 2
+SECTION_MATCHED = 3
+SECTION_LABELS = ['不整合データ', 'カレンダーのみ', 'Ibowのみ', '整合データ']
+# 照合結果の画面に1ページで表示する行数（Treeviewに挿入するのは表示中のページの行だけ）
+RESULT_PAGE_SIZE = 500
+
+# 検証結果のビット（満たさなかったルールごとに1ビット）
+CHECK_START_TIME_MISMATCH = 1 << 0  # 開始時間がカレンダーとIbowで異なる
+CHECK_SERVICE_TIME_MISMATCH = 1 << 1  # 提供時間がカレンダーとIbowで異なる
+CHECK_SERVICE_CODE_MISMATCH = 1 << 2  # サービス内容がカレンダーとIbowで異なる
+CHECK_END_TIME_MISMATCH = 1 << 3  # 終了時間がカレンダーとIbowで異なる
+CHECK_CALENDAR_END_TIME_RANGE = 1 << 4  # カレンダーの開始〜終了時間がサービスの有効範囲外
+CHECK_IBOW_END_TIME_RANGE = 1 << 5  # Ibowの開始〜終了時間がサービスの有効範囲外
+CHECK_CALENDAR_SERVICE_TIME_RANGE = 1 << 6  # カレンダーの提供時間がサービスの有効範囲外
+CHECK_IBOW_SERVICE_TIME_RANGE = 1 << 7  # Ibowの提供時間がサービスの有効範囲外
+CHECK_ADD_ON = 1 << 8  # 加算がルール表で有効な組み合わせ以外
+
+# いずれかを満たさない場合に不整合データとするビット
+CHECK_MISMATCH_MASK = (CHECK_START_TIME_MISMATCH | CHECK_SERVICE_CODE_MISMATCH |
+                       CHECK_CALENDAR_END_TIME_RANGE | CHECK_IBOW_END_TIME_RANGE |
+                       CHECK_CALENDAR_SERVICE_TIME_RANGE | CHECK_IBOW_SERVICE_TIME_RANGE | CHECK_ADD_ON)
+
+# 照合結果として出力するカラム
+RESULT_COLUMNS = ["訪問日", "利用者名", "主訪問者", "サービス内容_カレンダー",
+                  "開始時間_カレンダー", "終了時間_カレンダー", "提供時間_カレンダー",
+                  "サービス内容_Ibow", "開始時間_Ibow", "終了時間_Ibow", "提供時間_Ibow", "加算"]
+
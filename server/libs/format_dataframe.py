@@ -1,70 +1,108 @@
+import numpy as np
 import pandas as pd
-import re
-from datetime import timedelta
-from .constant import  COLUMNS_TO_DATETIME, COLUMNS_TO_REPLACES
+from functools import lru_cache
+from .constant import  COLUMNS_TO_DATETIME, COLUMNS_TO_REPLACES, NORMALIZE_CACHE_SIZE
+from .service_rules import load_service_rules
+
+MINUTES_PER_DAY = 24 * 60
+
+# 0時からの経過分数 -> "HH:MM" の変換表
+TIME_LABELS = np.array([f"{minutes // 60:02d}:{minutes % 60:02d}" for minutes in range(MINUTES_PER_DAY)], dtype=object)
+
+# 全角スペースを半角スペースに変換
+_SPACE_TABLE = {'　': ' '}
+
+# カラムごとの変換表
+NORMALIZE_TABLES = {
+    '主訪問者': str.maketrans(_SPACE_TABLE),
+    # 利用者名の空白は全角・半角ともに削除
+    '利用者名': str.maketrans({'　': None, ' ': None}),
+    # サービス内容はI（Ⅰ・１・1）と中黒の表記を揃え、半角数字を全角数字に変換
+    'サービス内容': str.maketrans({
+        **_SPACE_TABLE,
+        **{char: chr(ord(char) + 0xFEE0) for char in '0123456789'},
+        # 1は全角数字ではなくIに変換する
+        'Ⅰ': 'I', '１': 'I', '1': 'I',
+        '･': '・',
+    }),
+}
 
 
-def replace_service_content(service) -> str:
+def start_end_dateformat(df: pd.DataFrame, columns: list = COLUMNS_TO_DATETIME) -> None:
     """
-    サービス内容の置き換え
-    :param service: サービス内容
-    :return: 変換後のサービス内容
+    開始時間と終了時間を0時からの経過分数（Int16）に変換する
+    :param df: DataFrame
+    :param columns: 変換するカラム名のリスト(デフォルトはCOLUMNS_TO_DATETIME)
+    :return: None
     """
+    for column in columns:
+        times = pd.to_datetime(df[column], format='%H:%M')
+        df[column] = (times.dt.hour * 60 + times.dt.minute).astype('Int16')
 
-    # 半角数字を全角数字に変換
-    def _to_fullwidth_numbers(text):
-        if isinstance(text, str):
-            return ''.join(chr(ord(char) + 0xFEE0) if '0' <= char <= '9' else char for char in text)
-        return text
 
-    if isinstance(service, str):
-        service = re.sub(r'[Ⅰ１1]', 'I', service)  # 1をIに変換
-        service = re.sub(r'･', '・', service)  # 半角ドットを全角ドットに変換
-        service = _to_fullwidth_numbers(service)
-    return service
+def minutes_to_time(minutes: pd.Series) -> pd.Series:
+    """
+    0時からの経過分数の列を"HH:MM"形式の文字列に変換する（欠損値はNaNのまま）
+    :param minutes: 経過分数の列
+    :return: "HH:MM"形式の文字列の列
+    """
+    values = minutes.to_numpy(dtype='float64', na_value=np.nan)
+    exists = ~np.isnan(values)
+    labels = np.full(len(values), np.nan, dtype=object)
+    labels[exists] = TIME_LABELS[values[exists].astype(np.intp) % MINUTES_PER_DAY]
+    return pd.Series(labels, index=minutes.index)
 
 
-def start_end_dateformat(df: pd.DataFrame, columns: list = COLUMNS_TO_DATETIME) -> None:
+def render_dataframe(df: pd.DataFrame) -> None:
     """
-    開始時間と終了時間のフォーマットを統一
+    内部表現（経過分数・datetime64の訪問日・カテゴリ型）の列を表示用の値に変換する
     :param df: DataFrame
-    :param columns: フォーマットを統一するカラム名のリスト(デフォルトはCOLUMNS_TO_DATETIME)
     :return: None
     """
-    for column in columns:
-        df[column] = pd.to_datetime(df[column], format='%H:%M').dt.strftime('%H:%M')
+    for column in df.columns:
+        if column.startswith(tuple(COLUMNS_TO_DATETIME)) and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = minutes_to_time(df[column])
+        elif column.startswith('提供時間') and pd.api.types.is_integer_dtype(df[column]):
+            # Int16に縮めた提供時間も、カレンダー側（float）と同じ表示（例: 25.0）にする
+            df[column] = df[column].astype('float64')
+        elif column == '訪問日' and pd.api.types.is_datetime64_dtype(df[column]):
+            df[column] = df[column].dt.date
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_text(text: str, column: str) -> str:
+    """
+    カラムに対応する変換表で文字列を正規化する（結果はプロセス内でキャッシュする）
+    :param text: 変換する文字列
+    :param column: カラム名
+    :return: 変換後の文字列
+    """
+    return text.translate(NORMALIZE_TABLES[column])
 
 
-def replace_columns_spaces(df: pd.DataFrame, columns: list = COLUMNS_TO_REPLACES) -> None:
+def normalize_text_columns(df: pd.DataFrame, columns: list = COLUMNS_TO_REPLACES) -> None:
     """
-    指定した列の全角スペースを半角スペースに変換する
+    指定した列の表記ゆれ（空白・サービスコードの文字種）を正規化する
+    行ごとではなく、列のユニークな値ごとに一度だけ変換して元の行に対応付ける
     :param df: DataFrame
     :param columns: 変換する列名のリスト（デフォルトはCOLUMNS_TO_REPLACES）
     :return: None
     """
-
-    def convert_fullwidth_to_halfwidth(text):
-        if isinstance(text, str):
-            return text.replace('　', ' ')
-        return text
-
     for column in columns:
-        df[column] = df[column].apply(convert_fullwidth_to_halfwidth)
+        codes, uniques = pd.factorize(df[column])
+        # factorizeは欠損値を-1とするため、末尾にNaNを追加しておく
+        normalized = np.array([normalize_text(value, column) if isinstance(value, str) else value for value in uniques]
+                              + [np.nan], dtype=object)
+        df[column] = normalized[codes]
 
 
 def convert_to_date(df: pd.DataFrame, column_name: str = "訪問日") -> None:
     """
-    指定したカラムを日付型に変換する
+    指定したカラムを日付（時刻を切り捨てたdatetime64）に変換する
     """
-    df[column_name] = pd.to_datetime(df[column_name]).dt.tz_localize('Asia/Tokyo', ambiguous='infer').dt.tz_localize(
-        None).dt.date
-
-
-def remove_whitespace(df: pd.DataFrame, column_name: str = "利用者名") -> None:
-    """
-    指定したカラムのすべての空白を削除する
-    """
-    df[column_name] = df[column_name].str.replace(' ', '')
+    df[column_name] = pd.to_datetime(df[column_name]).dt.normalize()
 
 
 def format_dataframe(df: pd.DataFrame) -> pd.DataFrame:
@@ -73,51 +111,45 @@ def format_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     :param df: DataFrame
     :return: 整形後のDataFrame
     """
-    # 日付フォーマットの統一
+    # 開始時間・終了時間を経過分数に変換
     start_end_dateformat(df)
 
-    # 全角スペースを半角スペースに変換
-    replace_columns_spaces(df)
-
-    # サービス内容の置き換え
-    df["サービス内容"] = df["サービス内容"].apply(replace_service_content)
+    # 主訪問者・利用者名・サービス内容の表記を正規化
+    normalize_text_columns(df)
 
     # 日付型に変換
     convert_to_date(df)
 
-    # 空白を削除
-    remove_whitespace(df)
-
     # データフレームをソート
     df = df.sort_values(by=['訪問日', '開始時間'])
 
     return df
 
 
-def format_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+def format_calendar_dataframe(calendar_df: pd.DataFrame) -> pd.DataFrame:
     """
-    カレンダーとibowのデータフレームのフォーマットの整形
+    カレンダーのデータフレームのフォーマットの整形（ルール表で指定されたサービスの終了時間・提供時間の補正を含む）
     :param calendar_df: カレンダーのデータフレーム
-    :param ibow_df: ibowのデータフレーム
-    :return: 整形後のカレンダーのデータフレームとibowのデータフレーム
+    :return: 整形後のカレンダーのデータフレーム
     """
-    # 各データフレームをフォーマットする
     format_calendar_df = format_dataframe(calendar_df)
-    format_ibow_df = format_dataframe(ibow_df)
 
-    # 特定のサービスに対してのみ終了時間と提供時間を1分減らす
-    services_to_adjust = ['訪看I２', '予防看I２', '予訪看I２', '予防訪看I２',
-                          '訪看I３', '予防看I３', '予訪看I３', '予防訪看I３',
-                          '訪看I４', '予防看I４', '予訪看I４', '予防訪看I４']
+    # ルール表で補正が指定されたサービス（訪看I２〜I４など）の終了時間と提供時間を補正する（0:00の1分前は23:59とする）
+    rules = load_service_rules()
+    adjustments = rules.get_end_time_adjustments(rules.get_service_ids(format_calendar_df['サービス内容']))
+    adjusted = adjustments != 0
+    format_calendar_df.loc[adjusted, '終了時間'] = \
+        (format_calendar_df.loc[adjusted, '終了時間'] + adjustments[adjusted]) % MINUTES_PER_DAY
+    format_calendar_df.loc[adjusted, '提供時間'] = format_calendar_df.loc[adjusted, '提供時間'] + adjustments[adjusted]
 
-    # 該当するサービスの終了時間を1分減らす
-    format_calendar_df.loc[format_calendar_df['サービス内容'].isin(services_to_adjust), '終了時間'] = \
-        format_calendar_df.loc[format_calendar_df['サービス内容'].isin(services_to_adjust), '終了時間'].apply(
-            lambda x: (pd.to_datetime(x, format="%H:%M") - timedelta(minutes=1)).strftime("%H:%M")
-        )
+    return format_calendar_df
 
-    # 該当するサービスの提供時間（int）を1分減らす
-    format_calendar_df.loc[format_calendar_df['サービス内容'].isin(services_to_adjust), '提供時間'] = \
-        format_calendar_df.loc[format_calendar_df['サービス内容'].isin(services_to_adjust), '提供時間'] - 1
 
-    return format_calendar_df, format_ibow_df
+def format_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    カレンダーとibowのデータフレームのフォーマットの整形
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :return: 整形後のカレンダーのデータフレームとibowのデータフレーム
+    """
+    return format_calendar_dataframe(calendar_df), format_dataframe(ibow_df)
@@ -1,45 +1,332 @@
 
-import requests
+import codecs
+import numpy as np
 import pandas as pd
-import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 from tkinter import messagebox
-from .constant import CALENDER_GAS_API_URL, USE_IBOW_COLUMNS
+from .constant import (CALENDER_GAS_API_URL, CALENDAR_IDS, CALENDAR_FETCH_WORKERS, CALENDAR_CACHE_ENABLED,
+                       CALENDAR_PARAM_START, CALENDAR_PARAM_END, CALENDAR_PARAM_STAFF, CALENDAR_PARAM_CALENDAR_ID,
+                       USE_IBOW_COLUMNS, ADD_ON_COLUMNS, IBOW_DTYPES, IBOW_CSV_ENGINE,
+                       IBOW_ENCODING_SAMPLE_BYTES, IBOW_FALLBACK_ENCODING,
+                       IBOW_ENCODING_ERROR_MESSAGE)
+from .service_rules import load_service_rules
+from .format_dataframe import normalize_text
+from .instrumentation import NULL_REPORT
+from .calendar_client import get_calendar_client, CalendarFetchError
+from .calendar_cache import get_calendar_cache
 
-def create_google_calendar_to_csv(calendar_gas_api_url: str = CALENDER_GAS_API_URL) -> pd.DataFrame:
+def fetch_calendar_csv(calendar_gas_api_url: str, use_cache: bool, params: dict = None) -> pd.DataFrame:
+    """
+    カレンダーのCSVを1つ取得する（メッセージボックスを出さないため、ワーカースレッドからも呼び出せる）
+    """
+    if use_cache:
+        return get_calendar_cache().fetch_csv(calendar_gas_api_url, params=params, sep=",")
+    return get_calendar_client().fetch_csv(calendar_gas_api_url, params=params, sep=",")
+
+
+def fetch_calendars(calendar_gas_api_url: str, calendar_ids: list, use_cache: bool, params: dict = None,
+                    max_workers: int = CALENDAR_FETCH_WORKERS) -> pd.DataFrame:
+    """
+    複数のカレンダーを並行して取得し、1つのデータフレームにまとめる
+    複数のカレンダーに同じ予定がある場合は、まとめて型を揃えた行のハッシュで重複を除く
+    :param calendar_gas_api_url: GoogleカレンダーのAPIのURL
+    :param calendar_ids: カレンダーIDのリスト
+    :param use_cache: ディスクに保存したスナップショットを使うか
+    :param params: 各カレンダーに共通のクエリパラメータ
+    :param max_workers: 同時に取得するカレンダーの数の上限
+    :return: まとめたデータフレーム（attrs['calendar_snapshot']は最も古いスナップショットのもの）
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calendar_ids)))) as executor:
+        futures = [executor.submit(fetch_calendar_csv, calendar_gas_api_url, use_cache,
+                                   dict(params or {}, **{CALENDAR_PARAM_CALENDAR_ID: calendar_id}))
+                   for calendar_id in calendar_ids]
+        try:
+            calendar_dfs = [future.result() for future in futures]
+        except BaseException:
+            # 1つでも失敗した場合は、まだ始まっていない取得を取り消してからエラーを送出する
+            for future in futures:
+                future.cancel()
+            raise
+
+    # 先に取得したカレンダーにある予定と同じ行を除く（1つのカレンダー内の同じ行はそのまま残す）
+    # 行のハッシュは型によって変わるため（欠損値のある提供時間は浮動小数点数になるなど）、まとめて型を揃えてからハッシュを求める
+    calendar_df = pd.concat(calendar_dfs, ignore_index=True)
+    calendar_positions = np.repeat(np.arange(len(calendar_dfs)), [len(df) for df in calendar_dfs])
+    hashes = pd.util.hash_pandas_object(calendar_df, index=False).to_numpy()
+    # 同じ行がある最初のカレンダーの行だけを残す
+    first_positions = pd.Series(calendar_positions).groupby(hashes).transform('min').to_numpy()
+    calendar_df = calendar_df[calendar_positions == first_positions].reset_index(drop=True)
+
+    snapshots = [df.attrs['calendar_snapshot'] for df in calendar_dfs if 'calendar_snapshot' in df.attrs]
+    if snapshots:
+        calendar_df.attrs['calendar_snapshot'] = max(snapshots, key=lambda snapshot: snapshot['age_seconds'])
+    return calendar_df
+
+
+def load_calendar_csv(calendar_gas_api_url: str, use_cache: bool, params: dict = None,
+                      calendar_ids: list = CALENDAR_IDS) -> pd.DataFrame:
+    """
+    カレンダーIDの指定に応じて、1つまたは複数のカレンダーを取得する（メッセージボックスは出さない）
+    """
+    if calendar_ids:
+        return fetch_calendars(calendar_gas_api_url, calendar_ids, use_cache, params)
+    return fetch_calendar_csv(calendar_gas_api_url, use_cache, params)
+
+
+def create_google_calendar_to_csv(calendar_gas_api_url: str = CALENDER_GAS_API_URL,
+                                  use_cache: bool = CALENDAR_CACHE_ENABLED, params: dict = None,
+                                  calendar_ids: list = CALENDAR_IDS) -> pd.DataFrame:
     """
     GoogleカレンダーのCSVデータを取得し、データフレームを作成する
     :param calendar_gas_api_url: GoogleカレンダーのAPIのURL（デフォルトはCALENDER_GAS_API_URL）
-    :return: calendar_df: Googleカレンダーのデータフレーム
+    :param use_cache: ディスクに保存したスナップショットを使うか（デフォルトはCALENDAR_CACHE_ENABLED）
+    :param params: APIに渡すクエリパラメータ（取得する範囲など）
+    :param calendar_ids: 取得するカレンダーIDのリスト（デフォルトはCALENDAR_IDS、空の場合はAPIの既定のカレンダー）
+    :return: calendar_df: Googleカレンダーのデータフレーム（キャッシュを使った場合はattrs['calendar_snapshot']付き）
     """
     try:
-        response = requests.get(calendar_gas_api_url)
-        if response.status_code == 200:
-            calendar_df = pd.read_csv(io.BytesIO(response.content), sep=",")
-            return calendar_df
-        elif response.status_code == 500:
-            messagebox.showerror("エラー", "データの取得に失敗しました: 開発者にお問い合わせください。")
-            raise ValueError("データの取得に失敗しました: 開発者にお問い合わせください。")
-    except Exception:
+        return load_calendar_csv(calendar_gas_api_url, use_cache, params, calendar_ids)
+    except CalendarFetchError:
         messagebox.showerror("エラー", "データの取得に失敗しました: 開発者にお問い合わせください。")
-        raise ValueError("データの取得に失敗しました: 開発者にお問い合わせください。")
+        raise
+
+def build_add_on_columns(ibow_df: pd.DataFrame, columns: list = ADD_ON_COLUMNS) -> tuple[pd.Categorical, np.ndarray]:
+    """
+    加算①〜⑤から、加算の表示用の文字列（カンマ区切り）と加算フラグ（ルール表の加算ごとのビット）を作成する
+    行ごとではなく、加算①〜⑤の値の組み合わせごとに一度だけ文字列とフラグを求める
+    :param ibow_df: ibowのデータフレーム
+    :param columns: 加算のカラム名のリスト（デフォルトはADD_ON_COLUMNS）
+    :return: 加算（組み合わせごとのカテゴリ型）と加算フラグの配列
+    """
+    rules = load_service_rules()
 
-def get_dataframes(file_path: Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+    slot_codes, slot_values = [], []
+    for column in columns:
+        codes, uniques = pd.factorize(ibow_df[column])
+        slot_codes.append(codes)
+        slot_values.append([str(value) for value in uniques])
+
+    combinations, combination_ids = np.unique(np.column_stack(slot_codes), axis=0, return_inverse=True)
+    labels, flags = [], []
+    for combination in combinations:
+        add_ons = [slot_values[slot][code] for slot, code in enumerate(combination) if code != -1]
+        labels.append(', '.join(add_ons))
+        flags.append(rules.get_add_on_flags(add_ons))
+
+    # 異なる組み合わせが同じ文字列になる場合（空欄の位置が違うだけなど）は同じカテゴリにまとめる
+    label_codes, label_uniques = pd.factorize(pd.Series(labels, dtype=object))
+    combination_ids = combination_ids.reshape(-1)
+    add_on_labels = pd.Categorical.from_codes(label_codes[combination_ids], categories=label_uniques)
+    return add_on_labels, np.array(flags, dtype=np.int64)[combination_ids]
+
+
+def get_visit_date_range(ibow_df: pd.DataFrame) -> Optional[tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Ibowの訪問日の範囲を月単位に広げて返す（月末にIbowにない訪問があってもカレンダーのみとして残すため）
+    :param ibow_df: ibowのデータフレーム
+    :return: (範囲の開始日, 範囲の終了日)（訪問日がない場合はNone）
+    """
+    # 訪問日はユニークな値ごとに一度だけ日付に変換する
+    dates = pd.to_datetime(pd.Series(ibow_df['訪問日'].unique()), errors='coerce').dropna()
+    if dates.empty:
+        return None
+    return dates.min().to_period('M').start_time, dates.max().to_period('M').end_time.normalize()
+
+
+def build_calendar_params(date_range: Optional[tuple], staff: list = None) -> dict:
+    """
+    カレンダーのAPIに渡す取得範囲のクエリパラメータを作成する
+    :param date_range: (範囲の開始日, 範囲の終了日)
+    :param staff: 取得する主訪問者のリスト（Noneの場合は全員）
+    :return: クエリパラメータ
+    """
+    params = {}
+    if date_range is not None:
+        params[CALENDAR_PARAM_START] = date_range[0].strftime('%Y-%m-%d')
+        params[CALENDAR_PARAM_END] = date_range[1].strftime('%Y-%m-%d')
+    if staff is not None:
+        params[CALENDAR_PARAM_STAFF] = ','.join(sorted(staff))
+    return params
+
+
+def filter_calendar_dataframe(calendar_df: pd.DataFrame, date_range: Optional[tuple], staff: list = None
+                              ) -> pd.DataFrame:
+    """
+    カレンダーのAPIが取得範囲のパラメータに対応していない場合のために、取得したデータを手元でも絞り込む
+    訪問日を日付に変換できない行は、照合結果に残すため絞り込まない
+    :param calendar_df: カレンダーのデータフレーム
+    :param date_range: (範囲の開始日, 範囲の終了日)
+    :param staff: 残す主訪問者のリスト（表記ゆれは正規化して比較する、Noneの場合は全員）
+    :return: 絞り込んだデータフレーム
+    """
+    keep = np.ones(len(calendar_df), dtype=bool)
+    if date_range is not None:
+        codes, uniques = pd.factorize(calendar_df['訪問日'])
+        dates = pd.to_datetime(pd.Series(uniques), errors='coerce').dt.normalize()
+        in_range = (dates.isna() | dates.between(*date_range)).to_numpy()
+        # factorizeは欠損値を-1とするため、末尾に欠損値の結果（残す）を追加しておく
+        keep &= np.append(in_range, True)[codes]
+    if staff is not None:
+        normalized_staff = {normalize_text(name, '主訪問者') for name in staff if isinstance(name, str)}
+        codes, uniques = pd.factorize(calendar_df['主訪問者'])
+        in_staff = np.array([normalize_text(name, '主訪問者') in normalized_staff for name in uniques], dtype=bool)
+        keep &= np.append(in_staff, False)[codes]
+    if keep.all():
+        return calendar_df
+    filtered_df = calendar_df[keep].reset_index(drop=True)
+    filtered_df.attrs = calendar_df.attrs
+    return filtered_df
+
+
+def detect_csv_encoding(file_path: Path, sample_bytes: int = IBOW_ENCODING_SAMPLE_BYTES) -> str:
+    """
+    CSVファイルの先頭を読み込み、文字コード（BOM付きUTF-8・UTF-8・cp932）を判定する
+    :param file_path: CSVファイルのパス
+    :param sample_bytes: 判定に使う先頭のバイト数
+    :return: pd.read_csvに渡す文字コード
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_bytes)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    # 先頭のバイト数で区切ったため、末尾の文字が途中で切れていてもよいように逐次デコーダーで判定する
+    for encoding in ['utf-8', IBOW_FALLBACK_ENCODING]:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(IBOW_ENCODING_ERROR_MESSAGE)
+
+
+def compact_service_minutes(minutes: pd.Series) -> pd.Series:
+    """
+    提供時間がすべて整数の分数であれば、欠損値を扱えるInt16に縮める（それ以外はそのまま返す）
+    """
+    values = minutes.to_numpy(dtype='float64', na_value=np.nan)
+    values = values[~np.isnan(values)]
+    if np.all(values == np.round(values)) and np.all(np.abs(values) <= np.iinfo(np.int16).max):
+        return minutes.astype('Int16')
+    return minutes
+
+
+def read_csv_columns(file_path: Path, encoding: str, columns: list, dtypes: dict, engine: str) -> pd.DataFrame:
+    """
+    CSVファイルの指定したカラムを指定した型で読み込む（文字コードが誤っている場合はUnicodeDecodeErrorを送出する）
+    """
+    if engine != 'pyarrow':
+        return pd.read_csv(file_path, encoding=encoding, usecols=columns, dtype=dtypes, engine=engine)
+
+    import pyarrow
+    from pyarrow import csv
+    # pd.read_csvのpyarrowエンジンは型を推定してから変換するため（9:00を時刻とするなど）、pyarrowで文字列として読み込む
+    column_types = {column: pyarrow.string() if dtype == 'category' else pyarrow.from_numpy_dtype(np.dtype(dtype))
+                    for column, dtype in dtypes.items()}
+    try:
+        table = csv.read_csv(file_path, read_options=csv.ReadOptions(encoding=encoding),
+                             convert_options=csv.ConvertOptions(include_columns=columns, column_types=column_types,
+                                                                strings_can_be_null=True))
+    except pyarrow.ArrowException:
+        # 文字コードの誤りはArrowInvalid（ヘッダーの場合はカラムがないArrowKeyError）になるため、
+        # C言語のエンジンで読み直してUnicodeDecodeErrorまたは元の誤りとして判定する
+        return pd.read_csv(file_path, encoding=encoding, usecols=columns, dtype=dtypes, engine='c')
+    return table.to_pandas().astype(dtypes)
+
+
+def read_ibow_csv(file_path: Path, columns: list = USE_IBOW_COLUMNS, engine: str = IBOW_CSV_ENGINE) -> pd.DataFrame:
+    """
+    IbowのCSVファイルの指定したカラムを、IBOW_DTYPESの型で読み込む
+    文字コードは先頭から判定し（UTF-8・BOM付きUTF-8・cp932）、読み込みながら変換する
+    :param file_path: IbowのCSVファイルのパス
+    :param columns: 読み込むカラム名のリスト（デフォルトはUSE_IBOW_COLUMNS）
+    :param engine: pd.read_csvのエンジン（デフォルトはpyarrowがインストールされていればpyarrowで並列に読み込む）
+    :return: ibowのデータフレーム
+    """
+    try:
+        encoding = detect_csv_encoding(file_path)
+    except OSError:
+        raise ValueError("Ibowのファイルが誤っています。正しいファイルが選択されているか確認してください。")
+    dtypes = {column: IBOW_DTYPES[column] for column in columns if column in IBOW_DTYPES}
+
+    # 先頭はUTF-8として読めても途中から読めない場合は、cp932として読み直す
+    for candidate in dict.fromkeys([encoding, IBOW_FALLBACK_ENCODING]):
+        try:
+            ibow_df = read_csv_columns(file_path, candidate, columns, dtypes, engine)
+            break
+        except UnicodeDecodeError:
+            continue
+        except Exception:
+            raise ValueError("Ibowのファイルが誤っています。正しいファイルが選択されているか確認してください。")
+    else:
+        raise ValueError(IBOW_ENCODING_ERROR_MESSAGE)
+
+    if '提供時間' in ibow_df.columns:
+        ibow_df['提供時間'] = compact_service_minutes(ibow_df['提供時間'])
+    return ibow_df
+
+
+def load_ibow_dataframe(file_path: Path) -> pd.DataFrame:
+    """
+    IbowのCSVファイルを読み込み、加算①〜⑤を加算・加算フラグにまとめる
+    :param file_path: IbowのCSVファイルのパス
+    :return: ibowのデータフレーム
+    """
+    ibow_df = read_ibow_csv(file_path)
+    ibow_df['加算'], ibow_df['加算フラグ'] = build_add_on_columns(ibow_df)
+    return ibow_df[["訪問日", "利用者名", "開始時間", "終了時間", "提供時間", "サービス内容", "主訪問者", "加算", "加算フラグ"]]
+
+
+def load_calendar_dataframe(calendar_gas_api_url: str, use_cache: bool, date_range: Optional[tuple],
+                            staff: list = None) -> tuple[pd.DataFrame, int]:
+    """
+    取得範囲を指定してカレンダーを取得し、手元でも絞り込む（ワーカースレッドで実行できるよう、メッセージボックスは出さない）
+    :return: (calendar_df, 絞り込む前の行数)
+    """
+    calendar_df = load_calendar_csv(calendar_gas_api_url, use_cache, build_calendar_params(date_range, staff))
+    return filter_calendar_dataframe(calendar_df, date_range, staff), len(calendar_df)
+
+
+def get_dataframes(file_path: Path, calendar_gas_api_url: str = CALENDER_GAS_API_URL,
+                   use_cache: bool = CALENDAR_CACHE_ENABLED, filter_staff: bool = False, report=NULL_REPORT
+                   ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     ファイルパスからカレンダーのDataFrameとIbowのDataFrameを作成する
+    カレンダーはIbowの訪問日を含む月の範囲だけを取得する
+    Ibowの訪問日だけを先に読み込んで取得範囲を決め、カレンダーの取得をバックグラウンドで行う間にIbow全体を読み込む
     :param file_path:
+    :param calendar_gas_api_url: GoogleカレンダーのAPIのURL（デフォルトはCALENDER_GAS_API_URL）
+    :param use_cache: カレンダーのスナップショットのキャッシュを使うか（デフォルトはCALENDAR_CACHE_ENABLED）
+    :param filter_staff: カレンダーをIbowにある主訪問者だけに絞り込むか
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
     :return: calendar_df, ibow_df
     """
-    calendar_df = create_google_calendar_to_csv()
+    with report.stage('ibow_range') as stage:
+        range_df = read_ibow_csv(file_path, ['訪問日', '主訪問者'] if filter_staff else ['訪問日'])
+        date_range = get_visit_date_range(range_df)
+        staff = list(range_df['主訪問者'].dropna().unique()) if filter_staff else None
+        stage.rows_out = len(range_df)
+        range_df = None
+
+    executor = ThreadPoolExecutor(max_workers=1)
     try:
-        ibow_df = pd.read_csv(file_path, encoding='utf-8', usecols=USE_IBOW_COLUMNS)
-    except UnicodeDecodeError:
-        raise ValueError("Ibowのファイルの文字コードが誤っています。UTF-8形式のファイルを選択してください。")
-    except Exception:
-        raise ValueError("Ibowのファイルが誤っています。正しいファイルが選択されているか確認してください。")
+        calendar_future = executor.submit(load_calendar_dataframe, calendar_gas_api_url, use_cache, date_range, staff)
+
+        with report.stage('ibow_read') as stage:
+            ibow_df = load_ibow_dataframe(file_path)
+            stage.rows_out = len(ibow_df)
 
-    ibow_df['加算'] = ibow_df[["加算①", "加算②", "加算③", "加算④", "加算⑤"]].apply(
-        lambda x: ', '.join(x.dropna().astype(str)), axis=1
-    )
+        # Ibowの読み込み後に、カレンダーの取得を待った時間を計測する
+        with report.stage('calendar_fetch') as stage:
+            try:
+                calendar_df, stage.rows_in = calendar_future.result()
+            except CalendarFetchError:
+                messagebox.showerror("エラー", "データの取得に失敗しました: 開発者にお問い合わせください。")
+                raise
+            stage.rows_out = len(calendar_df)
+    finally:
+        # Ibowの読み込みに失敗した場合は、カレンダーの取得の完了を待たずに戻る
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    return calendar_df, ibow_df[["訪問日", "利用者名", "開始時間", "終了時間", "提供時間", "サービス内容", "主訪問者", "加算"]]
\ No newline at end of file
+    return calendar_df, ibow_df
\ No newline at end of file
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+from .constant import (MERGE_KEY_COLUMNS, RESULT_COLUMNS, VISIT_MATCH_TOLERANCE_MINUTES, INCREMENTAL_STORE_DIR,
+                       INCREMENTAL_STORE_VERSION)
+from .validate_dataframe import merge_and_validate, render_results, insert_boundaries
+from .result_cache import encode_dataframe, decode_dataframe
+from .service_rules import load_service_rules
+from .instrumentation import NULL_REPORT
+
+# グループ内の行の位置を行のハッシュに混ぜる係数（同じ行の並べ替えも変更として扱うため）
+_POSITION_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def hash_group_keys(df: pd.DataFrame) -> np.ndarray:
+    """
+    各行の結合キー（訪問日・利用者名・主訪問者）のハッシュを返す（カテゴリ型でも値が同じなら同じハッシュ）
+    """
+    return pd.util.hash_pandas_object(df[MERGE_KEY_COLUMNS], index=False).to_numpy()
+
+
+def get_group_fingerprints(df: pd.DataFrame, group_keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    整形後のデータフレームを結合キーのグループごとに、行の値と並び順から作ったフィンガープリントにまとめる
+    :param df: 整形後のデータフレーム
+    :param group_keys: 各行の結合キーのハッシュ
+    :return: (グループの結合キーのハッシュ, グループのフィンガープリント)
+    """
+    rows = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    positions = pd.Series(group_keys).groupby(group_keys, sort=False).cumcount().to_numpy(dtype=np.uint64)
+    mixed = pd.util.hash_array(rows ^ (positions * _POSITION_MULTIPLIER))
+    keys, inverse = np.unique(group_keys, return_inverse=True)
+    fingerprints = np.zeros(len(keys), dtype=np.uint64)
+    # uint64の加算は桁あふれしても折り返すため、グループ内の行の順序によらない和になる（順序はpositionsで区別する）
+    np.add.at(fingerprints, inverse, mixed)
+    return keys, fingerprints
+
+
+def combine_fingerprints(calendar_keys: np.ndarray, calendar_fingerprints: np.ndarray, ibow_keys: np.ndarray,
+                         ibow_fingerprints: np.ndarray) -> pd.Series:
+    """
+    カレンダーとIbowのグループのフィンガープリントを、結合キーのハッシュごとに1つにまとめる
+    :return: 結合キーのハッシュをインデックスとしたフィンガープリントのSeries
+    """
+    keys = pd.Index(calendar_keys).union(pd.Index(ibow_keys))
+    calendar = pd.Series(calendar_fingerprints, index=calendar_keys).reindex(keys, fill_value=np.uint64(0))
+    # Ibow側はハッシュし直してから混ぜ、同じ行がカレンダーとIbowのどちらにあるかを区別する
+    ibow = pd.Series(pd.util.hash_array(ibow_fingerprints), index=ibow_keys).reindex(keys, fill_value=np.uint64(0))
+    return pd.Series(calendar.to_numpy(dtype=np.uint64) ^ ibow.to_numpy(dtype=np.uint64), index=keys)
+
+
+def find_unchanged_groups(fingerprints: pd.Series, previous_fingerprints: pd.Series) -> np.ndarray:
+    """
+    前回とフィンガープリントが同じグループを返す
+    :return: fingerprintsの各グループが変わっていないかを示すboolの配列
+    """
+    positions = previous_fingerprints.index.get_indexer(fingerprints.index)
+    previous_values = previous_fingerprints.to_numpy(dtype=np.uint64)[np.maximum(positions, 0)] \
+        if len(previous_fingerprints) else np.zeros(len(fingerprints), dtype=np.uint64)
+    return (positions >= 0) & (previous_values == fingerprints.to_numpy(dtype=np.uint64))
+
+
+def get_group_order(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame) -> pd.Series:
+    """
+    外部結合の結果と同じ順序（結合キーの昇順、欠損値は先頭）でのグループの順位を返す
+    :return: 結合キーのハッシュをインデックスとした順位のSeries
+    """
+    keys = pd.concat([calendar_df[MERGE_KEY_COLUMNS], ibow_df[MERGE_KEY_COLUMNS]], ignore_index=True)
+    keys = keys.assign(_group=hash_group_keys(keys)).drop_duplicates('_group')
+    keys = keys.sort_values(MERGE_KEY_COLUMNS, na_position='first', kind='stable')
+    return pd.Series(np.arange(len(keys)), index=keys['_group'].to_numpy())
+
+
+class IncrementalStore:
+    """
+    前回の照合結果を結合キーのグループごとにディスクへ保存するストア
+    保存するのは表示用の照合結果（境界行なし）の各行と、その区分・グループ、グループごとのフィンガープリント
+    照合の設定（ルール表・match_by_timeなど）ごとに直近1回分を保存する
+    """
+
+    def __init__(self, directory: Path = INCREMENTAL_STORE_DIR):
+        self.directory = Path(directory)
+
+    def get_key(self, match_by_time: bool) -> str:
+        """
+        照合の設定からストアのキーを作成する
+        """
+        source = json.dumps({
+            'version': INCREMENTAL_STORE_VERSION,
+            'rules': load_service_rules().fingerprint,
+            'match_by_time': match_by_time,
+            'tolerance': VISIT_MATCH_TOLERANCE_MINUTES,
+            'columns': RESULT_COLUMNS,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def get_path(self, key: str) -> Path:
+        return self.directory / f"{key}.pkl"
+
+    def load(self, key: str) -> Optional[dict]:
+        """
+        前回の照合結果を返す（ない場合・読み込めない場合はNone）
+        :return: {'display': 表示用の照合結果, 'sections': 区分, 'groups': 各行のグループ,
+                  'fingerprints': グループごとのフィンガープリントのSeries}
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            state['display'] = decode_dataframe(state['display'])
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, ValueError):
+            path.unlink(missing_ok=True)
+            return None
+        return state
+
+    def save(self, key: str, state: dict) -> None:
+        """
+        今回の照合結果を保存する（前回の照合結果は置き換える）
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        # 書き込み途中のファイルを読まないように、一時ファイルに書き出してから置き換える
+        temporary_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temporary_path, 'wb') as f:
+                pickle.dump(dict(state, display=encode_dataframe(state['display'])), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+
+
+@lru_cache(maxsize=None)
+def get_incremental_store() -> IncrementalStore:
+    """
+    プロセス内で共有するインクリメンタル照合のストアを返す
+    """
+    return IncrementalStore()
+
+
+def check_dataframes_incremental(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False,
+                                 store: IncrementalStore = None, report=NULL_REPORT) -> pd.DataFrame:
+    """
+    整形後のカレンダーとIbowを、前回からフィンガープリントが変わった結合キーのグループだけマージ・照合する
+    結合キーは訪問日・利用者名・主訪問者のため、照合結果の各行は1つのグループだけから作られる
+    変わっていないグループは前回の照合結果の行をそのまま使い、外部結合と同じグループの順に並べ直す
+    :param calendar_df: 整形後のカレンダーのデータフレーム
+    :param ibow_df: 整形後のibowのデータフレーム
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param store: 前回の照合結果のストア（デフォルトはプロセス内で共有するストア）
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+    :return: 表示用の照合結果（区分ごとに境界行を挟んだもの）
+    """
+    store = store or get_incremental_store()
+    key = store.get_key(match_by_time)
+
+    with report.stage('fingerprint', rows_in=len(calendar_df) + len(ibow_df)) as stage:
+        calendar_groups, ibow_groups = hash_group_keys(calendar_df), hash_group_keys(ibow_df)
+        fingerprints = combine_fingerprints(*get_group_fingerprints(calendar_df, calendar_groups),
+                                            *get_group_fingerprints(ibow_df, ibow_groups))
+        previous = store.load(key)
+        if previous is None:
+            unchanged = np.zeros(len(fingerprints), dtype=bool)
+        else:
+            unchanged = find_unchanged_groups(fingerprints, previous['fingerprints'])
+        changed_groups = fingerprints.index[~unchanged]
+        stage.rows_out = len(changed_groups)
+
+    # 変わったグループだけをマージ・照合する
+    changed_calendar_df = calendar_df[np.isin(calendar_groups, changed_groups)]
+    changed_ibow_df = ibow_df[np.isin(ibow_groups, changed_groups)]
+    results_df = merge_and_validate(changed_calendar_df, changed_ibow_df, match_by_time=match_by_time, report=report)
+    display_df = render_results(results_df, boundaries=False, report=report)
+    sections = results_df['区分'].to_numpy()
+    groups = hash_group_keys(results_df)
+
+    with report.stage('splice', rows_in=len(display_df)) as stage:
+        if previous is not None:
+            # 変わっていないグループの前回の行を加え、区分ごとに外部結合と同じグループの順に並べる
+            reused = np.isin(previous['groups'], fingerprints.index[unchanged])
+            display_df = pd.concat([display_df, previous['display'][reused]], ignore_index=True)
+            sections = np.concatenate([sections, previous['sections'][reused]])
+            groups = np.concatenate([groups, previous['groups'][reused]])
+        group_order = get_group_order(calendar_df, ibow_df).reindex(groups).to_numpy()
+        order = np.lexsort((group_order, sections))
+        display_df = display_df.take(order).reset_index(drop=True)
+        sections, groups = sections[order], groups[order]
+        stage.rows_out = len(display_df)
+
+    # すべてのグループが前回と同じ場合は、保存した照合結果もそのまま使える
+    if previous is None or len(changed_groups) or len(previous['fingerprints']) != len(fingerprints):
+        with report.stage('store', rows_in=len(display_df)):
+            try:
+                store.save(key, {'display': display_df, 'sections': sections, 'groups': groups,
+                                 'fingerprints': fingerprints})
+            except OSError:
+                # 保存できなくても照合結果はそのまま返す（次回はすべてのグループを照合する）
+                pass
+
+    with report.stage('concat', rows_in=len(display_df)) as stage:
+        display_df = insert_boundaries(display_df, sections)
+        stage.rows_out = len(display_df)
+    return display_df
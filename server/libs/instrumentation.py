@@ -0,0 +1,142 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+
+class StageRecord:
+    """
+    1つのステージの計測結果（経過時間・入出力の行数・ピークメモリ）
+    """
+
+    def __init__(self, name: str, rows_in: int = None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        self.peak_mib = None
+
+    def to_dict(self) -> dict:
+        return {'stage': self.name, 'seconds': self.seconds, 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+                'peak_mib': self.peak_mib}
+
+
+class PipelineReport:
+    """
+    receipt_checkのステージごとの計測結果をまとめたレポート
+    stage()で囲んだ処理の経過時間を記録し、trace_memoryの場合はtracemallocでピークメモリも記録する
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        """
+        ステージの処理を囲んで計測する（出力の行数は返したStageRecordのrows_outに設定する）
+        :param name: ステージ名
+        :param rows_in: 入力の行数
+        :return: StageRecord
+        """
+        record = StageRecord(name, rows_in)
+        self.stages.append(record)
+        started_tracing = False
+        if self.trace_memory:
+            # 既に追跡中の場合はピークだけをリセットする
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                started_tracing = True
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            if self.trace_memory:
+                record.peak_mib = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                if started_tracing:
+                    tracemalloc.stop()
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(record.seconds or 0 for record in self.stages)
+
+    def to_dict(self) -> dict:
+        return {'started_at': self.started_at, 'total_seconds': self.total_seconds,
+                'stages': [record.to_dict() for record in self.stages]}
+
+    def dump_json(self, path: Path) -> None:
+        """
+        レポートをJSONファイルに書き出す
+        :param path: 書き出し先のパス
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def __str__(self) -> str:
+        lines = [f"{'stage':<16}{'seconds':>10}{'rows_in':>10}{'rows_out':>10}{'peak_mib':>10}"]
+        for record in self.stages:
+            lines.append(f"{record.name:<16}{record.seconds or 0:>10.3f}{_format_optional(record.rows_in):>10}"
+                         f"{_format_optional(record.rows_out):>10}{_format_optional(record.peak_mib, '.1f'):>10}")
+        return '\n'.join(lines)
+
+
+class CheckCancelled(Exception):
+    """
+    照合が中止された場合に、次のステージの開始時に送出する例外
+    """
+
+
+class ProgressReport(PipelineReport):
+    """
+    ステージの開始・終了をキューに送り、中止が要求されていれば次のステージの開始時にCheckCancelledを送出するレポート
+    （照合をワーカースレッドで実行し、画面のスレッドでキューから進捗を読み取るためのもの）
+    キューには ('start', ステージ名) と ('done', ステージ名) を送る
+    """
+
+    def __init__(self, progress_queue, cancel_event, trace_memory: bool = False):
+        super().__init__(trace_memory=trace_memory)
+        self.progress_queue = progress_queue
+        self.cancel_event = cancel_event
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        if self.cancel_event.is_set():
+            raise CheckCancelled(name)
+        self.progress_queue.put(('start', name))
+        with super().stage(name, rows_in) as record:
+            yield record
+        self.progress_queue.put(('done', name))
+
+
+class NullReport:
+    """
+    計測しない場合のレポート（stage()は何もしないため、計測を無効にした場合のオーバーヘッドはほぼない）
+    """
+    stages = ()
+
+    class _NullStage:
+        rows_out = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    _null_stage = _NullStage()
+
+    def stage(self, name: str, rows_in: int = None):
+        return self._null_stage
+
+
+NULL_REPORT = NullReport()
+
+
+def _format_optional(value, format_spec: str = '') -> str:
+    return '-' if value is None else format(value, format_spec)
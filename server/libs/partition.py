@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from .constant import USE_IBOW_COLUMNS, IBOW_CHUNK_SIZE, IBOW_ENCODING_ERROR_MESSAGE
+from .get_dataframe import detect_csv_encoding
+
+# 訪問日を日付に変換できない行をまとめるパーティション
+UNKNOWN_MONTH = 'unknown'
+
+
+def get_month_labels(visit_dates: pd.Series) -> np.ndarray:
+    """
+    訪問日の列を月のラベル（YYYY-MM、変換できない場合はUNKNOWN_MONTH）の配列に変換する
+    訪問日はユニークな値ごとに一度だけ変換する
+    """
+    codes, uniques = pd.factorize(visit_dates)
+    months = pd.to_datetime(pd.Series(uniques, dtype=object), errors='coerce').dt.strftime('%Y-%m')
+    # factorizeは欠損値を-1とするため、末尾に欠損値のラベルを追加しておく
+    labels = np.append(months.fillna(UNKNOWN_MONTH).to_numpy(dtype=object), UNKNOWN_MONTH)
+    return labels[codes]
+
+
+def partition_ibow_by_month(file_path: Path, directory: Path, chunksize: int = IBOW_CHUNK_SIZE) -> dict:
+    """
+    IbowのCSVファイルをchunksize行ずつ読み込み、訪問日の月ごとのCSVファイルに書き分ける
+    メモリに載せるのは1チャンク分だけで、値は文字列のまま書き出す（読み込み時の型変換は月ごとに行う）
+    :param file_path: IbowのCSVファイルのパス
+    :param directory: 月ごとのCSVファイルの書き出し先
+    :param chunksize: 1度に読み込む行数
+    :return: {月のラベル: 月ごとのCSVファイルのパス}（月の順、UNKNOWN_MONTHは最後）
+    """
+    directory = Path(directory)
+    try:
+        encoding = detect_csv_encoding(file_path)
+        reader = pd.read_csv(file_path, encoding=encoding, usecols=USE_IBOW_COLUMNS, dtype=str, chunksize=chunksize)
+    except OSError:
+        raise ValueError("Ibowのファイルが誤っています。正しいファイルが選択されているか確認してください。")
+
+    paths = {}
+    try:
+        with reader:
+            for chunk in reader:
+                months = get_month_labels(chunk['訪問日'])
+                for month in pd.unique(months):
+                    path = paths.setdefault(month, directory / f"ibow_{month}.csv")
+                    chunk[months == month].to_csv(path, mode='a', header=not path.exists(), index=False,
+                                                  encoding='utf-8')
+    except UnicodeDecodeError:
+        raise ValueError(IBOW_ENCODING_ERROR_MESSAGE)
+    except ValueError:
+        raise ValueError("Ibowのファイルが誤っています。正しいファイルが選択されているか確認してください。")
+
+    return {month: paths[month] for month in sorted(paths, key=lambda month: (month == UNKNOWN_MONTH, month))}
+
+
+def get_visit_dates(visit_dates: pd.Series) -> np.ndarray:
+    """
+    訪問日の列を日付（時刻を切り捨てたdatetime64、変換できない場合はNaT）の配列に変換する
+    訪問日はユニークな値ごとに一度だけ変換する
+    """
+    codes, uniques = pd.factorize(visit_dates)
+    dates = pd.to_datetime(pd.Series(uniques, dtype=object), errors='coerce').dt.normalize()
+    # factorizeは欠損値を-1とするため、末尾にNaTを追加しておく
+    return np.append(dates.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT', 'ns'))[codes]
+
+
+def partition_by_date_range(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, n_partitions: int
+                            ) -> list[tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    カレンダーとIbowのデータフレームを、行数がおおよそ等しくなるように訪問日の連続した範囲で分割する
+    結合キーは訪問日を含み、照合結果は区分ごとに訪問日の順に並ぶため、各範囲の照合結果を範囲の順に
+    つなげると分割せずに照合した結果と同じ順序になる
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :param n_partitions: 分割数の上限（訪問日の種類がそれより少ない場合は訪問日の種類数）
+    :return: 範囲ごとの(カレンダーのデータフレーム, ibowのデータフレーム)のリスト（訪問日の順、空の範囲は含まない）
+    """
+    calendar_dates = get_visit_dates(calendar_df['訪問日'])
+    ibow_dates = get_visit_dates(ibow_df['訪問日'])
+    dates, counts = np.unique(np.concatenate([calendar_dates, ibow_dates]), return_counts=True)
+    dates, counts = dates[~np.isnat(dates)], counts[~np.isnat(dates)]
+
+    # 行数の累積が等分点を超える訪問日を各範囲の最初の日にする
+    cumulative = np.cumsum(counts)
+    targets = cumulative[-1] * np.arange(1, n_partitions) / n_partitions if len(dates) else []
+    first_dates = np.unique(dates[np.minimum(np.searchsorted(cumulative, targets, side='right'), len(dates) - 1)])
+
+    def _labels(visit_dates: np.ndarray) -> np.ndarray:
+        labels = np.searchsorted(first_dates, visit_dates, side='right') + 1
+        # 外部結合では訪問日が欠損したキーが先頭に並ぶため、訪問日が読めない行は最初の範囲にまとめる
+        labels[np.isnat(visit_dates)] = 0
+        return labels
+
+    calendar_labels, ibow_labels = _labels(calendar_dates), _labels(ibow_dates)
+    partitions = []
+    for label in range(len(first_dates) + 2):
+        calendar_rows, ibow_rows = calendar_labels == label, ibow_labels == label
+        if calendar_rows.any() or ibow_rows.any():
+            partitions.append((calendar_df[calendar_rows], ibow_df[ibow_rows]))
+    return partitions
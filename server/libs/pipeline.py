@@ -0,0 +1,240 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable
+import pandas as pd
+from .constant import PIPELINE_MEMO_SIZE
+from .instrumentation import NULL_REPORT
+from .result_cache import hash_dataframe
+
+# メモにない場合の値（Noneを出力するステージもメモするため）
+_MISSING = object()
+
+
+def fingerprint_value(value) -> str:
+    """
+    ステージの入力・出力の値のフィンガープリントを返す
+    データフレームは値から（attrs['fingerprint']に内容から作ったフィンガープリントがあればそれを使う）、
+    fingerprint属性を持つもの（ルール表など）はその値から、それ以外はJSONの表現から作る
+    """
+    if isinstance(value, pd.DataFrame):
+        return value.attrs.get('fingerprint') or hash_dataframe(value)
+    if hasattr(value, 'fingerprint'):
+        return value.fingerprint
+    source = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class Stage:
+    """
+    パイプラインの1つのステージ
+    - inputs: 入力とするステージ名またはパラメータ名（値はこの順にfuncの引数として渡す）
+    - options: 結果に影響しないパラメータ名（キーワード引数として渡し、フィンガープリントには含めない）
+    - lazy_inputs: inputsのうち、値の代わりに値を返す引数なしの関数を渡すもの（オプションによって使わない入力を計算しないため、
+      フィンガープリントには含める）
+    - volatile: 入力が同じでも結果が変わりうるステージ（ネットワークからの取得など）は毎回実行し、
+      出力の値からフィンガープリントを作る（出力が同じであれば下流のステージはメモを使う）
+    - persist: ディスクのキャッシュにも保存するか
+    - version: 処理の内容を変えた場合に変える値（フィンガープリントに含める）
+    funcは入力の値を変更してはならない（メモした値を他の実行と共有するため）
+    """
+
+    def __init__(self, name: str, func: Callable, inputs: tuple = (), options: tuple = (), lazy_inputs: tuple = (),
+                 volatile: bool = False, persist: bool = False, version=1):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.options = tuple(options)
+        self.lazy_inputs = frozenset(lazy_inputs)
+        self.volatile = volatile
+        self.persist = persist
+        self.version = version
+
+
+class Pipeline:
+    """
+    名前付きのステージとその入力からなるDAGを、必要なステージだけ遅延評価するパイプライン
+    ステージの出力は入力のフィンガープリントから作ったキーでメモし（メモリ上に直近memo_size件、
+    persistのステージはdisk_cacheにも）、入力が変わったステージとその下流だけを実行し直す
+    """
+
+    def __init__(self, stages: list, memo_size: int = PIPELINE_MEMO_SIZE, disk_cache=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.memo_size = memo_size
+        self.disk_cache = disk_cache
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, report=NULL_REPORT, use_disk_cache: bool = True, **params) -> 'PipelineRun':
+        """
+        パラメータを指定して1回分の実行を作成する（同じ実行の中では、volatileのステージも1回だけ実行する）
+        :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+        :param use_disk_cache: persistのステージでディスクのキャッシュを使うか
+        :param params: ステージの入力・オプションとするパラメータ
+        :return: PipelineRun（withで囲んで使う）
+        """
+        return PipelineRun(self, params, report, self.disk_cache if use_disk_cache else None)
+
+    def get(self, name: str, report=NULL_REPORT, use_disk_cache: bool = True, **params):
+        """
+        パラメータを指定してステージの出力を返す（途中のステージの出力も取得できる）
+        """
+        with self.run(report=report, use_disk_cache=use_disk_cache, **params) as run:
+            return run.get(name)
+
+    def get_memo(self, key: str):
+        with self._lock:
+            if key not in self._memo:
+                return _MISSING
+            self._memo.move_to_end(key)
+            return self._memo[key]
+
+    def put_memo(self, key: str, value) -> None:
+        with self._lock:
+            self._memo[key] = value
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def clear_memo(self) -> None:
+        with self._lock:
+            self._memo.clear()
+
+
+class PipelineRun:
+    """
+    パイプラインの1回分の実行
+    ステージのキーは入力のフィンガープリントだけから求め（volatileのステージを除いて計算しない）、
+    出力を求められたステージだけ、メモ・ディスクのキャッシュになければ計算する
+    計算するステージの入力はワーカースレッドで並行して計算するため、依存しないステージ（Ibowの読み込みと整形など）は並行して実行される
+    """
+
+    def __init__(self, pipeline: Pipeline, params: dict, report, disk_cache):
+        self.pipeline = pipeline
+        self.params = params
+        self.report = report
+        self.disk_cache = disk_cache
+        self._fingerprints = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(pipeline.stages)),
+                                            thread_name_prefix='pipeline')
+
+    def __enter__(self) -> 'PipelineRun':
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        # 失敗した場合は、並行して実行しているステージの完了を待たずに戻る
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        return False
+
+    def get(self, name: str):
+        """
+        ステージ（またはパラメータ）の値を返す
+        """
+        return self._start(name).result()
+
+    def resolve(self, name: str) -> str:
+        """
+        ステージ（またはパラメータ）のフィンガープリントを求める
+        パラメータは値から、volatileのステージは出力を計算してその値から、それ以外のステージは入力のフィンガープリントから作る
+        （volatile以外のステージは計算しないため、下流のステージのメモ・ディスクのキャッシュを先に探せる）
+        """
+        with self._lock:
+            if name in self._fingerprints:
+                return self._fingerprints[name]
+
+        if name not in self.pipeline.stages:
+            if name not in self.params:
+                raise KeyError(f"パイプラインにステージまたはパラメータがありません: {name}")
+            fingerprint = fingerprint_value(self.params[name])
+        else:
+            stage = self.pipeline.stages[name]
+            if stage.volatile:
+                # volatileのステージのフィンガープリントは出力から作る（_startで1回だけ計算し、フィンガープリントも記録する）
+                self._start(name).result()
+                return self._fingerprints[name]
+            input_fingerprints = [self.resolve(input_name) for input_name in stage.inputs]
+            fingerprint = fingerprint_value([stage.name, stage.version, input_fingerprints])
+
+        with self._lock:
+            return self._fingerprints.setdefault(name, fingerprint)
+
+    def _start(self, name: str) -> Future:
+        """
+        ステージ（またはパラメータ）の値のFutureを返す（同じ実行の中では1回だけ求める）
+        volatileのステージとパラメータはこのスレッドで求め、それ以外のステージはメモ・ディスクのキャッシュになければ
+        ワーカースレッドで計算を始める
+        """
+        with self._lock:
+            future = self._futures.get(name)
+            if future is not None:
+                return future
+            future = self._futures[name] = Future()
+
+        try:
+            if name not in self.pipeline.stages:
+                if name not in self.params:
+                    raise KeyError(f"パイプラインにステージまたはパラメータがありません: {name}")
+                future.set_result(self.params[name])
+                return future
+
+            stage = self.pipeline.stages[name]
+            if stage.volatile:
+                value = self._compute(stage)
+                with self._lock:
+                    self._fingerprints[name] = fingerprint_value(value)
+                future.set_result(value)
+                return future
+
+            key = self.resolve(name)
+            value = self._lookup(stage, key)
+            if value is not _MISSING:
+                future.set_result(value)
+            else:
+                self._executor.submit(self._compute_and_store, stage, key, future)
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def _lookup(self, stage: Stage, key: str):
+        value = self.pipeline.get_memo(key)
+        if value is _MISSING and stage.persist and self.disk_cache is not None:
+            with self.report.stage(f"{stage.name}_cache") as record:
+                cached = self.disk_cache.get(key)
+                record.rows_out = len(cached) if isinstance(cached, pd.DataFrame) else None
+            if cached is not None:
+                value = cached
+                self.pipeline.put_memo(key, value)
+        return value
+
+    def _compute(self, stage: Stage):
+        # 入力を先にすべて求め始めてから待つ（メモにない入力どうしは並行して計算する）
+        futures = [None if input_name in stage.lazy_inputs else self._start(input_name) for input_name in stage.inputs]
+        values = [partial(self.get, input_name) if future is None else future.result()
+                  for input_name, future in zip(stage.inputs, futures)]
+        options = {option: self.params[option] for option in stage.options if option in self.params}
+        if 'report' in stage.options:
+            options['report'] = self.report
+        with self.report.stage(stage.name) as record:
+            value = stage.func(*values, **options)
+            record.rows_out = len(value) if isinstance(value, pd.DataFrame) else None
+        return value
+
+    def _compute_and_store(self, stage: Stage, key: str, future: Future) -> None:
+        try:
+            value = self._compute(stage)
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        self.pipeline.put_memo(key, value)
+        if stage.persist and self.disk_cache is not None:
+            try:
+                self.disk_cache.put(key, value)
+            except OSError:
+                # 保存できなくても出力はそのまま使う
+                pass
+        future.set_result(value)
@@ -1,13 +1,393 @@
-from .get_dataframe import get_dataframes
-from .validate_dataframe import merge_and_validate
-from .format_dataframe import format_dataframes
-
-
-def receipt_check(receipt_file):
-    calendar_df, ibow_df = get_dataframes(receipt_file)
-    calendar_df, ibow_df = format_dataframes(calendar_df, ibow_df)
-    results_df = merge_and_validate(calendar_df, ibow_df)
-    return results_df[
-        ["訪問日", "利用者名", "主訪問者",  "サービス内容_カレンダー",
-         "開始時間_カレンダー","終了時間_カレンダー","提供時間_カレンダー",
-         "サービス内容_Ibow","開始時間_Ibow","終了時間_Ibow", "提供時間_Ibow", "加算"]].fillna('データなし')
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from tkinter import messagebox
+from typing import Callable, Iterator
+import numpy as np
+import pandas as pd
+from .get_dataframe import (get_dataframes, load_ibow_dataframe, read_ibow_csv, get_visit_date_range,
+                            load_calendar_dataframe)
+from .validate_dataframe import merge_and_validate, render_results, insert_boundaries
+from .format_dataframe import format_dataframes, format_dataframe, format_calendar_dataframe
+from .instrumentation import PipelineReport, NULL_REPORT
+from .partition import partition_ibow_by_month, partition_by_date_range, UNKNOWN_MONTH
+from .pipeline import Pipeline, Stage
+from .result_cache import get_result_cache, hash_file
+from .calendar_snapshot import get_calendar_snapshot_store
+from .incremental import check_dataframes_incremental
+from .service_rules import load_service_rules
+from .calendar_client import CalendarFetchError
+from .constant import (CALENDER_GAS_API_URL, CALENDAR_CACHE_ENABLED, RECEIPT_CHECK_REPORT_PATH,
+                       RECEIPT_CHECK_TRACE_MEMORY, RECEIPT_CHECK_WORKERS, RECEIPT_CHECK_PARALLEL_MIN_ROWS,
+                       RECEIPT_CHECK_INCREMENTAL, IBOW_CHUNK_SIZE, RESULT_CACHE_ENABLED, RESULT_CACHE_VERSION,
+                       RESULT_COLUMNS, VISIT_MATCH_TOLERANCE_MINUTES)
+
+
+def check_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False,
+                     workers: int = RECEIPT_CHECK_WORKERS, incremental: bool = False, report=NULL_REPORT
+                     ) -> pd.DataFrame:
+    """
+    読み込んだカレンダーとIbowのデータフレームを整形・照合し、表示用の照合結果を返す
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param workers: 照合を並列に実行するプロセス数（1の場合、または行数がRECEIPT_CHECK_PARALLEL_MIN_ROWS未満の場合は
+                    並列にしない）
+    :param incremental: 前回の照合結果から、フィンガープリントが変わった結合キーのグループだけを照合し直すか
+                        （workersより優先する）
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+    :return: 照合結果のデータフレーム（attrs['boundary_rows']に境界行の位置、
+             カレンダーのキャッシュを使った場合はattrs['calendar_snapshot']付き）
+    """
+    # キャッシュしたスナップショットを使った場合は、その取得日時・経過秒数を照合結果にも残す
+    calendar_snapshot = calendar_df.attrs.get('calendar_snapshot')
+    with report.stage('format', rows_in=len(calendar_df) + len(ibow_df)) as stage:
+        calendar_df, ibow_df = format_dataframes(calendar_df, ibow_df)
+        stage.rows_out = len(calendar_df) + len(ibow_df)
+    results_df = check_formatted_dataframes(calendar_df, ibow_df, match_by_time=match_by_time, workers=workers,
+                                            incremental=incremental, report=report).fillna('データなし')
+    if calendar_snapshot:
+        results_df.attrs['calendar_snapshot'] = calendar_snapshot
+    return results_df
+
+
+def check_formatted_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False,
+                               workers: int = RECEIPT_CHECK_WORKERS, incremental: bool = False, report=NULL_REPORT
+                               ) -> pd.DataFrame:
+    """
+    整形後のカレンダーとIbowのデータフレームを照合し、表示用の照合結果を返す
+    :param calendar_df: 整形後のカレンダーのデータフレーム
+    :param ibow_df: 整形後のibowのデータフレーム
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param workers: 照合を並列に実行するプロセス数
+    :param incremental: 前回の照合結果から、フィンガープリントが変わった結合キーのグループだけを照合し直すか
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+    :return: 表示用の照合結果（区分ごとに境界行を挟んだもの、欠損値はそのまま）
+    """
+    if incremental:
+        return check_dataframes_incremental(calendar_df, ibow_df, match_by_time=match_by_time, report=report)
+    results_df = validate_formatted_dataframes(calendar_df, ibow_df, match_by_time=match_by_time, workers=workers,
+                                               report=report)
+    return render_validated_results(results_df, workers=workers, report=report)
+
+
+def use_parallel(workers: int, rows: int) -> bool:
+    """
+    プロセスプールで並列に実行するか（小さいデータはプロセスへの受け渡しの方が遅いため並列にしない）
+    """
+    return workers > 1 and rows >= RECEIPT_CHECK_PARALLEL_MIN_ROWS
+
+
+def validate_formatted_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False,
+                                  workers: int = RECEIPT_CHECK_WORKERS, report=NULL_REPORT) -> pd.DataFrame:
+    """
+    整形後のカレンダーとIbowのデータフレームをマージして照合する
+    :return: 照合結果（値は内部表現のまま、区分の順に並べたもの）
+    """
+    if use_parallel(workers, len(calendar_df) + len(ibow_df)):
+        return validate_dataframes_parallel(calendar_df, ibow_df, match_by_time=match_by_time, workers=workers,
+                                            report=report)
+    return merge_and_validate(calendar_df, ibow_df, match_by_time=match_by_time, report=report)
+
+
+def render_validated_results(results_df: pd.DataFrame, workers: int = RECEIPT_CHECK_WORKERS, report=NULL_REPORT
+                             ) -> pd.DataFrame:
+    """
+    照合結果を表示用のデータフレームに変換し、区分ごとに境界行を挟む
+    :return: 表示用の照合結果（区分ごとに境界行を挟んだもの、欠損値はそのまま）
+    """
+    if use_parallel(workers, len(results_df)):
+        return render_results_parallel(results_df, workers=workers, report=report)
+    return render_results(results_df, report=report)
+
+
+def validate_partition(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False
+                       ) -> pd.DataFrame:
+    """
+    整形後のカレンダーとIbowの1つの範囲をマージして照合する（並列に実行する場合にワーカーのプロセスで実行する）
+    """
+    return merge_and_validate(calendar_df, ibow_df, match_by_time=match_by_time)
+
+
+def validate_dataframes_parallel(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False,
+                                 workers: int = RECEIPT_CHECK_WORKERS, report=NULL_REPORT) -> pd.DataFrame:
+    """
+    整形後のカレンダーとIbowを訪問日の範囲ごとに分け、マージ・照合をプロセスプールで並列に実行する
+    結合キーは訪問日を含むため範囲をまたいで結合される行はなく、区分ごとに範囲の順につなげると
+    並列にしない場合と同じ照合結果になる
+    :param calendar_df: 整形後のカレンダーのデータフレーム
+    :param ibow_df: 整形後のibowのデータフレーム
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param workers: プロセス数
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+    :return: 照合結果（値は内部表現のまま、区分の順に並べたもの）
+    """
+    with report.stage('partition', rows_in=len(calendar_df) + len(ibow_df)) as stage:
+        partitions = partition_by_date_range(calendar_df, ibow_df, workers)
+        stage.rows_out = len(partitions)
+
+    with report.stage('parallel', rows_in=len(calendar_df) + len(ibow_df)) as stage:
+        calendar_parts, ibow_parts = zip(*partitions) if partitions else ((calendar_df,), (ibow_df,))
+        with ProcessPoolExecutor(max_workers=min(workers, len(calendar_parts))) as executor:
+            results = list(executor.map(validate_partition, calendar_parts, ibow_parts, repeat(match_by_time)))
+        stage.rows_out = sum(len(results_df) for results_df in results)
+
+    with report.stage('concat', rows_in=stage.rows_out) as stage:
+        results_df = pd.concat(results, ignore_index=True)
+        # 区分の順に並べ替える（区分内は範囲の順＝訪問日の順のまま）
+        order = np.argsort(results_df['区分'].to_numpy(), kind='stable')
+        results_df = results_df.take(order).reset_index(drop=True)
+        stage.rows_out = len(results_df)
+    return results_df
+
+
+def render_partition(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    照合結果の一部の行を、境界行を挟まずに表示用のデータフレームに変換する（ワーカーのプロセスで実行する）
+    """
+    return render_results(results_df, boundaries=False)
+
+
+def render_results_parallel(results_df: pd.DataFrame, workers: int = RECEIPT_CHECK_WORKERS, report=NULL_REPORT
+                            ) -> pd.DataFrame:
+    """
+    照合結果を連続した行ごとに分け、表示用のデータフレームへの変換をプロセスプールで並列に実行する
+    （行ごとに独立して変換するため、分けた順につなげると並列にしない場合と同じ表示になる）
+    :return: 表示用の照合結果（区分ごとに境界行を挟んだもの）
+    """
+    bounds = np.linspace(0, len(results_df), workers + 1).astype(int)
+    with report.stage('mark', rows_in=len(results_df)) as stage:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(render_partition, [results_df.iloc[start:stop]
+                                                          for start, stop in zip(bounds[:-1], bounds[1:])]))
+        stage.rows_out = sum(len(part) for part in parts)
+
+    with report.stage('concat', rows_in=stage.rows_out) as stage:
+        display_df = insert_boundaries(pd.concat(parts, ignore_index=True), results_df['区分'].to_numpy())
+        stage.rows_out = len(display_df)
+    return display_df
+
+
+def hash_ibow_file(receipt_file) -> str:
+    """
+    IbowのCSVファイルの内容のハッシュを返す
+    """
+    try:
+        return hash_file(receipt_file)
+    except OSError:
+        raise ValueError("Ibowのファイルが誤っています。正しいファイルが選択されているか確認してください。")
+
+
+def read_visit_date_range(receipt_file, ibow_hash: str):
+    """
+    IbowのCSVファイルの訪問日だけを読み込み、カレンダーを取得する範囲を返す
+    （ibow_hashはファイルの内容が変わった場合に読み直すための入力）
+    """
+    return get_visit_date_range(read_ibow_csv(receipt_file, ['訪問日']))
+
+
+def fetch_calendar_dataframe(calendar_gas_api_url: str, use_cache: bool, date_range) -> pd.DataFrame:
+    """
+    Ibowの訪問日の範囲のカレンダーを取得する
+    """
+    calendar_df, _ = load_calendar_dataframe(calendar_gas_api_url, use_cache, date_range)
+    return calendar_df
+
+
+def load_ibow_stage(receipt_file, ibow_hash: str) -> pd.DataFrame:
+    """
+    IbowのCSVファイルを読み込む（ibow_hashはファイルの内容が変わった場合に読み直すための入力）
+    """
+    return load_ibow_dataframe(receipt_file)
+
+
+def load_formatted_calendar(calendar_gas_api_url: str, use_cache: bool, date_range, rules,
+                            get_calendar: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    """
+    Ibowの訪問日の範囲の整形済みのカレンダーを返す
+    キャッシュを使う場合は、保存した整形済みのスナップショットを開き、カレンダーのCSVの読み込みと整形を省く
+    キャッシュを使わない場合は、calendarステージで取得したカレンダーを整形する
+    :param get_calendar: calendarステージの出力を返す関数（キャッシュを使う場合は取得しないため、呼び出さない）
+    """
+    if use_cache:
+        return get_calendar_snapshot_store().load(calendar_gas_api_url, date_range, rules)
+    # calendarステージの出力は他のステージと共有するため、コピーを整形する
+    return format_calendar_dataframe(get_calendar().copy())
+
+
+def format_ibow_stage(ibow_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ibowを整形する
+    """
+    return format_dataframe(ibow_df.copy())
+
+
+def validate_stage(ibow_df: pd.DataFrame, calendar_df: pd.DataFrame, match_by_time: bool, rules,
+                   workers: int = RECEIPT_CHECK_WORKERS, report=NULL_REPORT) -> pd.DataFrame:
+    """
+    整形後のカレンダーとIbowをマージして照合する（値は内部表現のまま）
+    （rulesはルール表が変わった場合に照合し直すための入力）
+    """
+    return validate_formatted_dataframes(calendar_df, ibow_df, match_by_time=match_by_time, workers=workers,
+                                         report=report)
+
+
+def results_stage(get_validated: Callable[[], pd.DataFrame], get_ibow: Callable[[], pd.DataFrame],
+                  get_calendar: Callable[[], pd.DataFrame], match_by_time: bool, workers: int = RECEIPT_CHECK_WORKERS,
+                  incremental: bool = False, report=NULL_REPORT) -> pd.DataFrame:
+    """
+    validatedステージの照合結果を表示用の照合結果に変換する
+    インクリメンタル照合の場合は、validatedステージを使わずに整形後のカレンダーとIbowから変わったグループだけを照合する
+    （入力はステージの出力を返す関数で、使う入力だけを計算する）
+    """
+    if incremental:
+        display_df = check_dataframes_incremental(get_calendar(), get_ibow(), match_by_time=match_by_time,
+                                                  report=report)
+    else:
+        display_df = render_validated_results(get_validated(), workers=workers, report=report)
+    return display_df.fillna('データなし')
+
+
+def build_receipt_check_pipeline(disk_cache=None) -> Pipeline:
+    """
+    receipt_checkのステージのDAGを作成する
+    パラメータ: receipt_file, calendar_gas_api_url, use_cache, match_by_time（オプション: workers, incremental）
+    ステージ:
+    - ibow_hash: IbowのCSVファイルの内容のハッシュ（毎回計算する）
+    - date_range: カレンダーを取得する範囲（disk_cacheにも保存する）
+    - ibow: 読み込んだIbow
+    - calendar: 取得したカレンダー（整形前、キャッシュを使わない場合にcalendar_formattedで整形する）
+    - rules: ルール表（毎回読み込み、フィンガープリントが同じであれば下流のステージはメモを使う）
+    - ibow_formatted: 整形後のIbow
+    - calendar_formatted: 整形後のカレンダー（毎回スナップショットを開き、内容が同じであれば下流のステージはメモを使う）
+    - validated: マージして照合した結果（値は内部表現のまま、workersが2以上であれば範囲ごとに並列に照合する）
+    - results: validatedを変換した表示用の照合結果（disk_cacheにも保存する、incrementalの場合は変わったグループだけを照合する）
+    :param disk_cache: date_range・resultsを保存するディスクのキャッシュ（get(key)・put(key, value)を持つもの）
+    :return: Pipeline
+    """
+    return Pipeline([
+        Stage('ibow_hash', hash_ibow_file, inputs=['receipt_file'], volatile=True),
+        # 照合結果のキャッシュを探す前にカレンダーを開くため、取得する範囲もディスクに保存してIbowを読み込まずに済ませる
+        Stage('date_range', read_visit_date_range, inputs=['receipt_file', 'ibow_hash'], persist=True),
+        Stage('ibow', load_ibow_stage, inputs=['receipt_file', 'ibow_hash']),
+        Stage('calendar', fetch_calendar_dataframe, inputs=['calendar_gas_api_url', 'use_cache', 'date_range'],
+              volatile=True),
+        Stage('rules', load_service_rules, volatile=True),
+        Stage('ibow_formatted', format_ibow_stage, inputs=['ibow']),
+        Stage('calendar_formatted', load_formatted_calendar,
+              inputs=['calendar_gas_api_url', 'use_cache', 'date_range', 'rules', 'calendar'], lazy_inputs=['calendar'],
+              volatile=True),
+        # カレンダーは照合結果のキーを求めるために先に開き、Ibowの読み込み・整形は照合結果がメモ・ディスクのキャッシュにない場合だけ行う
+        Stage('validated', validate_stage, inputs=['ibow_formatted', 'calendar_formatted', 'match_by_time', 'rules'],
+              options=['workers', 'report'], version=[1, VISIT_MATCH_TOLERANCE_MINUTES]),
+        # インクリメンタル照合は整形後のカレンダーとIbowから照合するため、どの入力も使う場合だけ計算する
+        Stage('results', results_stage,
+              inputs=['validated', 'ibow_formatted', 'calendar_formatted', 'match_by_time'],
+              lazy_inputs=['validated', 'ibow_formatted', 'calendar_formatted'],
+              options=['workers', 'incremental', 'report'], persist=True,
+              version=[RESULT_CACHE_VERSION, RESULT_COLUMNS, VISIT_MATCH_TOLERANCE_MINUTES]),
+    ], disk_cache=disk_cache)
+
+
+@lru_cache(maxsize=None)
+def get_receipt_check_pipeline() -> Pipeline:
+    """
+    プロセス内で共有するreceipt_checkのパイプラインを返す（ステージの出力のメモを実行をまたいで使うため）
+    """
+    return build_receipt_check_pipeline(disk_cache=get_result_cache())
+
+
+def get_default_report():
+    """
+    RECEIPT_CHECK_REPORT_PATHが設定されていれば計測するレポートを、設定されていなければ計測しないレポートを返す
+    """
+    if RECEIPT_CHECK_REPORT_PATH:
+        return PipelineReport(trace_memory=RECEIPT_CHECK_TRACE_MEMORY)
+    return NULL_REPORT
+
+
+def receipt_check(receipt_file, match_by_time: bool = False, workers: int = RECEIPT_CHECK_WORKERS,
+                  use_result_cache: bool = RESULT_CACHE_ENABLED, incremental: bool = RECEIPT_CHECK_INCREMENTAL,
+                  report=None, show_errors: bool = True):
+    """
+    カレンダーとIbowの訪問データを照合し、表示用の照合結果を返す
+    ステージのDAG（build_receipt_check_pipeline）で、前回から入力が変わったステージとその下流だけを実行する
+    同じIbowのファイル・カレンダー・ルール表で照合済みの場合は、メモまたはディスクに保存した照合結果を返す
+    :param receipt_file: IbowのCSVファイルのパス
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param workers: 照合を並列に実行するプロセス数（デフォルトはRECEIPT_CHECK_WORKERS）
+    :param use_result_cache: ディスクに保存した照合結果を使うか（デフォルトはRESULT_CACHE_ENABLED）
+    :param incremental: 前回の照合結果から、変わったグループだけを照合し直すか（デフォルトはRECEIPT_CHECK_INCREMENTAL）
+    :param report: ステージごとの計測結果を記録するPipelineReport
+                   （省略した場合、RECEIPT_CHECK_REPORT_PATHが設定されていれば計測してJSONを書き出す）
+    :param show_errors: カレンダーの取得に失敗した場合にメッセージボックスを表示するか
+                        （Tkのメインスレッド以外で実行する場合はFalseにし、呼び出し元で表示する）
+    :return: 照合結果のデータフレーム（attrs['boundary_rows']に境界行の位置、
+             カレンダーのキャッシュを使った場合はattrs['calendar_snapshot']付き）
+    """
+    dump_path = RECEIPT_CHECK_REPORT_PATH if report is None else None
+    if report is None:
+        report = get_default_report()
+
+    pipeline = get_receipt_check_pipeline()
+    with pipeline.run(report=report, use_disk_cache=use_result_cache, receipt_file=receipt_file,
+                      calendar_gas_api_url=CALENDER_GAS_API_URL, use_cache=CALENDAR_CACHE_ENABLED,
+                      match_by_time=match_by_time, workers=workers, incremental=incremental) as run:
+        try:
+            results_df = run.get('results')
+        except CalendarFetchError:
+            if show_errors:
+                messagebox.showerror("エラー", "データの取得に失敗しました: 開発者にお問い合わせください。")
+            raise
+        calendar_df = run.get('calendar_formatted')
+
+    # メモした照合結果は他の実行と共有するため、コピーに境界行の位置と今回使ったカレンダーのスナップショットの情報を付ける
+    results_df = results_df.copy(deep=False)
+    results_df.attrs = {key: value for key, value in results_df.attrs.items() if key == 'boundary_rows'}
+    if calendar_df.attrs.get('calendar_snapshot'):
+        results_df.attrs['calendar_snapshot'] = calendar_df.attrs['calendar_snapshot']
+
+    if dump_path:
+        report.dump_json(dump_path)
+    return results_df
+
+
+def iter_receipt_check_by_month(receipt_file, match_by_time: bool = False, chunksize: int = IBOW_CHUNK_SIZE,
+                                workers: int = RECEIPT_CHECK_WORKERS, report=None
+                                ) -> Iterator[tuple[str, pd.DataFrame]]:
+    """
+    IbowのCSVファイルを月ごとに分けて照合し、月の照合結果ができるたびに返す（1年分などの大きなファイル向け）
+    Ibowはchunksize行ずつ読み込んで月ごとの一時ファイルに書き分け、カレンダーはその月の範囲だけを取得するため、
+    メモリに載るのはファイルの長さによらず1か月分のデータだけになる
+    :param receipt_file: IbowのCSVファイルのパス
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param chunksize: IbowのCSVを1度に読み込む行数
+    :param workers: 月ごとの照合を並列に実行するプロセス数（デフォルトはRECEIPT_CHECK_WORKERS）
+    :param report: ステージごとの計測結果を記録するPipelineReport（月ごとのステージが順に記録される）
+    :return: (月のラベル（YYYY-MM、訪問日が読めない行はUNKNOWN_MONTH）, その月の照合結果) を月の順に返すイテレータ
+    """
+    dump_path = RECEIPT_CHECK_REPORT_PATH if report is None else None
+    if report is None:
+        report = get_default_report()
+
+    with tempfile.TemporaryDirectory(prefix='receipt_check_') as directory:
+        with report.stage('partition') as stage:
+            partitions = partition_ibow_by_month(receipt_file, directory, chunksize)
+            stage.rows_out = len(partitions)
+
+        for month, path in partitions.items():
+            if month == UNKNOWN_MONTH:
+                # 訪問日が読めない行は照合するカレンダーの範囲がないため、Ibowのみとして出力する
+                # （日付に変換できない訪問日は整形で例外になるため、欠損値にしてから照合する）
+                ibow_df = load_ibow_dataframe(path)
+                ibow_df['訪問日'] = pd.Series(pd.NaT, index=ibow_df.index, dtype='datetime64[ns]')
+                calendar_df = ibow_df.iloc[:0, :7]
+            else:
+                calendar_df, ibow_df = get_dataframes(path, report=report)
+            path.unlink()
+            yield month, check_dataframes(calendar_df, ibow_df, match_by_time=match_by_time, workers=workers,
+                                          report=report)
+
+    if dump_path:
+        report.dump_json(dump_path)
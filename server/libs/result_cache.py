@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+from .constant import RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES
+
+# ファイルのハッシュを計算する際に1度に読み込むバイト数
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(file_path: Path) -> str:
+    """
+    ファイルの内容のSHA-256を返す
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    """
+    データフレームのカラム名と値のSHA-256を返す（インデックスは含めない）
+    """
+    digest = hashlib.sha256(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))],
+                                       ensure_ascii=False).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def encode_dataframe(df: pd.DataFrame) -> dict:
+    """
+    データフレームをカラムごとのコードとユニークな値に分けた辞書に変換する
+    照合結果は繰り返しの多い文字列のカラムばかりのため、行ごとの値をそのままpickleするより小さく、読み込みも速い
+    """
+    columns = {}
+    for column in df.columns:
+        codes, uniques = pd.factorize(df[column], use_na_sentinel=False)
+        columns[column] = (codes.astype(np.int32), uniques)
+    return {'columns': columns, 'length': len(df), 'attrs': dict(df.attrs)}
+
+
+def decode_dataframe(encoded: dict) -> pd.DataFrame:
+    """
+    encode_dataframeで変換した辞書をデータフレームに戻す（attrsも戻す）
+    照合結果はすべて文字列のカラムのため、1つの2次元の配列に値を戻してからデータフレームにする
+    （カラムごとの配列から作ると、型の推定とブロックへのまとめ直しでコピーが増えるため）
+    """
+    columns = encoded['columns']
+    if not all(uniques.dtype == object for _, uniques in columns.values()):
+        df = pd.DataFrame({column: uniques.take(codes).to_numpy() for column, (codes, uniques) in columns.items()},
+                          index=pd.RangeIndex(encoded['length']))
+        df.attrs = encoded.get('attrs', {})
+        return df
+
+    values = np.empty((len(columns), encoded['length']), dtype=object)
+    for position, (codes, uniques) in enumerate(columns.values()):
+        np.take(uniques.to_numpy(dtype=object), codes, out=values[position])
+    df = pd.DataFrame(values.T, columns=list(columns), index=pd.RangeIndex(encoded['length']), dtype=object,
+                      copy=False)
+    df.attrs = encoded.get('attrs', {})
+    return df
+
+
+class ResultCache:
+    """
+    照合結果をIbowのファイル・カレンダーの内容・ルール表・照合の設定から作ったキーごとにディスクへ保存するキャッシュ
+    （キーはパイプラインのresultsステージのフィンガープリントで、どれかが変わればキーが変わるため古い照合結果を返すことはない）
+    保存した照合結果の合計がmax_bytesを超えた場合は、最後に使ってから最も時間が経ったものから削除する
+    データフレーム以外の値（カレンダーを取得する範囲など、照合結果のキーを求めるために使う値）もそのまま保存できる
+    """
+
+    def __init__(self, directory: Path = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def get_path(self, key: str) -> Path:
+        return self.directory / f"{key}.pkl"
+
+    def get(self, key: str):
+        """
+        保存した照合結果（または値）を返す（ない場合・読み込めない場合はNone）
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                encoded = pickle.load(f)
+            results_df = decode_dataframe(encoded) if 'columns' in encoded else encoded['value']
+            # 最後に使った日時として更新日時を更新する
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, ValueError,
+                TypeError):
+            path.unlink(missing_ok=True)
+            return None
+        return results_df
+
+    def put(self, key: str, results_df) -> None:
+        """
+        照合結果（または値）を保存し、合計がmax_bytesを超えた分を古いものから削除する
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        # 書き込み途中のファイルを読まないように、一時ファイルに書き出してから置き換える
+        temporary_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temporary_path, 'wb') as f:
+                encoded = encode_dataframe(results_df) if isinstance(results_df, pd.DataFrame) \
+                    else {'value': results_df}
+                pickle.dump(encoded, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        保存した照合結果の合計がmax_bytes以下になるまで、最後に使った日時が古いものから削除する
+        """
+        with self._lock:
+            entries = []
+            for path in self.directory.glob('*.pkl'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total_bytes -= size
+
+
+@lru_cache(maxsize=None)
+def get_result_cache() -> ResultCache:
+    """
+    プロセス内で共有する照合結果のキャッシュを返す
+    """
+    return ResultCache()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from .constant import SERVICE_RULES_PATH
+
+# 加算フラグ（int64）に割り当てられる語彙の数（語彙にない加算のビットを1つ残す）
+MAX_ADD_ON_VOCABULARY = 62
+
+
+class ServiceRules:
+    """
+    サービスコードのルール表（有効範囲・部分一致・同一とみなす組み合わせ・終了時間の補正・加算）をコンパイルしたもの
+    ルール表の各グループに整数IDを割り当て、IDで引ける配列としてまとめて評価する
+    """
+
+    def __init__(self, config: dict):
+        try:
+            service_codes = config['service_codes']
+            self.code_ids = {}
+            self.contains = []
+            min_minutes, max_minutes, adjustments = [], [], []
+            for rule_id, rule in enumerate(service_codes):
+                for code in rule['codes']:
+                    self.code_ids[code] = rule_id
+                for substring in rule.get('contains', []):
+                    self.contains.append((substring, rule_id))
+                start, end = rule['valid_minutes']
+                min_minutes.append(int(start))
+                max_minutes.append(int(end))
+                adjustments.append(int(rule.get('end_time_adjustment', 0)))
+
+            # 末尾の要素は該当するサービスコードがない場合（常に範囲外・有効範囲は空文字・補正なし）
+            self.unknown_id = len(service_codes)
+            self.min_minutes = np.array(min_minutes + [0])
+            self.max_minutes = np.array(max_minutes + [-1])
+            self.range_labels = np.array([f"{start}~{end}" for start, end in zip(min_minutes, max_minutes)] + [""],
+                                         dtype=object)
+            self.end_time_adjustments = np.array(adjustments + [0])
+
+            # カレンダーのID × IbowのID で同一とみなすかを引ける表
+            self.equivalent = np.zeros((self.unknown_id + 1, self.unknown_id + 1), dtype=bool)
+            for equivalence in config.get('equivalences', []):
+                calendar_ids = [self.code_ids[code] for code in equivalence['calendar']]
+                ibow_ids = [self.code_ids[code] for code in equivalence['ibow']]
+                self.equivalent[np.ix_(calendar_ids, ibow_ids)] = True
+
+            # 加算の語彙ごとに1ビットを割り当て、語彙にない加算はまとめて最上位のビットとする
+            add_ons = config['add_ons']
+            vocabulary = add_ons['vocabulary']
+            if len(vocabulary) > MAX_ADD_ON_VOCABULARY:
+                raise ValueError(f"加算の語彙は{MAX_ADD_ON_VOCABULARY}個までです")
+            self.add_on_bits = {add_on: 1 << bit for bit, add_on in enumerate(vocabulary)}
+            self.other_add_on_flag = 1 << len(vocabulary)
+            self.valid_add_on_flags = np.array([self.get_add_on_flags(valid) for valid in add_ons['valid']],
+                                               dtype=np.int64)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"サービスコードのルール表が誤っています: {e!r}")
+
+        self.fingerprint = hashlib.sha256(
+            json.dumps(config, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_service_id(self, service) -> int:
+        """
+        サービス内容に対応するサービスコードIDを返す
+        :param service: サービス内容
+        :return: サービスコードID（該当なしの場合はunknown_id）
+        """
+        # サービス内容がNaN（空の値）またはfloat型（不正な値）であれば、該当なし
+        if not isinstance(service, str):
+            return self.unknown_id
+
+        # サービス内容が特定の文字列を含む場合、対応するサービスコードとみなす
+        for substring, rule_id in self.contains:
+            if substring in service:
+                return rule_id
+
+        return self.code_ids.get(service, self.unknown_id)
+
+    def get_service_ids(self, services: pd.Series) -> np.ndarray:
+        """
+        サービス内容の列をサービスコードIDの配列に変換する
+        行ごとではなく、ユニークなサービス内容ごとに一度だけIDを求める
+        :param services: サービス内容の列
+        :return: サービスコードIDの配列
+        """
+        codes, uniques = pd.factorize(services)
+        # factorizeは欠損値を-1とするため、末尾に該当なしのIDを追加しておく
+        unique_ids = np.array([self.get_service_id(service) for service in uniques] + [self.unknown_id],
+                              dtype=np.intp)
+        return unique_ids[codes]
+
+    def validate_minutes(self, service_ids: np.ndarray, minutes: np.ndarray) -> np.ndarray:
+        """
+        サービスコードIDと分数の整合性をまとめてチェックする
+        :param service_ids: サービスコードIDの配列
+        :param minutes: 分数の配列（NaNは範囲外として扱う）
+        :return: チェック結果の配列
+        """
+        return (self.min_minutes[service_ids] <= minutes) & (minutes <= self.max_minutes[service_ids])
+
+    def get_valid_ranges(self, service_ids: np.ndarray) -> np.ndarray:
+        """
+        サービスコードIDに対応する有効範囲の文字列（例: "30~59"、該当なしは空文字）を返す
+        """
+        return self.range_labels[service_ids]
+
+    def get_end_time_adjustments(self, service_ids: np.ndarray) -> np.ndarray:
+        """
+        サービスコードIDに対応するカレンダーの終了時間・提供時間の補正（分）を返す
+        """
+        return self.end_time_adjustments[service_ids]
+
+    def is_equivalent(self, calendar_ids: np.ndarray, ibow_ids: np.ndarray) -> np.ndarray:
+        """
+        カレンダーとIbowのサービスコードIDの組み合わせが同一とみなせるかを返す
+        """
+        return self.equivalent[calendar_ids, ibow_ids]
+
+    def get_add_on_flags(self, add_ons: list) -> int:
+        """
+        加算の一覧を加算フラグ（語彙ごとのビットの論理和）に変換する
+        同じ加算が重複している場合は、語彙にない加算と同じく最上位のビットを立てる
+        """
+        flags = 0
+        for add_on in add_ons:
+            bit = self.add_on_bits.get(add_on, self.other_add_on_flag)
+            flags |= self.other_add_on_flag if flags & bit else bit
+        return flags
+
+    def is_valid_add_on(self, add_on_flags: np.ndarray) -> np.ndarray:
+        """
+        加算フラグがルール表で有効な組み合わせのいずれかと一致するかを返す
+        """
+        return np.isin(add_on_flags, self.valid_add_on_flags)
+
+
+@lru_cache(maxsize=None)
+def load_service_rules(path: str = SERVICE_RULES_PATH) -> ServiceRules:
+    """
+    ルール表の設定ファイルを読み込んでコンパイルする（同じパスは一度だけ読み込む）
+    :param path: ルール表のJSONファイルのパス（デフォルトはSERVICE_RULES_PATH）
+    :return: コンパイルしたルール表
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"サービスコードのルール表を読み込めませんでした: {path}") from e
+    return ServiceRules(config)
@@ -1,242 +1,357 @@
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from .constant import SERVICE_CODE_VALID_TIME_RANGES, MERGE_KEY_COLUMNS, CHECK_COLUMNS, MATCH_COLUMNS
-
-
-def merge_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame) -> pd.DataFrame:
+from .constant import (MERGE_KEY_COLUMNS, ENCODE_KEY_COLUMNS, CHECK_COLUMNS,
+                       RESULT_COLUMNS, VISIT_MATCH_TOLERANCE_MINUTES, SECTION_LABELS, SECTION_MISMATCHED,
+                       SECTION_CALENDAR_ONLY, SECTION_IBOW_ONLY, SECTION_MATCHED, CHECK_START_TIME_MISMATCH,
+                       CHECK_SERVICE_TIME_MISMATCH, CHECK_SERVICE_CODE_MISMATCH, CHECK_END_TIME_MISMATCH,
+                       CHECK_CALENDAR_END_TIME_RANGE, CHECK_IBOW_END_TIME_RANGE, CHECK_CALENDAR_SERVICE_TIME_RANGE,
+                       CHECK_IBOW_SERVICE_TIME_RANGE, CHECK_ADD_ON, CHECK_MISMATCH_MASK)
+from .format_dataframe import MINUTES_PER_DAY, render_dataframe
+from .service_rules import load_service_rules
+from .instrumentation import NULL_REPORT
+
+
+def encode_key_columns(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, columns: list = ENCODE_KEY_COLUMNS
+                       ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
-    2つのデータフレームを外部結合でマージする
+    結合キーの文字列カラムを、両方のデータフレームで共通のカテゴリを持つカテゴリ型に変換する
+    カテゴリは辞書順に並べるため、結合結果の並び順は文字列のまま結合した場合と変わらない
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :param columns: 変換するカラム名のリスト（デフォルトはENCODE_KEY_COLUMNS）
+    :return: 変換後のカレンダーのデータフレームとibowのデータフレーム
     """
-    return pd.merge(calendar_df, ibow_df, on=MERGE_KEY_COLUMNS, suffixes=('_カレンダー', '_Ibow'), how='outer')
-
-
-def filter_mismatched_data(merged_df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
+    calendar_keys, ibow_keys = {}, {}
+    for column in columns:
+        calendar_codes, calendar_uniques = pd.factorize(calendar_df[column])
+        ibow_codes, ibow_uniques = pd.factorize(ibow_df[column])
+        categories = pd.Index(calendar_uniques).union(pd.Index(ibow_uniques)).sort_values()
+        # ユニークな値ごとのコードを共通カテゴリのコードに読み替える（欠損値の-1はそのまま）
+        calendar_keys[column] = pd.Categorical.from_codes(
+            np.append(categories.get_indexer(calendar_uniques), -1)[calendar_codes], categories=categories)
+        ibow_keys[column] = pd.Categorical.from_codes(
+            np.append(categories.get_indexer(ibow_uniques), -1)[ibow_codes], categories=categories)
+    return calendar_df.assign(**calendar_keys), ibow_df.assign(**ibow_keys)
+
+
+def match_visits(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame,
+                 tolerance: int = VISIT_MATCH_TOLERANCE_MINUTES) -> tuple[np.ndarray, np.ndarray]:
     """
-    片方にしかないデータをフィルタリングする
+    同じ訪問日・利用者名・主訪問者の訪問どうしを、開始時間が最も近いものから1対1で対応付ける
+    開始時間の差がtolerance分を超える訪問、開始時間が欠損している訪問は対応付けない
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :param tolerance: 対応付ける開始時間の差の上限（分）
+    :return: 対応付けたカレンダーの行番号とibowの行番号の配列
     """
-    calendar_only_df = merged_df[merged_df[[col + '_Ibow' for col in MATCH_COLUMNS]].isnull().all(axis=1)]
-    ibow_only_df = merged_df[merged_df[[col + '_カレンダー' for col in MATCH_COLUMNS]].isnull().all(axis=1)]
-    return calendar_only_df, ibow_only_df
-
-
-def validate_service_time(service, time):
+    # 結合キーの組み合わせを両方のデータフレームで共通のグループ番号にする
+    keys = pd.concat([calendar_df[MERGE_KEY_COLUMNS], ibow_df[MERGE_KEY_COLUMNS]], ignore_index=True)
+    groups = keys.groupby(MERGE_KEY_COLUMNS, observed=True, dropna=False, sort=False).ngroup().to_numpy()
+
+    def _visits(df: pd.DataFrame, group: np.ndarray) -> pd.DataFrame:
+        visits = pd.DataFrame({'_group': group, '_row': np.arange(len(df)),
+                               '_start': df['開始時間'].to_numpy(dtype='float64', na_value=np.nan)})
+        return visits.dropna(subset=['_start']).astype({'_start': 'int64'})
+
+    calendar_visits = _visits(calendar_df, groups[:len(calendar_df)])
+    ibow_visits = _visits(ibow_df, groups[len(calendar_df):]).rename(columns={'_row': '_ibow_row'})
+    ibow_visits['_ibow_start'] = ibow_visits['_start']
+
+    calendar_rows, ibow_rows = [], []
+    while len(calendar_visits) and len(ibow_visits):
+        # 各カレンダーの訪問に、残っているIbowの訪問のうち開始時間が最も近いものを割り当てる
+        # （開始時間が同じ訪問は行の順に並べ、対応付けが他のグループの行に左右されないようにする）
+        candidates = pd.merge_asof(calendar_visits.sort_values('_start', kind='stable'),
+                                   ibow_visits.sort_values('_start', kind='stable'),
+                                   on='_start', by='_group', direction='nearest', tolerance=tolerance)
+        candidates = candidates.dropna(subset=['_ibow_row'])
+        if candidates.empty:
+            break
+
+        # 同じIbowの訪問が複数割り当てられた場合は、開始時間の差が最も小さいものだけを採用する
+        candidates['_distance'] = (candidates['_start'] - candidates['_ibow_start']).abs()
+        pairs = candidates.sort_values(['_distance', '_row'], kind='stable').drop_duplicates('_ibow_row')
+        calendar_rows.append(pairs['_row'].to_numpy())
+        ibow_rows.append(pairs['_ibow_row'].to_numpy(dtype=np.intp))
+
+        # 採用されなかった訪問は、残りの訪問の中から次に近いものを探す
+        calendar_visits = calendar_visits[~calendar_visits['_row'].isin(pairs['_row'])]
+        ibow_visits = ibow_visits[~ibow_visits['_ibow_row'].isin(pairs['_ibow_row'])]
+
+    if not calendar_rows:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    return np.concatenate(calendar_rows), np.concatenate(ibow_rows)
+
+
+def merge_dataframes(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, encode_keys: bool = True,
+                     match_by_time: bool = False, tolerance: int = VISIT_MATCH_TOLERANCE_MINUTES) -> pd.DataFrame:
     """
-    サービス内容と提供時間の整合性をチェックし、有効範囲を返す
-    :param service: サービス内容
-    :param time: 提供時間
-    :return: (bool, str) チェック結果と有効範囲の文字列
+    2つのデータフレームを外部結合でマージする
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :param encode_keys: 利用者名・主訪問者を共通の辞書でエンコードしてから結合するか
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+                          （Falseの場合はキーが一致するすべての組み合わせを結合する）
+    :param tolerance: match_by_timeの場合に対応付ける開始時間の差の上限（分）
+    :return: マージしたデータフレーム（エンコードしたキーはカテゴリ型のまま、結合元を示す_mergeカラム付き）
     """
-    # サービス内容がNaN（空の値）またはfloat型（不正な値）であれば、Falseを返す
-    if pd.isna(service) or isinstance(service, float):
-        return False, ""
-
-    # サービス内容が特定の文字列を含む場合、対応するキーを設定
-    if '基本療養費' in service:
-        key = '基本療養費'
-    elif '難病等複数回訪問' in service:
-        key = '難病等複数回訪問加算(２回)'
-    else:
-        key = service
+    if encode_keys:
+        calendar_df, ibow_df = encode_key_columns(calendar_df, ibow_df)
 
-    # 通常のサービスコードに基づく時間範囲チェック
-    if key not in SERVICE_CODE_VALID_TIME_RANGES:
-        return False, ""
+    if not match_by_time:
+        return pd.merge(calendar_df, ibow_df, on=MERGE_KEY_COLUMNS, suffixes=('_カレンダー', '_Ibow'), how='outer',
+                        indicator=True)
 
-    start, end = SERVICE_CODE_VALID_TIME_RANGES[key]
+    # 対応付けた訪問には同じ訪問番号、対応付けられなかった訪問には個別の訪問番号を振り、キーと訪問番号で結合する
+    calendar_rows, ibow_rows = match_visits(calendar_df, ibow_df, tolerance)
+    calendar_visit_ids = np.arange(len(calendar_df))
+    ibow_visit_ids = np.arange(len(calendar_df), len(calendar_df) + len(ibow_df))
+    ibow_visit_ids[ibow_rows] = calendar_rows
+    merged_df = pd.merge(calendar_df.assign(_visit=calendar_visit_ids), ibow_df.assign(_visit=ibow_visit_ids),
+                         on=MERGE_KEY_COLUMNS + ['_visit'], suffixes=('_カレンダー', '_Ibow'), how='outer', indicator=True)
+    return merged_df.drop(columns='_visit')
 
-    # Check if time is within the valid range
-    if start <= time <= end:
-        return True, f"{start}~{end}"
-    else:
-        return False, f"{start}~{end}"
 
-
-def validate_service_times(merged_df: pd.DataFrame) -> pd.DataFrame:
+def to_float_array(values: pd.Series) -> np.ndarray:
     """
-    サービス時間をチェックする
+    数値の列を欠損値をNaNとしたfloat64の配列に変換する
     """
-    # DataFrameのコピーを作成してから操作
-    merged_df = merged_df.copy()
-
-    merged_df.loc[:, 'カレンダー_サービス時間_match'], merged_df.loc[:, 'カレンダー_有効範囲'] = zip(*merged_df.apply(
-        lambda row: validate_service_time(row['サービス内容_カレンダー'], row['提供時間_カレンダー']), axis=1))
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
 
-    merged_df.loc[:, 'Ibow_サービス時間_match'], merged_df.loc[:, 'Ibow_有効範囲'] = zip(*merged_df.apply(
-        lambda row: validate_service_time(row['サービス内容_Ibow'], row['提供時間_Ibow']), axis=1))
 
-    return merged_df
+def validate_service_time(service_ids: np.ndarray, times: pd.Series) -> np.ndarray:
+    """
+    サービス内容と提供時間の整合性をチェックする
+    :param service_ids: サービスコードIDの配列
+    :param times: 提供時間の列
+    :return: チェック結果の配列
+    """
+    return load_service_rules().validate_minutes(service_ids, to_float_array(times))
 
 
-def validate_end_time(service, start_time, end_time):
+def validate_end_time(service_ids: np.ndarray, start_times: pd.Series, end_times: pd.Series) -> np.ndarray:
     """
     サービス内容に基づいて終了時間が有効範囲内かをチェックする
-    :param service: サービス内容
-    :param start_time: 開始時間 (フォーマット: "HH:MM")
-    :param end_time: 終了時間 (フォーマット: "HH:MM")
-    :return: (bool, str) チェック結果と有効範囲の文字列
+    :param service_ids: サービスコードIDの配列
+    :param start_times: 開始時間の列 (0時からの経過分数)
+    :param end_times: 終了時間の列 (0時からの経過分数)
+    :return: チェック結果の配列
     """
-    if pd.isna(service) or isinstance(service, float):
-        return False, ""
-
-    # サービス内容が特定の文字列を含む場合、対応するキーを設定
-    if '基本療養費' in service:
-        key = '基本療養費'
-    elif '難病等複数回訪問' in service:
-        key = '難病等複数回訪問加算(２回)'
-    else:
-        key = service
+    # 日付をまたぐ場合も含めて経過分数を計算する
+    duration_minutes = np.mod(to_float_array(end_times) - to_float_array(start_times), MINUTES_PER_DAY)
+    return load_service_rules().validate_minutes(service_ids, duration_minutes)
 
-    # 通常のサービスコードに基づく時間範囲チェック
-    if key not in SERVICE_CODE_VALID_TIME_RANGES:
-        return False, ""
 
-    start_minutes, end_minutes = SERVICE_CODE_VALID_TIME_RANGES[key]
-
-    # Convert start and end time to datetime objects
-    start_dt = datetime.strptime(start_time, "%H:%M")
-    end_dt = datetime.strptime(end_time, "%H:%M")
-
-    # Calculate duration in minutes
-    duration_minutes = (end_dt - start_dt).seconds / 60
-
-    # Check if duration is within valid range
-    if start_minutes <= int(duration_minutes) <= end_minutes:
-        return True, f"{start_minutes}~{end_minutes}"
-    else:
-        return False, f"{start_minutes}~{end_minutes}"
+def match_minutes(calendar_minutes: pd.Series, ibow_minutes: pd.Series) -> np.ndarray:
+    """
+    カレンダーとIbowの分数（時刻の経過分数・提供時間）が一致するかを判定する（欠損値は不一致）
+    """
+    return (calendar_minutes == ibow_minutes).fillna(False).to_numpy(dtype=bool)
 
 
-def check_columns(merged_df: pd.DataFrame) -> pd.DataFrame:
+def check_columns(merged_df: pd.DataFrame) -> None:
     """
-    一致判定用のカラムを追加する
+    一致判定を行い、満たさなかったルールをビットマスクとして検証結果カラムに記録する（merged_dfを直接更新する）
     """
-    # DataFrameのコピーを作成してから操作
-    validate_df = merged_df.copy()
+    results = np.zeros(len(merged_df), dtype=np.int16)
+
+    def _record(passed: np.ndarray, check: int) -> None:
+        results[~passed] |= check
+
+    rules = load_service_rules()
+    calendar_ids = rules.get_service_ids(merged_df['サービス内容_カレンダー'])
+    ibow_ids = rules.get_service_ids(merged_df['サービス内容_Ibow'])
 
     for column in CHECK_COLUMNS:
         if column == 'サービス内容':
-            validate_df.loc[:, column + '_match'] = validate_df.apply(
-                lambda row: (
-                    row[column + '_カレンダー'] == row[column + '_Ibow'] or
-                    (row[column + '_カレンダー'] == '医' and
-                     isinstance(row[column + '_Ibow'], str) and  # 型チェックを追加
-                     ('基本療養費' in row[column + '_Ibow'] or
-                      '難病等複数回訪問' in row[column + '_Ibow']))
-                ), axis=1)
+            # ルール表で同一とみなす組み合わせ（カレンダーの「医」とIbowの基本療養費など）も一致とする
+            _record((merged_df[column + '_カレンダー'] == merged_df[column + '_Ibow']).to_numpy() |
+                    rules.is_equivalent(calendar_ids, ibow_ids),
+                    CHECK_SERVICE_CODE_MISMATCH)
         elif column == "開始時間":
-            validate_df.loc[:, column + '_match'] = validate_df[column + '_カレンダー'] == validate_df[column + '_Ibow']
+            _record(match_minutes(merged_df[column + '_カレンダー'], merged_df[column + '_Ibow']),
+                    CHECK_START_TIME_MISMATCH)
         elif column == "終了時間":
-            validate_df.loc[:, column + '_match'] = validate_df[column + '_カレンダー'] == validate_df[column + '_Ibow']
-            validate_df.loc[:, '終了時間_カレンダー_match'], validate_df.loc[:, '終了時間_カレンダー_有効範囲'] = zip(*validate_df.apply(
-                lambda row: validate_end_time(
-                    row['サービス内容_カレンダー'],
-                    row['開始時間_カレンダー'],
-                    row['終了時間_カレンダー']
-                ), axis=1))
-            validate_df.loc[:, '終了時間_Ibow_match'], validate_df.loc[:, '終了時間_Ibow_有効範囲'] = zip(*validate_df.apply(
-                lambda row: validate_end_time(
-                    row['サービス内容_Ibow'],
-                    row['開始時間_Ibow'],
-                    row['終了時間_Ibow']
-                ), axis=1))
+            _record(match_minutes(merged_df[column + '_カレンダー'], merged_df[column + '_Ibow']),
+                    CHECK_END_TIME_MISMATCH)
+            _record(validate_end_time(calendar_ids, merged_df['開始時間_カレンダー'], merged_df['終了時間_カレンダー']),
+                    CHECK_CALENDAR_END_TIME_RANGE)
+            _record(validate_end_time(ibow_ids, merged_df['開始時間_Ibow'], merged_df['終了時間_Ibow']),
+                    CHECK_IBOW_END_TIME_RANGE)
         elif column == "提供時間":
-            validate_df.loc[:, column + '_match'] = validate_df[column + '_カレンダー'] == validate_df[column + '_Ibow']
-            validate_df = validate_service_times(validate_df)
+            _record(match_minutes(merged_df[column + '_カレンダー'], merged_df[column + '_Ibow']),
+                    CHECK_SERVICE_TIME_MISMATCH)
+            _record(validate_service_time(calendar_ids, merged_df['提供時間_カレンダー']),
+                    CHECK_CALENDAR_SERVICE_TIME_RANGE)
+            _record(validate_service_time(ibow_ids, merged_df['提供時間_Ibow']), CHECK_IBOW_SERVICE_TIME_RANGE)
         elif column == "加算":
-            validate_df.loc[:, '加算_check'] = validate_df[column].apply(lambda x: x == '通常')
-        else:
-            validate_df.loc[:, column + '_match'] = validate_df[column + '_カレンダー'] == validate_df[column + '_Ibow']
+            # カレンダーのみの行は加算フラグが欠損するため0として扱う
+            add_on_flags = merged_df['加算フラグ'].fillna(0).to_numpy(dtype=np.int64)
+            _record(rules.is_valid_add_on(add_on_flags), CHECK_ADD_ON)
 
-    return validate_df
+    merged_df['検証結果'] = results
 
 
-def mark_mismatches(merged_df: pd.DataFrame) -> pd.DataFrame:
+def categorize_rows(merged_df: pd.DataFrame) -> None:
     """
-    不整合データに❌マークを追加する
+    マージ結果の各行を区分（不整合データ・カレンダーのみ・Ibowのみ・整合データ）に分類し、区分カラムを追加する
     """
+    merge_indicator = merged_df.pop('_merge').to_numpy()
+    mismatched = (merged_df['検証結果'].to_numpy() & CHECK_MISMATCH_MASK) != 0
 
-    def mark_mismatch(row):
-        for column in MATCH_COLUMNS:
-            if row[column + '_match'] is False:
-                row[column + '_カレンダー'] = str(row[column + '_カレンダー']) + ' ❌'
-                row[column + '_Ibow'] = str(row[column + '_Ibow']) + ' ❌'
-        if row["終了時間_カレンダー_match"] is False:
-            row["終了時間_カレンダー"] = f"{row['終了時間_カレンダー']} ❌ ({row['終了時間_カレンダー_有効範囲']})"
-        if row["終了時間_Ibow_match"] is False:
-            row["終了時間_Ibow"] = f"{row['終了時間_Ibow']} ❌ ({row['終了時間_Ibow_有効範囲']})"
-        if row['カレンダー_サービス時間_match'] is False:
-            row['提供時間_カレンダー'] = f"{row['提供時間_カレンダー']}  ❌ ({row['カレンダー_有効範囲']})"
-        if row['Ibow_サービス時間_match'] is False:
-            row['提供時間_Ibow'] = f"{row['提供時間_Ibow']} ❌ ({row['Ibow_有効範囲']})"
-        if row['加算_check'] is False:
-            row['加算'] = f"{row['加算']} ※"
-        return row
-
-    mismatched_df = merged_df[(merged_df['開始時間_match'] == False) |
-                              (merged_df['終了時間_カレンダー_match'] == False) |
-                              (merged_df['終了時間_Ibow_match'] == False) |
-                              (merged_df['サービス内容_match'] == False) |
-                              (merged_df['カレンダー_サービス時間_match'] == False) |
-                              (merged_df["加算_check"] == False) |
-                              (merged_df['Ibow_サービス時間_match'] == False)].apply(mark_mismatch, axis=1)
-    return mismatched_df
+    sections = np.where(mismatched, SECTION_MISMATCHED, SECTION_MATCHED)
+    sections[merge_indicator == 'left_only'] = SECTION_CALENDAR_ONLY
+    sections[merge_indicator == 'right_only'] = SECTION_IBOW_ONLY
+    merged_df['区分'] = sections.astype(np.int8)
 
 
-def create_boundary_dataframe(label: str, columns: list) -> pd.DataFrame:
+def append_text(df: pd.DataFrame, rows: np.ndarray, column: str, text) -> None:
     """
-    境界データフレームを作成する
+    指定した行のカラムの値の末尾に文字列を追加する（df を直接更新する）
+    :param df: DataFrame
+    :param rows: 対象の行を示すboolの配列
+    :param column: カラム名
+    :param text: 追加する文字列（行ごとに異なる場合は行数分の配列）
     """
-    boundary_df = pd.DataFrame({col: ['---'] for col in columns})
-    boundary_df['訪問日'] = label
-    return boundary_df
-
-
-def merge_and_validate(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame) -> pd.DataFrame:
-    merged_df = merge_dataframes(calendar_df, ibow_df)
-
-    calendar_only_df, ibow_only_df = filter_mismatched_data(merged_df)
+    if column not in df.columns or not rows.any():
+        return
+    if df[column].dtype != object:
+        df[column] = df[column].astype(object)
+    if not isinstance(text, str):
+        text = text[rows]
+    df.loc[rows, column] = df.loc[rows, column].astype(str) + text
 
-    # matchしているデータのみ抽出
-    merged_df = merged_df[~(merged_df.index.isin(calendar_only_df.index) | merged_df.index.isin(ibow_only_df.index))]
-
-    # データのvalidation
-    validate_df = check_columns(merged_df)
 
+def mark_mismatches(display_df: pd.DataFrame, results: np.ndarray, sections: np.ndarray,
+                    valid_ranges: dict) -> None:
+    """
+    不整合データに❌マークを追加する
+    """
+    mismatched = sections == SECTION_MISMATCHED
+
+    def _failed(check: int) -> np.ndarray:
+        return mismatched & ((results & check) != 0)
+
+    for column, check in [('開始時間', CHECK_START_TIME_MISMATCH),
+                          ('提供時間', CHECK_SERVICE_TIME_MISMATCH),
+                          ('サービス内容', CHECK_SERVICE_CODE_MISMATCH)]:
+        append_text(display_df, _failed(check), column + '_カレンダー', ' ❌')
+        append_text(display_df, _failed(check), column + '_Ibow', ' ❌')
+    append_text(display_df, _failed(CHECK_CALENDAR_END_TIME_RANGE), '終了時間_カレンダー',
+                ' ❌ (' + valid_ranges['カレンダー'] + ')')
+    append_text(display_df, _failed(CHECK_IBOW_END_TIME_RANGE), '終了時間_Ibow', ' ❌ (' + valid_ranges['Ibow'] + ')')
+    append_text(display_df, _failed(CHECK_CALENDAR_SERVICE_TIME_RANGE), '提供時間_カレンダー',
+                '  ❌ (' + valid_ranges['カレンダー'] + ')')
+    append_text(display_df, _failed(CHECK_IBOW_SERVICE_TIME_RANGE), '提供時間_Ibow',
+                ' ❌ (' + valid_ranges['Ibow'] + ')')
+    append_text(display_df, _failed(CHECK_ADD_ON), '加算', ' ※')
+
+
+def mark_matches(display_df: pd.DataFrame, results: np.ndarray, sections: np.ndarray, valid_ranges: dict) -> None:
+    """
+    整合データのうち、カレンダーとIbowで値は異なるが有効範囲内のものに※マークを追加する
+    """
+    matched = sections == SECTION_MATCHED
 
+    rows = matched & ((results & CHECK_SERVICE_TIME_MISMATCH) != 0)
+    append_text(display_df, rows, '提供時間_カレンダー', ' ※ (' + valid_ranges['カレンダー'] + ')')
+    append_text(display_df, rows, '提供時間_Ibow', ' ※ (' + valid_ranges['Ibow'] + ')')
 
-    # 不整合データにマークを追加
-    mismatched_df = mark_mismatches(validate_df)
+    rows = matched & ((results & CHECK_END_TIME_MISMATCH) != 0)
+    append_text(display_df, rows, '終了時間_カレンダー', ' ※')
+    append_text(display_df, rows, '終了時間_Ibow', ' ※')
 
 
-    print(validate_df.columns)
+def create_boundary_dataframe(label: str, columns: list) -> pd.DataFrame:
+    """
+    境界データフレームを作成する
+    """
+    boundary_df = pd.DataFrame({col: ['---'] for col in columns})
+    boundary_df['訪問日'] = label
+    return boundary_df
 
-    def mark_match(row):
-        if row["提供時間_match"] is False and row["カレンダー_サービス時間_match"] is True and row["Ibow_サービス時間_match"] is True:
-            row["提供時間_カレンダー"] = f"{row['提供時間_カレンダー']} ※ ({row['カレンダー_有効範囲']})"
-            row["提供時間_Ibow"] = f"{row['提供時間_Ibow']} ※ ({row['Ibow_有効範囲']})"
-        if row["終了時間_match"] is False and row["終了時間_Ibow_match"] is True and row["終了時間_カレンダー_match"] is True:
-            row["終了時間_カレンダー"] = f"{row['終了時間_カレンダー']} ※"
-            row["終了時間_Ibow"] = f"{row['終了時間_Ibow']} ※"
 
-        return row
-    # 整合データの抽出
-    matched_df = validate_df[(validate_df['開始時間_match'] == True) &
-                             (validate_df['サービス内容_match'] == True) &
-                             (validate_df['終了時間_カレンダー_match'] == True) &
-                             (validate_df['終了時間_Ibow_match'] == True) &
-                             (validate_df['カレンダー_サービス時間_match'] == True) &
-                             (validate_df['Ibow_サービス時間_match'] == True) &
-                             (validate_df["加算_check"] == True)].apply(mark_match, axis=1)
+def get_valid_ranges(results_df: pd.DataFrame) -> dict:
+    """
+    照合結果の各行のサービスの有効範囲の表示をカレンダー・Ibowごとに返す（❌・※の注記に使う）
+    """
+    rules = load_service_rules()
+    return {source: rules.get_valid_ranges(rules.get_service_ids(results_df[f'サービス内容_{source}']))
+            for source in ['カレンダー', 'Ibow']}
 
-    # 境界データフレームの作成
-    boundary_mismatched_df = create_boundary_dataframe('不整合データ', merged_df.columns)
-    boundary_matched_df = create_boundary_dataframe('整合データ', merged_df.columns)
-    boundary_calendar_only_df = create_boundary_dataframe('カレンダーのみ', merged_df.columns)
-    boundary_ibow_only_df = create_boundary_dataframe('Ibowのみ', merged_df.columns)
 
-    # 最終的なデータフレームの作成
-    final_df = pd.concat([boundary_mismatched_df, mismatched_df,
-                          boundary_calendar_only_df, calendar_only_df,
-                          boundary_ibow_only_df, ibow_only_df,
-                          boundary_matched_df, matched_df], ignore_index=True)
-    return final_df
+def render_results(results_df: pd.DataFrame, columns: list = RESULT_COLUMNS, boundaries: bool = True,
+                   report=NULL_REPORT) -> pd.DataFrame:
+    """
+    照合結果を表示用のデータフレームに変換する
+    時刻・日付を表示形式に変換し、検証結果のビットマスクから❌・※の注記を付ける
+    GUIやCSVで実際に出力する行だけを渡せばよい
+    :param results_df: merge_and_validateの照合結果（またはその一部の行）
+    :param columns: 出力するカラム名のリスト（デフォルトはRESULT_COLUMNS）
+    :param boundaries: 区分ごとに境界行を挟むか
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+    :return: 表示用のデータフレーム
+    """
+    sections = results_df['区分'].to_numpy()
+    with report.stage('mark', rows_in=len(results_df)) as stage:
+        display_df = results_df[columns].copy()
+        render_dataframe(display_df)
+
+        results = results_df['検証結果'].to_numpy()
+        valid_ranges = get_valid_ranges(results_df)
+        mark_mismatches(display_df, results, sections, valid_ranges)
+        mark_matches(display_df, results, sections, valid_ranges)
+        stage.rows_out = len(display_df)
+
+    if not boundaries:
+        return display_df.reset_index(drop=True)
+    with report.stage('concat', rows_in=len(display_df)) as stage:
+        display_df = insert_boundaries(display_df, sections)
+        stage.rows_out = len(display_df)
+    return display_df
+
+
+def insert_boundaries(display_df: pd.DataFrame, sections: np.ndarray) -> pd.DataFrame:
+    """
+    区分ごとに境界行を挟む（照合結果は区分の順に並んでいる）
+    :param display_df: 表示用のデータフレーム
+    :param sections: 各行の区分の配列
+    :return: 境界行を挟んだデータフレーム（attrs['boundary_rows']に境界行の位置を区分の順に記録する）
+    """
+    section_starts = np.searchsorted(sections, np.arange(len(SECTION_LABELS) + 1))
+    parts = []
+    for section, label in enumerate(SECTION_LABELS):
+        parts.append(create_boundary_dataframe(label, list(display_df.columns)))
+        parts.append(display_df.iloc[section_starts[section]:section_starts[section + 1]])
+    display_df = pd.concat(parts, ignore_index=True)
+    # 各区分の境界行は、その区分の先頭の行の位置にそれより前に挟んだ境界行の数を足した位置にある
+    # （訪問日の値では判定しないため、区分の名前と同じ値の行があっても境界行とはみなさない）
+    display_df.attrs['boundary_rows'] = tuple(int(start) + section
+                                              for section, start in enumerate(section_starts[:-1]))
+    return display_df
+
+
+def merge_and_validate(calendar_df: pd.DataFrame, ibow_df: pd.DataFrame, match_by_time: bool = False,
+                       report=NULL_REPORT) -> pd.DataFrame:
+    """
+    カレンダーとibowのデータフレームをマージして照合する
+    :param calendar_df: カレンダーのデータフレーム
+    :param ibow_df: ibowのデータフレーム
+    :param match_by_time: 同じキーの訪問を開始時間の近いものどうしで1対1に対応付けるか
+    :param report: ステージごとの計測結果を記録するレポート（デフォルトは計測しない）
+    :return: 照合結果（値は内部表現のまま、検証結果・区分カラム付きで区分の順に並べたもの）
+    """
+    with report.stage('merge', rows_in=len(calendar_df) + len(ibow_df)) as stage:
+        validate_df = merge_dataframes(calendar_df, ibow_df, match_by_time=match_by_time)
+        stage.rows_out = len(validate_df)
+
+    # データのvalidationと区分の分類（1つのデータフレームを直接更新する）
+    with report.stage('check', rows_in=len(validate_df)) as stage:
+        check_columns(validate_df)
+        categorize_rows(validate_df)
+
+        # 区分の順に並べ替える（区分内の行の順序はマージ結果の順序のまま）
+        order = np.argsort(validate_df['区分'].to_numpy(), kind='stable')
+        validate_df = validate_df.take(order).reset_index(drop=True)
+        stage.rows_out = len(validate_df)
+    return validate_df
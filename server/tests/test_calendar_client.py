@@ -0,0 +1,137 @@
+import gzip
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from server.libs import calendar_client
+from server.libs.calendar_client import CalendarClient, CalendarHTTPError, CalendarTimeoutError
+
+CSV = "訪問日,利用者名\n2024/05/01,利用者1\n2024/05/02,利用者2\n".encode('utf-8')
+# タイムアウトを確かめる際に、クライアントの読み込みのタイムアウトより長く待つ秒数
+STALL_SECONDS = 1
+
+
+class CalendarHandler(BaseHTTPRequestHandler):
+    """
+    GASのエンドポイントの代わりに、パスごとに決まったレスポンスを返す
+    """
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requests[path] += 1
+        if path == '/gzip':
+            self.send_csv(gzip.compress(CSV), {'Content-Encoding': 'gzip'})
+        elif path == '/not_found':
+            self.send_error(404)
+        elif path == '/unavailable':
+            # 最初の2回だけ503を返し、3回目に成功する
+            if self.server.requests[path] <= 2:
+                self.send_error(503)
+            else:
+                self.send_csv(CSV)
+        elif path == '/slow_header':
+            self.server.released.wait(STALL_SECONDS)
+            self.send_csv(CSV)
+        elif path == '/slow_body':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(CSV)))
+            self.end_headers()
+            self.wfile.write(CSV[:10])
+            self.wfile.flush()
+            self.server.released.wait(STALL_SECONDS)
+        else:
+            self.send_csv(CSV)
+
+    def send_csv(self, body: bytes, headers: dict = None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CalendarHandler)
+    server.daemon_threads = True
+    server.block_on_close = False
+    server.requests = Counter()
+    # 待っているリクエストを終了時にすぐ返す（再試行の待ち時間はtime.sleepを置き換えるため、こちらはEventで待つ）
+    server.released = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.released.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # 再試行の待ち時間を記録し、実際には待たない
+    sleeps = []
+    monkeypatch.setattr(calendar_client.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def get_url(server, path: str) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_gzip_response_is_decoded(server, sleeps):
+    client = CalendarClient()
+
+    calendar_df = client.fetch_csv(get_url(server, '/gzip'))
+
+    assert calendar_df['利用者名'].tolist() == ['利用者1', '利用者2']
+    assert server.requests['/gzip'] == 1
+
+
+def test_not_found_is_not_retried(server, sleeps):
+    client = CalendarClient(max_retries=3)
+
+    with pytest.raises(CalendarHTTPError) as e:
+        client.fetch_csv(get_url(server, '/not_found'))
+
+    assert e.value.status_code == 404
+    assert server.requests['/not_found'] == 1
+    assert sleeps == []
+
+
+def test_unavailable_is_retried_with_backoff(server, sleeps):
+    client = CalendarClient(max_retries=3, backoff_factor=0.5, backoff_max=8)
+
+    calendar_df = client.fetch_csv(get_url(server, '/unavailable'))
+
+    assert len(calendar_df) == 2
+    assert server.requests['/unavailable'] == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_unavailable_raises_after_max_retries(server, sleeps):
+    client = CalendarClient(max_retries=1, backoff_factor=0.5)
+
+    with pytest.raises(CalendarHTTPError) as e:
+        client.fetch_csv(get_url(server, '/unavailable'))
+
+    assert e.value.status_code == 503
+    assert server.requests['/unavailable'] == 2
+    assert sleeps == [0.5]
+
+
+@pytest.mark.parametrize('path', ['/slow_header', '/slow_body'])
+def test_timeout_raises_calendar_timeout_error(server, sleeps, path):
+    client = CalendarClient(read_timeout=0.2, max_retries=1)
+
+    with pytest.raises(CalendarTimeoutError):
+        client.fetch_csv(get_url(server, path))
+
+    # タイムアウトも再試行する
+    assert server.requests[path] == 2
+    assert len(sleeps) == 1
@@ -0,0 +1,84 @@
+import importlib.util
+import pandas as pd
+import pytest
+from server.libs import get_dataframe
+from server.libs.calendar_snapshot import CalendarSnapshotStore, SNAPSHOT_FORMATS
+from server.libs.format_dataframe import format_calendar_dataframe
+from server.libs.service_rules import load_service_rules
+
+CALENDAR_DF = pd.DataFrame({
+    '訪問日': ['2024/05/02', '2024/05/01', '2024/05/01', 'abc'],
+    '利用者名': ['利用者1　太郎', '利用者2 太郎', '利用者1　太郎', '利用者3　太郎'],
+    '開始時間': ['9:00', '10:00', '11:00', '12:00'],
+    '終了時間': ['9:30', '10:30', '11:30', '12:30'],
+    '提供時間': [30, 30, 30, 30],
+    'サービス内容': ['訪看I５・２超', '訪看Ⅰ２', '医', '訪看I5'],
+    '主訪問者': ['佐藤　一郎', '佐藤 一郎', '山田 花子', '山田 花子'],
+})
+DATE_RANGE = (pd.Timestamp('2024-05-01'), pd.Timestamp('2024-05-31'))
+
+FORMATS = ['npy', pytest.param('feather', marks=pytest.mark.skipif(
+    importlib.util.find_spec('pyarrow') is None, reason='pyarrowがインストールされていない'))]
+
+
+def formatted_calendar() -> pd.DataFrame:
+    return format_calendar_dataframe(CALENDAR_DF.iloc[:3].copy())
+
+
+@pytest.mark.parametrize('snapshot_format', FORMATS)
+def test_round_trip_keeps_values_dtypes_and_index(tmp_path, snapshot_format):
+    write, read = SNAPSHOT_FORMATS[snapshot_format]
+    df = formatted_calendar()
+    write(df, tmp_path / 'snapshot')
+
+    restored = read(tmp_path / 'snapshot')
+
+    pd.testing.assert_frame_equal(restored, df)
+
+
+@pytest.mark.parametrize('snapshot_format', FORMATS)
+def test_load_reuses_snapshot_and_rebuilds_corrupt_file(tmp_path, monkeypatch, snapshot_format):
+    fetches = []
+    monkeypatch.setattr(get_dataframe, 'load_calendar_csv',
+                        lambda *args, **kwargs: fetches.append(args) or CALENDAR_DF.iloc[:3].copy())
+    store = CalendarSnapshotStore(tmp_path, snapshot_format=snapshot_format)
+
+    first = store.load('http://calendar.invalid', DATE_RANGE)
+    # 別のプロセスを想定し、新しいストアで保存したスナップショットを開く
+    second = CalendarSnapshotStore(tmp_path, snapshot_format=snapshot_format).load('http://calendar.invalid',
+                                                                                    DATE_RANGE)
+
+    pd.testing.assert_frame_equal(first, formatted_calendar())
+    pd.testing.assert_frame_equal(second, first)
+    assert second.attrs['fingerprint'] == first.attrs['fingerprint']
+    assert len(fetches) == 1
+
+    key = store.get_key('http://calendar.invalid', DATE_RANGE, load_service_rules())
+    data_path = store.get_data_path(store.read_metadata(key))
+    # Featherは開いたデータフレームがファイルを参照するため、上書きせずに別のファイルに置き換えて壊す
+    broken_path = data_path / 'codes.npy' if data_path.is_dir() else data_path
+    broken_path.unlink()
+    broken_path.write_bytes(b'broken')
+    rebuilt = CalendarSnapshotStore(tmp_path, snapshot_format=snapshot_format).load('http://calendar.invalid',
+                                                                                     DATE_RANGE)
+
+    pd.testing.assert_frame_equal(rebuilt, formatted_calendar())
+    pd.testing.assert_frame_equal(first, formatted_calendar())
+    assert len(fetches) == 2
+
+
+def test_stale_source_snapshot_keeps_its_age(tmp_path, monkeypatch):
+    # エンドポイントが落ちていて、カレンダーのキャッシュが1日前のスナップショットを返した場合
+    def load_stale_calendar(*args, **kwargs):
+        calendar_df = CALENDAR_DF.iloc[:3].copy()
+        calendar_df.attrs['calendar_snapshot'] = {'url': 'http://calendar.invalid', 'fetched_at': '2024-05-01T00:00:00',
+                                                  'age_seconds': 86400, 'stale': True}
+        return calendar_df
+
+    monkeypatch.setattr(get_dataframe, 'load_calendar_csv', load_stale_calendar)
+    store = CalendarSnapshotStore(tmp_path, snapshot_format='npy')
+
+    snapshot = store.load('http://calendar.invalid', DATE_RANGE).attrs['calendar_snapshot']
+
+    assert snapshot['age_seconds'] >= 86400
+    assert snapshot['stale'] is True
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+from server.libs import get_dataframe
+from server.libs.constant import CALENDAR_PARAM_CALENDAR_ID
+from server.libs.get_dataframe import fetch_calendars
+
+
+def test_duplicates_across_calendars_are_removed_regardless_of_dtype(monkeypatch):
+    calendars = {
+        # 提供時間に欠損値があるため浮動小数点数になるカレンダー
+        'a': pd.DataFrame({'訪問日': ['2024/05/01', '2024/05/02'], '利用者名': ['利用者1', '利用者2'],
+                           '提供時間': [30, np.nan]}),
+        # 整数のままのカレンダー（1行目はaと同じ予定、同じカレンダー内の同じ行は残す）
+        'b': pd.DataFrame({'訪問日': ['2024/05/01', '2024/05/03', '2024/05/03'],
+                           '利用者名': ['利用者1', '利用者3', '利用者3'], '提供時間': [30, 60, 60]}),
+    }
+    assert calendars['a']['提供時間'].dtype != calendars['b']['提供時間'].dtype
+    monkeypatch.setattr(get_dataframe, 'fetch_calendar_csv',
+                        lambda url, use_cache, params: calendars[params[CALENDAR_PARAM_CALENDAR_ID]].copy())
+
+    calendar_df = fetch_calendars('http://calendar.invalid', ['a', 'b'], use_cache=False)
+
+    assert calendar_df['利用者名'].tolist() == ['利用者1', '利用者2', '利用者3', '利用者3']
+    assert calendar_df.index.tolist() == [0, 1, 2, 3]
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from server.libs.constant import SECTION_LABELS, SECTION_MISMATCHED, SECTION_IBOW_ONLY, SECTION_MATCHED
+from server.libs.result_cache import ResultCache
+from server.libs.validate_dataframe import insert_boundaries
+
+
+def make_display_df() -> tuple[pd.DataFrame, np.ndarray]:
+    # 訪問日に区分の名前と同じ値があっても境界行とはみなさない
+    display_df = pd.DataFrame({'訪問日': ['2024/05/01', 'Ibowのみ', '2024/05/02', '2024/05/03'],
+                               '利用者名': ['利用者1', '利用者2', '利用者3', '利用者4']})
+    sections = np.array([SECTION_MISMATCHED, SECTION_MISMATCHED, SECTION_IBOW_ONLY, SECTION_MATCHED])
+    return display_df, sections
+
+
+def test_boundary_rows_are_recorded_from_sections():
+    display_df, sections = make_display_df()
+
+    result_df = insert_boundaries(display_df, sections)
+
+    boundary_rows = list(result_df.attrs['boundary_rows'])
+    assert boundary_rows == [0, 3, 4, 6]
+    assert result_df['訪問日'].iloc[boundary_rows].tolist() == SECTION_LABELS
+    assert result_df['利用者名'].iloc[2] == '利用者2'
+
+
+def test_boundary_rows_survive_result_cache(tmp_path):
+    display_df, sections = make_display_df()
+    result_df = insert_boundaries(display_df, sections)
+    cache = ResultCache(tmp_path)
+
+    cache.put('key', result_df)
+    cached_df = cache.get('key')
+
+    assert cached_df.equals(result_df)
+    assert cached_df.attrs['boundary_rows'] == result_df.attrs['boundary_rows']
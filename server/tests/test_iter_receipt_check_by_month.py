@@ -0,0 +1,39 @@
+import pandas as pd
+import pytest
+from server.libs import get_dataframe
+from server.libs.receipt_check import iter_receipt_check_by_month
+from server.libs.partition import UNKNOWN_MONTH
+from server.libs.constant import SECTION_LABELS
+
+IBOW_CSV = """訪問日,利用者名,開始時間,終了時間,提供時間,サービス内容,主訪問者,加算①,加算②,加算③,加算④,加算⑤
+2024/05/01,利用者1　太郎,9:00,9:30,30,訪看I５・２超,佐藤 一郎,,,,,
+abc,利用者2　太郎,10:00,10:30,30,訪看I５・２超,佐藤 一郎,,,,,
+,利用者3　太郎,11:00,11:30,30,訪看I５・２超,佐藤 一郎,,,,,
+"""
+
+CALENDAR_DF = pd.DataFrame({
+    '訪問日': ['2024/05/01'], '利用者名': ['利用者1　太郎'], '開始時間': ['9:00'], '終了時間': ['9:30'],
+    '提供時間': [30], 'サービス内容': ['訪看I５・２超'], '主訪問者': ['佐藤 一郎'],
+})
+
+
+@pytest.fixture
+def receipt_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_dataframe, 'load_calendar_csv', lambda *args, **kwargs: CALENDAR_DF.copy())
+    path = tmp_path / 'ibow.csv'
+    path.write_text(IBOW_CSV, encoding='utf-8')
+    return path
+
+
+def test_unreadable_visit_dates_are_ibow_only(receipt_file):
+    results = dict(iter_receipt_check_by_month(receipt_file))
+
+    assert list(results) == ['2024-05', UNKNOWN_MONTH]
+    unknown_df = results[UNKNOWN_MONTH]
+    # 境界行を除くと、訪問日が読めない行（abc）と欠損している行の2行がIbowのみになる
+    boundary_rows = list(unknown_df.attrs['boundary_rows'])
+    assert unknown_df['訪問日'].iloc[boundary_rows].tolist() == SECTION_LABELS
+    ibow_only = boundary_rows[SECTION_LABELS.index('Ibowのみ')]
+    rows = unknown_df.iloc[ibow_only + 1:boundary_rows[SECTION_LABELS.index('整合データ')]]
+    assert sorted(rows['利用者名']) == ['利用者2太郎', '利用者3太郎']
+    assert (rows['サービス内容_カレンダー'] == 'データなし').all()
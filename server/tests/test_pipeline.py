@@ -0,0 +1,63 @@
+from collections import Counter
+from server.libs.instrumentation import PipelineReport
+from server.libs.pipeline import Pipeline, Stage
+
+
+class DictCache:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def put(self, key, value):
+        self.values[key] = value
+
+
+def build_pipeline(calls: Counter, disk_cache=None) -> Pipeline:
+    def stage(name, func):
+        def run(*args):
+            calls[name] += 1
+            return func(*args)
+        return run
+
+    return Pipeline([
+        Stage('source', stage('source', lambda path: path.upper()), inputs=['path']),
+        Stage('version', stage('version', lambda: 'v1'), volatile=True),
+        Stage('parsed', stage('parsed', lambda source: source + '!'), inputs=['source']),
+        Stage('result', stage('result', lambda parsed, version: f"{parsed}{version}"), inputs=['parsed', 'version'],
+              persist=True),
+    ], disk_cache=disk_cache)
+
+
+def test_disk_hit_skips_upstream_stages():
+    calls, disk_cache = Counter(), DictCache()
+    assert build_pipeline(calls, disk_cache).get('result', path='a') == 'A!v1'
+    assert calls == {'source': 1, 'parsed': 1, 'version': 1, 'result': 1}
+
+    # 別のプロセスを想定し、メモのない新しいパイプラインでディスクのキャッシュを使う
+    calls.clear()
+    report = PipelineReport()
+    assert build_pipeline(calls, disk_cache).get('result', report=report, path='a') == 'A!v1'
+
+    # キーを求めるためにvolatileのステージだけを実行し、上流のステージは実行しない
+    assert calls == {'version': 1}
+    assert [stage.name for stage in report.stages] == ['version', 'result_cache']
+
+
+def test_memo_reruns_only_changed_stages():
+    calls = Counter()
+    pipeline = build_pipeline(calls)
+    pipeline.get('result', path='a')
+    calls.clear()
+
+    assert pipeline.get('parsed', path='a') == 'A!'
+    assert pipeline.get('result', path='b') == 'B!v1'
+    assert calls == {'source': 1, 'parsed': 1, 'version': 1, 'result': 1}
+
+
+def test_intermediate_stage_computes_only_its_inputs():
+    calls = Counter()
+
+    assert build_pipeline(calls).get('source', path='a') == 'A'
+    assert calls == {'source': 1}
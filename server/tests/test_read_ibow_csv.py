@@ -0,0 +1,54 @@
+import importlib.util
+import pytest
+from server.libs.constant import USE_IBOW_COLUMNS, IBOW_DTYPES
+from server.libs.get_dataframe import read_ibow_csv, read_csv_columns
+
+IBOW_CSV = """訪問日,利用者名,開始時間,終了時間,提供時間,サービス内容,主訪問者,加算①,加算②,加算③,加算④,加算⑤
+2024/05/01,利用者1　太郎,9:00,9:30,30,訪看I５・２超,佐藤 一郎,通常,,,,
+2024/05/02,利用者2　太郎,10:00,10:30,30,,山田 花子,,,,,
+"""
+
+ENGINES = ['c', pytest.param('pyarrow', marks=pytest.mark.skipif(
+    importlib.util.find_spec('pyarrow') is None, reason='pyarrowがインストールされていない'))]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_values_are_read_as_written(tmp_path, engine):
+    path = tmp_path / 'ibow.csv'
+    path.write_text(IBOW_CSV, encoding='utf-8')
+
+    ibow_df = read_ibow_csv(path, engine=engine)
+
+    # 時刻に見える値も推定した型に変換せず、書かれたとおりの文字列のカテゴリ型にする
+    assert ibow_df['開始時間'].tolist() == ['9:00', '10:00']
+    assert ibow_df['開始時間'].dtype == 'category'
+    assert ibow_df['サービス内容'].isna().tolist() == [False, True]
+    assert ibow_df['加算①'].isna().tolist() == [False, True]
+    assert ibow_df['提供時間'].tolist() == [30, 30]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_cp932_file_matches_utf8_file(tmp_path, engine):
+    utf8_path, cp932_path = tmp_path / 'utf8.csv', tmp_path / 'cp932.csv'
+    utf8_path.write_text(IBOW_CSV, encoding='utf-8')
+    cp932_path.write_text(IBOW_CSV, encoding='cp932')
+
+    assert read_ibow_csv(cp932_path, engine=engine).equals(read_ibow_csv(utf8_path, engine=engine))
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_wrong_encoding_raises_unicode_decode_error(tmp_path, engine):
+    # read_ibow_csvはUnicodeDecodeErrorの場合にcp932で読み直すため、どのエンジンでも同じ例外にする
+    path = tmp_path / 'cp932.csv'
+    path.write_text(IBOW_CSV, encoding='cp932')
+
+    with pytest.raises(UnicodeDecodeError):
+        read_csv_columns(path, 'utf-8', USE_IBOW_COLUMNS, IBOW_DTYPES, engine)
+
+
+def test_undecodable_file_is_rejected(tmp_path):
+    path = tmp_path / 'binary.csv'
+    path.write_bytes(IBOW_CSV.encode('utf-8').splitlines()[0] + b'\n' + bytes(range(128, 256)) * 4)
+
+    with pytest.raises(ValueError, match='Shift_JIS'):
+        read_ibow_csv(path)
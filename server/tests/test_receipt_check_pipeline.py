@@ -0,0 +1,73 @@
+import pandas as pd
+import pytest
+from server.libs import get_dataframe
+from server.libs.instrumentation import PipelineReport
+from server.libs.receipt_check import build_receipt_check_pipeline
+from server.libs.result_cache import ResultCache
+
+IBOW_CSV = """訪問日,利用者名,開始時間,終了時間,提供時間,サービス内容,主訪問者,加算①,加算②,加算③,加算④,加算⑤
+2024/05/01,利用者1　太郎,9:00,9:30,30,訪看I５・２超,佐藤 一郎,,,,,
+2024/05/02,利用者2　太郎,10:00,10:30,30,訪看I５・２超,佐藤 一郎,,,,,
+"""
+
+CALENDAR_DF = pd.DataFrame({
+    '訪問日': ['2024/05/01'], '利用者名': ['利用者1　太郎'], '開始時間': ['9:00'], '終了時間': ['9:30'],
+    '提供時間': [30], 'サービス内容': ['訪看I５・２超'], '主訪問者': ['佐藤 一郎'],
+})
+
+
+@pytest.fixture
+def receipt_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_dataframe, 'load_calendar_csv', lambda *args, **kwargs: CALENDAR_DF.copy())
+    path = tmp_path / 'ibow.csv'
+    path.write_text(IBOW_CSV, encoding='utf-8')
+    return path
+
+
+def get_results(receipt_file, disk_cache) -> tuple[pd.DataFrame, list]:
+    # GUIを開き直した場合を想定し、メモのない新しいパイプラインで照合する
+    pipeline = build_receipt_check_pipeline(disk_cache=disk_cache)
+    report = PipelineReport()
+    results_df = pipeline.get('results', report=report, receipt_file=receipt_file,
+                              calendar_gas_api_url='http://calendar.invalid', use_cache=False, match_by_time=False)
+    return results_df, [stage.name for stage in report.stages]
+
+
+def test_disk_hit_does_not_read_ibow(receipt_file, tmp_path):
+    disk_cache = ResultCache(tmp_path / 'result_cache')
+    first_df, first_stages = get_results(receipt_file, disk_cache)
+    assert 'ibow' in first_stages
+
+    second_df, second_stages = get_results(receipt_file, disk_cache)
+
+    pd.testing.assert_frame_equal(second_df, first_df)
+    assert second_df.attrs['boundary_rows'] == first_df.attrs['boundary_rows']
+    # 照合結果のキーはIbowのファイルのハッシュ・カレンダー・ルール表から求め、Ibowは読み込まない
+    assert not {'date_range', 'ibow', 'ibow_formatted', 'results'} & set(second_stages)
+    assert {'date_range_cache', 'results_cache'} <= set(second_stages)
+
+
+def test_changed_ibow_misses_disk_cache(receipt_file, tmp_path):
+    disk_cache = ResultCache(tmp_path / 'result_cache')
+    get_results(receipt_file, disk_cache)
+    receipt_file.write_text(IBOW_CSV.replace('10:00', '10:15'), encoding='utf-8')
+
+    results_df, stages = get_results(receipt_file, disk_cache)
+
+    assert {'ibow', 'results'} <= set(stages)
+    assert '10:15' in results_df['開始時間_Ibow'].tolist()
+
+
+def test_results_render_from_validated(receipt_file):
+    pipeline = build_receipt_check_pipeline()
+    report = PipelineReport()
+    with pipeline.run(report=report, receipt_file=receipt_file, calendar_gas_api_url='http://calendar.invalid',
+                      use_cache=False, match_by_time=False) as run:
+        validated_df = run.get('validated')
+        results_df = run.get('results')
+
+    stages = [stage.name for stage in report.stages]
+    # マージ・照合は1回だけで、キャッシュを使わない場合のカレンダーはcalendarステージで1回だけ取得する
+    assert stages.count('merge') == 1
+    assert stages.count('calendar') == 1
+    assert len(results_df) == len(validated_df) + len(results_df.attrs['boundary_rows'])